@@ -0,0 +1,268 @@
+"""Token-budgeted conversation history for the Streamlit chat apps.
+
+Every message is tokenized once, when it is added, and its token count is
+cached next to it. The request sent to the model is built from:
+
+- the rolling summary of the older turns, as a system message
+- the most recent turns, verbatim, as many as fit in ``budget_tokens``
+
+Turns that fall out of the budget are folded into the summary by a
+background thread between turns, so the request size stays bounded (about
+``budget_tokens`` plus the summary, itself capped by the summarizer's
+``max_tokens``) however long the conversation runs.
+Until the thread finishes, the turns it is summarizing are left out of the
+request instead of growing it.
+
+Token counts use ``tiktoken`` when installed (and its encoding can be
+loaded) and a 4-characters-per-token estimate otherwise. Running the module prints the request size per turn of a
+simulated conversation::
+
+    python chat_history.py --turns 200 --budget 1000
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Sequence
+
+try:
+    import tiktoken
+except ImportError:  # stima a caratteri
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Token aggiunti dal formato chat a ogni messaggio (ruolo e separatori)
+MESSAGE_OVERHEAD_TOKENS = 4
+DEFAULT_ENCODING = "o200k_base"
+
+SUMMARY_PROMPT = (
+    "Update the running summary of a conversation between a user and an assistant. "
+    "Keep facts, decisions, names, numbers and open questions; drop pleasantries. "
+    "Answer with the updated summary only."
+)
+
+Message = Dict[str, str]
+Summarizer = Callable[[str, Sequence[Message]], str]
+
+
+def _load_encoding(name: str):
+    # Il primo uso scarica l'encoding: offline si ripiega sulla stima a caratteri
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as exc:
+        logger.warning("Encoding %s non disponibile (%s), token stimati", name, exc)
+        return None
+
+
+class TokenCounter:
+    """Token counter for chat messages.
+
+    Parameters
+    ----------
+    model : str, optional
+        Model name used to pick the ``tiktoken`` encoding; unknown names
+        (e.g. Azure deployment names) fall back to ``o200k_base``, and to
+        the character estimate when the encoding cannot be loaded.
+    """
+
+    def __init__(self, model: Optional[str] = None):
+        self._encoding = None
+        if tiktoken is not None:
+            try:
+                name = tiktoken.encoding_name_for_model(model or "")
+            except KeyError:
+                name = DEFAULT_ENCODING
+            # Anche i modelli noti passano da qui: il download può fallire
+            self._encoding = _load_encoding(name)
+
+    def count_text(self, text: str) -> int:
+        if self._encoding is None:
+            return (len(text) + 3) // 4
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def count_message(self, message: Message) -> int:
+        return self.count_text(message["content"] or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+def openai_summarizer(client, model: str, max_tokens: int = 300) -> Summarizer:
+    """Summarizer backed by an (Azure) OpenAI chat client.
+
+    Parameters
+    ----------
+    client : openai.OpenAI or openai.AzureOpenAI
+        Chat completions client.
+    model : str
+        Model or deployment name.
+    max_tokens : int, optional
+        Upper bound on the summary length.
+    """
+
+    def summarize(summary: str, messages: Sequence[Message]) -> str:
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        response = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"Current summary:\n{summary or '(empty)'}\n\nNew turns:\n{transcript}"},
+            ],
+            max_tokens=max_tokens,
+        )
+        return response.choices[0].message.content or summary
+
+    return summarize
+
+
+class HistoryManager:
+    """Conversation history with a token budget and a rolling summary.
+
+    Parameters
+    ----------
+    summarize : callable
+        ``summarize(summary, messages) -> summary``: folds ``messages`` into
+        the previous summary (see ``openai_summarizer``).
+    budget_tokens : int, optional
+        Token budget of the verbatim recent turns. The latest message is
+        always sent, even when it alone exceeds the budget.
+    system_prompt : str, optional
+        System message sent first in every request.
+    model : str, optional
+        Model name for the token counter.
+    """
+
+    def __init__(
+        self,
+        summarize: Summarizer,
+        budget_tokens: int = 2000,
+        system_prompt: Optional[str] = None,
+        model: Optional[str] = None,
+    ):
+        self.summarize = summarize
+        self.budget_tokens = budget_tokens
+        self.system_prompt = system_prompt
+        self.counter = TokenCounter(model)
+        self.messages: List[Message] = []
+        self.summary = ""
+        self.summary_error: Optional[Exception] = None
+        self._counts: List[int] = []
+        self._summarized = 0  # messaggi già inclusi nel riassunto
+        self._worker: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def append(self, role: str, content: str) -> None:
+        """Add a message, tokenizing it once."""
+        message = {"role": role, "content": content}
+        count = self.counter.count_message(message)
+        with self._lock:
+            self.messages.append(message)
+            self._counts.append(count)
+
+    def _window_start(self) -> int:
+        # Dal più recente all'indietro finché i turni stanno nel budget
+        start, used = len(self.messages), 0
+        while start > 0 and (start == len(self.messages) or used + self._counts[start - 1] <= self.budget_tokens):
+            used += self._counts[start - 1]
+            start -= 1
+        # Il contesto parte da un messaggio utente, non da metà turno
+        while start < len(self.messages) - 1 and self.messages[start]["role"] != "user":
+            start += 1
+        return start
+
+    def request_messages(self) -> List[Message]:
+        """Messages to send: system prompt, summary and the recent turns in budget."""
+        with self._lock:
+            recent = self.messages[self._window_start():]
+            summary = self.summary
+        request = []
+        if self.system_prompt:
+            request.append({"role": "system", "content": self.system_prompt})
+        if summary:
+            request.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+        return request + recent
+
+    def request_tokens(self) -> int:
+        """Tokens of ``request_messages()``, from the cached counts."""
+        with self._lock:
+            recent = sum(self._counts[self._window_start():])
+            summary = self.summary
+        extra = [m for m in (self.system_prompt, summary) if m]
+        return recent + sum(self.counter.count_text(m) + MESSAGE_OVERHEAD_TOKENS for m in extra)
+
+    def summarize_async(self) -> bool:
+        """Fold the turns that left the budget into the summary, in a background thread.
+
+        Call it after each complete turn. Does nothing when there is nothing
+        new to fold or a summary is already being computed.
+
+        Returns
+        -------
+        bool
+            Whether a summarization was started.
+        """
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return False
+            end = self._window_start()
+            if end <= self._summarized:
+                return False
+            pending = list(self.messages[self._summarized:end])
+            summary = self.summary
+            self._worker = threading.Thread(target=self._summarize, args=(summary, pending, end), daemon=True)
+        self._worker.start()
+        return True
+
+    def _summarize(self, summary: str, pending: List[Message], end: int) -> None:
+        try:
+            updated = self.summarize(summary, pending)
+        except Exception as exc:
+            # Al turno successivo si riprova con gli stessi messaggi
+            self.summary_error = exc
+            return
+        with self._lock:
+            self.summary = updated
+            self._summarized = end
+            self.summary_error = None
+
+    def wait(self, timeout: Optional[float] = None) -> None:
+        """Wait for the running summarization, if any."""
+        worker = self._worker
+        if worker is not None:
+            worker.join(timeout)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """Print the request size per turn of a simulated conversation, with and without budget."""
+    parser = argparse.ArgumentParser(description="Request size of a long conversation.")
+    parser.add_argument("--turns", type=int, default=200, help="User/assistant turns.")
+    parser.add_argument("--budget", type=int, default=1000, help="Token budget of the recent turns.")
+    parser.add_argument("--every", type=int, default=25, help="Print every N turns.")
+    args = parser.parse_args(argv)
+
+    def summarize(summary: str, messages: Sequence[Message]) -> str:
+        # Riassunto finto di lunghezza limitata, come con max_tokens
+        words = (summary + " " + " ".join(m["content"] for m in messages)).split()
+        return " ".join(words[-150:])
+
+    history = HistoryManager(summarize, budget_tokens=args.budget, system_prompt="You are a helpful assistant.")
+    full_tokens = history.counter.count_text(history.system_prompt) + MESSAGE_OVERHEAD_TOKENS
+    print(f"{'turno':>6} {'storia intera':>14} {'con budget':>11}")
+    for turn in range(1, args.turns + 1):
+        question = f"Question {turn}: how does step {turn} of the pipeline handle errors and retries?"
+        answer = f"Answer {turn}: " + "step details and caveats " * 12
+        history.append("user", question)
+        full_tokens += history.counter.count_message(history.messages[-1])
+        if turn % args.every == 0 or turn == 1:
+            print(f"{turn:>6} {full_tokens:>14} {history.request_tokens():>11}")
+        history.append("assistant", answer)
+        full_tokens += history.counter.count_message(history.messages[-1])
+        history.summarize_async()
+        history.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,8 @@ from dotenv import load_dotenv
 from openai import AzureOpenAI
 import streamlit as st
 
+from chat_history import HistoryManager, openai_summarizer
+
 # Load environment variables
 load_dotenv()
 
@@ -13,6 +15,9 @@ KEY = os.getenv("AZURE_OPENAI_KEY")
 DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT")
 API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION")
 
+# Tokens of recent turns sent verbatim; older turns are summarized
+HISTORY_BUDGET_TOKENS = 2000
+
 # login page
 def login():
     st.header("Login")
@@ -42,17 +47,22 @@ def chat():
             st.session_state['logged_in'] = False
             st.session_state['endpoint'] = ""
             st.session_state['key'] = ""
-            st.session_state.messages = []
+            st.session_state.pop("history", None)
             st.rerun()
 
     
     
     # Initialize chat history
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
+    if "history" not in st.session_state:
+        st.session_state.history = HistoryManager(
+            openai_summarizer(client, DEPLOYMENT),
+            budget_tokens=HISTORY_BUDGET_TOKENS,
+            model=DEPLOYMENT,
+        )
+    history = st.session_state.history
 
     # Display chat messages from history on app rerun
-    for message in st.session_state.messages:
+    for message in history.messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
 
@@ -61,11 +71,12 @@ def chat():
         # Display user message in chat message container
         st.chat_message("user").markdown(prompt)
         # Add user message to chat history
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        history.append("user", prompt)
 
+        # Send the summary and the recent turns only, not the whole history
         stream = client.chat.completions.create(
             model=DEPLOYMENT,
-            messages=st.session_state.messages,
+            messages=history.request_messages(),
             max_tokens=300,
             stream=True
     )
@@ -74,7 +85,9 @@ def chat():
             response = st.write_stream(stream)
 
         # Add assistant response to chat history
-        st.session_state.messages.append({"role": "assistant", "content": response})
+        history.append("assistant", response)
+        # Fold turns that left the budget into the summary, before the next turn
+        history.summarize_async()
 
 login_page = st.Page(login, title="Log in")
 chat_page = st.Page(chat, title="Chat")
@@ -3,6 +3,8 @@ import os
 from dotenv import load_dotenv
 from openai import AzureOpenAI
 
+from chat_history import HistoryManager, openai_summarizer
+
 # Load environment variables
 load_dotenv()
 
@@ -12,6 +14,9 @@ KEY = os.getenv("AZURE_OPENAI_KEY")
 DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT")
 API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION")
 
+# Tokens of recent turns sent verbatim; older turns are summarized
+HISTORY_BUDGET_TOKENS = 2000
+
 # Create Azure OpenAI client
 client = AzureOpenAI(
     api_key=KEY,
@@ -24,11 +29,16 @@ client = AzureOpenAI(
 st.title("My first chatbot")
 
 # Initialize chat history
-if "messages" not in st.session_state:
-    st.session_state.messages = []
+if "history" not in st.session_state:
+    st.session_state.history = HistoryManager(
+        openai_summarizer(client, DEPLOYMENT),
+        budget_tokens=HISTORY_BUDGET_TOKENS,
+        model=DEPLOYMENT,
+    )
+history = st.session_state.history
 
 # Display chat messages from history on app rerun
-for message in st.session_state.messages:
+for message in history.messages:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
@@ -37,11 +47,12 @@ if prompt := st.chat_input("What is up?"):
     # Display user message in chat message container
     st.chat_message("user").markdown(prompt)
     # Add user message to chat history
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    history.append("user", prompt)
 
+    # Send the summary and the recent turns only, not the whole history
     stream = client.chat.completions.create(
         model=DEPLOYMENT,
-        messages=st.session_state.messages,
+        messages=history.request_messages(),
         max_tokens=300,
         stream=True
 )
@@ -50,4 +61,6 @@ if prompt := st.chat_input("What is up?"):
         response = st.write_stream(stream)
 
     # Add assistant response to chat history
-    st.session_state.messages.append({"role": "assistant", "content": response})
\ No newline at end of file
+    history.append("assistant", response)
+    # Fold turns that left the budget into the summary, before the next turn
+    history.summarize_async()
\ No newline at end of file
@@ -0,0 +1,20 @@
+import pytest
+
+import chat_history
+from chat_history import TokenCounter
+
+tiktoken = pytest.importorskip("tiktoken")
+
+
+@pytest.mark.parametrize("model", ["gpt-4o", "my-azure-deployment", None])
+def test_falls_back_to_the_estimate_when_the_encoding_cannot_be_loaded(monkeypatch, model):
+    def offline(name):
+        raise ConnectionError(f"cannot download {name}")
+
+    monkeypatch.setattr(chat_history.tiktoken, "get_encoding", offline)
+
+    counter = TokenCounter(model)
+
+    assert counter._encoding is None
+    assert counter.count_text("x" * 10) == 3
+    assert counter.count_message({"role": "user", "content": "abcd"}) == 1 + chat_history.MESSAGE_OVERHEAD_TOKENS
@@ -1,9 +1,16 @@
 from __future__ import annotations
 
+import hashlib
+import logging
 import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dataclasses import dataclass
-from typing import List
+from typing import List, Optional
 import getpass
 
 from dotenv import load_dotenv
@@ -20,12 +27,22 @@ from langchain_openai import AzureOpenAIEmbeddings
 
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 
 from langchain.chat_models import init_chat_model
 
 from openai import AzureOpenAI
 
+# Moduli condivisi con il pacchetto rag_or_search (2025_08_27): unica copia nel repository
+try:
+    import rag_or_search  # noqa: F401  (installato con pip install -e)
+except ImportError:
+    sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "2025_08_27" / "rag_or_search" / "src"))
+
+from rag_or_search.tools.embedding_cache import CachedEmbeddings, EmbeddingCache
+from rag_or_search.tools.rag_utils import SETTINGS as RAG_SETTINGS
+from rag_or_search.tools.semantic_cache import SemanticCache
+
 from ragas import evaluate, EvaluationDataset
 from ragas.metrics import (
     context_precision,   # "precision@k" sui chunk recuperati
@@ -35,6 +52,8 @@ from ragas.metrics import (
     answer_correctness,  # usa questa solo se hai ground_truth
 )
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 load_dotenv()
 
@@ -43,11 +62,53 @@ ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 KEY = os.getenv("AZURE_OPENAI_KEY")
 DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT")
 API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION")
-st.session_state.search_method = None
-st.session_state.k = None
-st.session_state.fetch_k = None
-st.session_state.lambda_param = None
-st.session_state.uploaded_files = None
+
+# Indici FAISS tenuti in memoria tra rerun e sessioni (i meno recenti vengono scartati)
+VECTOR_STORE_CACHE_ENTRIES = 8
+
+# Un indice per corpus sotto INDEX_ROOT; oltre la quota si eliminano i meno usati di recente
+INDEX_ROOT = "faiss_indexes"
+INDEX_DISK_QUOTA_BYTES = 2 * 1024 * 1024 * 1024
+LAST_USED_FILE = "last_used"
+# Cartelle temporanee di build più vecchie di così sono residui di run interrotti
+STALE_BUILD_SECONDS = 3600
+
+# Indicizzazione in background: job contemporanei (condivisi da tutte le sessioni), chunk per batch
+INDEX_WORKERS = 2
+INDEX_BATCH_SIZE = 64
+PROGRESS_REFRESH_SECONDS = 1.0
+
+# Metodi di ricerca selezionabili nella sidebar (gli altri valori sono il placeholder)
+SEARCH_METHODS = ("MMR", "Similarity")
+
+# Un solo GC degli indici alla volta: job concorrenti non eliminano le stesse cartelle
+GC_LOCK = threading.Lock()
+
+# Valori iniziali dello stato di sessione, impostati solo al primo run
+SESSION_DEFAULTS = {
+    "search_method": None,
+    "k": None,
+    "fetch_k": None,
+    "lambda_param": None,
+    "uploaded_files": None,
+    "ready": False,
+    "retriever": None,
+    "answer_chain": None,
+    "vector_store": None,
+    "corpus_key": None,
+    "retrieval_params": None,
+    "index_job": None,
+}
+
+
+def init_session_state():
+    """
+    Inizializza lo stato di sessione senza sovrascrivere i valori dei run precedenti.
+    """
+    for key, value in SESSION_DEFAULTS.items():
+        if key not in st.session_state:
+            st.session_state[key] = value
+
 
 def selection():
     # sidebar
@@ -82,19 +143,75 @@ load_dotenv()
 # Componenti di base
 # =========================
 
+@st.cache_resource
 def get_embeddings():
+    """
+    Client degli embedding con cache su disco, creato una volta e condiviso tra rerun e sessioni.
+    """
 
     if not os.getenv("AZURE_OPENAI_KEY"):
         os.environ["AZURE_OPENAI_KEY"] = getpass.getpass(
             "Enter your AzureOpenAI API key: "
         )
     
-    return AzureOpenAIEmbeddings(
+    embeddings = AzureOpenAIEmbeddings(
         azure_deployment=os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"),
         azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
         openai_api_key=os.getenv("AZURE_OPENAI_KEY"),
         openai_api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
     )
+    # Cache degli embedding: la domanda embeddata per la cache semantica non viene ricalcolata dal retriever
+    cache = EmbeddingCache("embedding_cache", max_bytes=512 * 1024 * 1024)
+    return CachedEmbeddings(embeddings, cache, model=os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT") or "default")
+
+
+def response_cache_threshold() -> Optional[float]:
+    """
+    Soglia della cache semantica: RESPONSE_CACHE_THRESHOLD se impostata ("off" o vuota la disattiva),
+    altrimenti response_cache_threshold delle impostazioni di rag_or_search (None: disattivata).
+    """
+    value = os.getenv("RESPONSE_CACHE_THRESHOLD")
+    if value is None:
+        return RAG_SETTINGS.response_cache_threshold
+    if value.strip().lower() in ("", "off", "none"):
+        return None
+    return float(value)
+
+
+@st.cache_resource
+def get_response_cache() -> Optional[SemanticCache]:
+    """
+    Cache semantica delle risposte, condivisa tra rerun e sessioni: domande quasi identiche
+    (similarità coseno >= soglia) sullo stesso indice e con gli stessi parametri saltano l'LLM.
+    None se la cache è disattivata (vedi response_cache_threshold).
+    """
+    threshold = response_cache_threshold()
+    if threshold is None:
+        return None
+    return SemanticCache(
+        threshold=threshold,
+        ttl_seconds=RAG_SETTINGS.response_cache_ttl,
+        max_entries=RAG_SETTINGS.response_cache_size,
+    )
+
+
+def index_version(settings) -> tuple:
+    """
+    Versione dell'indice per la cache semantica: firma dei file persistiti più i parametri di retrieval.
+    """
+    signature = []
+    for name in ("index.faiss", "index.pkl"):
+        path = Path(settings["persist_dir"]) / name
+        stat = path.stat() if path.exists() else None
+        signature.append((stat.st_mtime_ns, stat.st_size) if stat else None)
+    return (
+        tuple(signature),
+        settings.get("corpus_key"),
+        settings["search_type"],
+        settings["k"],
+        settings["fetch_k"],
+        settings["mmr_lambda"],
+    )
 
 
 def get_llm_from_lmstudio(settings):
@@ -121,18 +238,31 @@ def get_llm_from_lmstudio(settings):
 
     return init_chat_model(model_name, model_provider="azure_openai", api_key=api_key, api_version=api_version)
 
+
+@st.cache_resource
+def get_llm(lmstudio_model_env: str):
+    """
+    ChatModel condiviso tra rerun e sessioni, uno per variabile d'ambiente del modello.
+    """
+    return get_llm_from_lmstudio({"lmstudio_model_env": lmstudio_model_env})
+
 def load_file(file) -> List[Document]:
-    documents = []
-    content = file.read()
+    # getvalue non sposta il cursore: il file resta leggibile nei rerun successivi
+    return parse_file(file.name, file.getvalue())
+
+def parse_file(name: str, content) -> List[Document]:
+    """
+    Divide il contenuto di un file nelle sue sezioni (separate da ---), una per Document.
+    """
     if isinstance(content, bytes):
         content = content.decode("utf-8")  # decode bytes to string
 
-    print(f"Loaded {file.name} ({len(content)} characters), type: {type(content)}")
+    print(f"Loaded {name} ({len(content)} characters), type: {type(content)}")
 
     documents = [
         Document(
             page_content=section,
-            metadata={"source": file.name, "section": i}
+            metadata={"source": name, "section": i}
         )
         for i, section in enumerate(content.split("---"), start=1)
         if section.strip()
@@ -215,18 +345,35 @@ def split_documents(docs: List[Document], settings) -> List[Document]:
 def build_faiss_vectorstore(chunks: List[Document], embeddings, persist_dir: str) -> FAISS:
     """
     Costruisce da zero un FAISS index (IndexFlatL2) e lo salva su disco.
+    Il salvataggio avviene in una cartella temporanea rinominata alla fine: chi carica
+    ``persist_dir`` vede solo indici completi, anche con più sessioni sullo stesso corpus.
     """
     # Determina la dimensione dell'embedding
     vs = FAISS.from_documents(
         documents=chunks,
         embedding=embeddings
     )
-
-    Path(persist_dir).mkdir(parents=True, exist_ok=True)
-    vs.save_local(persist_dir)
+    save_vectorstore(vs, persist_dir)
     return vs
 
 
+def save_vectorstore(vs: FAISS, persist_dir: str) -> None:
+    """
+    Salva ``vs`` in ``persist_dir`` passando da una cartella temporanea rinominata alla fine.
+    """
+    target = Path(persist_dir)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.parent / f".tmp-{target.name}-{os.getpid()}-{threading.get_ident()}"
+    vs.save_local(str(tmp))
+    if target.exists() and not index_exists(persist_dir):
+        shutil.rmtree(target, ignore_errors=True)
+    try:
+        os.rename(tmp, target)
+    except OSError:
+        # Un'altra sessione ha già salvato lo stesso corpus: le due copie sono equivalenti
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
 def load_or_build_vectorstore(settings, embeddings, docs: List[Document]) -> FAISS:
     """
     Tenta il load di un indice FAISS persistente; se non esiste, lo costruisce e lo salva.
@@ -247,6 +394,212 @@ def load_or_build_vectorstore(settings, embeddings, docs: List[Document]) -> FAI
     return build_faiss_vectorstore(chunks, embeddings, settings["persist_dir"])
 
 
+def corpus_key(uploaded_files, settings) -> str:
+    """
+    Chiave del corpus: hash del contenuto dei file caricati (con il nome, usato come source),
+    dei parametri di chunking e del deployment degli embedding, perché vettori di modelli diversi
+    non sono confrontabili. Upload identici, anche da sessioni diverse, hanno la stessa chiave.
+    """
+    digest = hashlib.sha256()
+    files = sorted((f.name, hashlib.sha256(f.getvalue()).hexdigest()) for f in uploaded_files)
+    for name, content_hash in files:
+        digest.update(f"{name}\0{content_hash}\0".encode("utf-8"))
+    digest.update(f"{settings['chunk_size']}\0{settings['chunk_overlap']}\0".encode("utf-8"))
+    digest.update((os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT") or "default").encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+def index_dir(key: str) -> str:
+    """Cartella dell'indice del corpus ``key`` (vedi ``corpus_key``)."""
+    return str(Path(INDEX_ROOT) / key)
+
+
+def touch_index(persist_dir: str) -> None:
+    """Segna l'indice come appena usato, per la politica LRU di ``gc_indexes``."""
+    if Path(persist_dir).is_dir():
+        (Path(persist_dir) / LAST_USED_FILE).touch()
+
+
+def _dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def gc_indexes(root: str = INDEX_ROOT, quota_bytes: int = INDEX_DISK_QUOTA_BYTES, keep=()) -> List[str]:
+    """
+    Elimina gli indici usati meno di recente finché ``root`` rientra in ``quota_bytes``.
+    Le cartelle in ``keep`` non vengono mai eliminate; le build temporanee abbandonate sì.
+    Ritorna i nomi delle cartelle eliminate.
+    """
+    root_path = Path(root)
+    if not root_path.is_dir():
+        return []
+    keep = {Path(p).name for p in keep}
+    now = time.time()
+    removed, entries = [], []
+    for path in root_path.iterdir():
+        if not path.is_dir():
+            continue
+        if path.name.startswith(".tmp-"):
+            if now - path.stat().st_mtime > STALE_BUILD_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+                removed.append(path.name)
+            continue
+        marker = path / LAST_USED_FILE
+        last_used = (marker if marker.exists() else path).stat().st_mtime
+        entries.append((last_used, path, _dir_size(path)))
+
+    total = sum(size for _, _, size in entries)
+    for _, path, size in sorted(entries, key=lambda e: e[0]):
+        if total <= quota_bytes:
+            break
+        if path.name in keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed.append(path.name)
+    return removed
+
+
+def collect_indexes(keep=()) -> None:
+    """
+    ``gc_indexes`` sotto ``GC_LOCK``. È solo manutenzione: gli errori finiscono nel log
+    e non fanno fallire chi lo chiama.
+    """
+    try:
+        with GC_LOCK:
+            removed = gc_indexes(keep=keep)
+    except Exception:
+        logger.exception("GC degli indici fallito")
+        return
+    if removed:
+        logger.info("Indici eliminati per la quota disco: %s", removed)
+
+
+def index_exists(persist_dir: str) -> bool:
+    """Se ``persist_dir`` contiene un indice completo."""
+    return (Path(persist_dir) / "index.faiss").exists() and (Path(persist_dir) / "index.pkl").exists()
+
+
+@st.cache_resource(max_entries=VECTOR_STORE_CACHE_ENTRIES, show_spinner="Caricamento dell'indice...")
+def get_vector_store(key: str) -> FAISS:
+    """
+    Vector store già persistito del corpus ``key`` (vedi ``corpus_key``), condiviso tra rerun e sessioni.
+    Un corpus indicizzato, anche da un'altra sessione o prima di un riavvio, si carica da disco
+    senza ricalcolare gli embedding; i corpus nuovi sono costruiti da un ``IndexJob``.
+    """
+    persist_dir = index_dir(key)
+    # Segnato prima del caricamento, così un GC concorrente non lo sceglie
+    touch_index(persist_dir)
+    return load_or_build_vectorstore({"persist_dir": persist_dir}, get_embeddings(), [])
+
+
+class IndexJob:
+    """
+    Indicizzazione in background di un corpus caricato. Il thread del job aggiunge i chunk
+    all'indice un batch di embedding alla volta; lo script Streamlit legge il progresso e,
+    sotto ``lock``, interroga l'indice parziale mentre la costruzione prosegue.
+    """
+
+    def __init__(self, key: str, files, settings, embeddings):
+        self.key = key
+        self.files = files  # lista di (nome, contenuto in bytes)
+        self.settings = settings
+        self.embeddings = embeddings
+        self.lock = threading.Lock()
+        self.vector_store = None
+        self.total_files = len(files)
+        self.files_done = 0
+        self.current_file = None
+        self.file_batches = 0
+        self.file_batches_done = 0
+        self.chunks_indexed = 0
+        self.started = False
+        self.done = False
+        self.error = None
+
+    def progress(self) -> float:
+        """Frazione completata, contando i batch del file in corso."""
+        if not self.total_files:
+            return 1.0
+        current = self.file_batches_done / self.file_batches if self.file_batches else 0.0
+        return min(1.0, (self.files_done + current) / self.total_files)
+
+    def run(self) -> None:
+        self.started = True
+        persist_dir = None
+        try:
+            for name, content in self.files:
+                self.current_file = name
+                chunks = split_documents(parse_file(name, content), self.settings)
+                batches = [chunks[i:i + INDEX_BATCH_SIZE] for i in range(0, len(chunks), INDEX_BATCH_SIZE)]
+                self.file_batches, self.file_batches_done = len(batches), 0
+                for batch in batches:
+                    texts = [c.page_content for c in batch]
+                    # Embedding fuori dal lock: le ricerche sull'indice parziale non aspettano l'API
+                    vectors = self.embeddings.embed_documents(texts)
+                    text_embeddings = list(zip(texts, vectors))
+                    metadatas = [c.metadata for c in batch]
+                    with self.lock:
+                        if self.vector_store is None:
+                            self.vector_store = FAISS.from_embeddings(text_embeddings, self.embeddings, metadatas=metadatas)
+                        else:
+                            self.vector_store.add_embeddings(text_embeddings, metadatas=metadatas)
+                        self.chunks_indexed += len(batch)
+                    self.file_batches_done += 1
+                self.files_done += 1
+
+            if self.vector_store is not None:
+                persist_dir = index_dir(self.key)
+                save_vectorstore(self.vector_store, persist_dir)
+                touch_index(persist_dir)
+        except Exception as exc:
+            # Mostrato nella sidebar dallo script
+            self.error = exc
+            persist_dir = None
+        finally:
+            self.done = True
+        # Fuori dal try: un errore del GC non fa fallire un indice già salvato
+        if persist_dir is not None:
+            collect_indexes(keep=[persist_dir])
+
+
+class IndexJobQueue:
+    """
+    Job di indicizzazione condivisi tra sessioni: al massimo ``max_workers`` alla volta, gli altri
+    in coda, così un upload molto grande non blocca le altre sessioni. Lo stesso corpus caricato
+    da più sessioni viene indicizzato una volta sola.
+    """
+
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="index")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, files, settings, embeddings) -> IndexJob:
+        """Ritorna il job del corpus ``key``, avviandolo se non è già in corso."""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is None or job.error is not None:
+                job = IndexJob(key, files, settings, embeddings)
+                self._jobs[key] = job
+                self._executor.submit(self._run, job)
+            return job
+
+    def _run(self, job: IndexJob) -> None:
+        job.run()
+        if job.error is None:
+            with self._lock:
+                # Completato: da qui in poi il corpus si carica da disco
+                if self._jobs.get(job.key) is job:
+                    del self._jobs[job.key]
+
+
+@st.cache_resource
+def get_index_queue() -> IndexJobQueue:
+    """Coda dei job di indicizzazione, unica per processo."""
+    return IndexJobQueue(INDEX_WORKERS)
+
+
 def make_retriever(vector_store: FAISS, settings):
     """
     Configura il retriever. Con 'mmr' otteniamo risultati meno ridondanti e più coprenti.
@@ -263,6 +616,17 @@ def make_retriever(vector_store: FAISS, settings):
         )
 
 
+def locked_retriever(retriever, lock):
+    """
+    Retriever che interroga l'indice sotto ``lock``: l'indice parziale di un ``IndexJob`` cresce in parallelo.
+    """
+    def invoke(question):
+        with lock:
+            return retriever.invoke(question)
+
+    return RunnableLambda(invoke)
+
+
 def format_docs_for_prompt(docs: List[Document]) -> str:
     """
     Prepara il contesto per il prompt, includendo citazioni [source].
@@ -274,9 +638,11 @@ def format_docs_for_prompt(docs: List[Document]) -> str:
     return "\n\n".join(lines)
 
 
-def build_rag_chain(llm, retriever):
+def build_answer_chain(llm):
     """
-    Costruisce la catena RAG (retrieval -> prompt -> LLM) con citazioni e regole anti-hallucination.
+    Parte generativa della catena RAG (prompt -> LLM) con citazioni e regole anti-hallucination.
+    Riceve ``{"question", "context"}``: separata dal retrieval per poter mostrare le fonti
+    prima dello streaming della risposta.
     """
     system_prompt = (
         "Sei un assistente esperto. Rispondi in italiano. "
@@ -297,24 +663,39 @@ def build_rag_chain(llm, retriever):
          "3) La risposta è sempre presente nel contesto.")
     ])
 
+    # LCEL: prompt -> llm -> parser
+    return prompt | llm | StrOutputParser()
+
+
+def build_rag_chain(llm, retriever):
+    """
+    Costruisce la catena RAG completa (retrieval -> prompt -> LLM).
+    """
     # LCEL: dict -> prompt -> llm -> parser
     chain = (
         {
             "context": retriever | format_docs_for_prompt,
             "question": RunnablePassthrough(),
         }
-        | prompt
-        | llm
-        | StrOutputParser()
+        | build_answer_chain(llm)
     )
     return chain
 
 
-def rag_answer(question: str, chain) -> str:
+def rag_answer_stream(question: str, retriever, answer_chain):
     """
-    Esegue la catena RAG per una singola domanda.
+    Risposta RAG in due tempi: ritorna subito i documenti recuperati e un iteratore
+    sui token della risposta, generati man mano che arrivano dall'LLM.
     """
-    return chain.invoke(question)
+    docs = retriever.invoke(question)
+    tokens = answer_chain.stream({"question": question, "context": format_docs_for_prompt(docs)})
+    return docs, tokens
+
+
+def format_sources(docs: List[Document]) -> str:
+    """Fonti dei documenti recuperati, senza duplicati e nell'ordine del retrieval."""
+    sources = dict.fromkeys(d.metadata.get("source", "?") for d in docs)
+    return "Fonti: " + ", ".join(sources)
 
 def get_contexts_for_question(retriever, question: str, k: int) -> List[str]:
     """Ritorna i testi dei top-k documenti (chunk) usati come contesto."""
@@ -354,36 +735,153 @@ def build_ragas_dataset(
 # Esecuzione dimostrativa
 # =========================
 
-def rag():
-    settings = {
-        "persist_dir": "faiss_index_example",
+def app_settings():
+    """
+    Parametri correnti dell'app: indicizzazione fissa, retrieval dalla sidebar.
+    """
+    return {
+        "persist_dir": index_dir(st.session_state.corpus_key) if st.session_state.corpus_key else None,
         "chunk_size": 1000,
         "chunk_overlap": 100,
         "search_type": st.session_state.search_method,
         "k": st.session_state.k,
         "fetch_k": st.session_state.fetch_k,
         "mmr_lambda": st.session_state.lambda_param,
-        "lmstudio_model_env": "LMSTUDIO_MODEL"
+        "lmstudio_model_env": "LMSTUDIO_MODEL",
+        "corpus_key": st.session_state.corpus_key,
     }
-    
-    # 1) Componenti
-    embeddings = get_embeddings()
-    llm = get_llm_from_lmstudio(settings)
 
-    # 2) Docuementi e indicizzazione
-    docs = load_documents(st.session_state.uploaded_files)
-    vector_store = load_or_build_vectorstore(settings, embeddings, docs)
 
-    # 3) Retriever ottimizzato
+def retrieval_params(settings) -> tuple:
+    """Parametri che cambiano solo il retriever, non l'indice."""
+    return (settings["search_type"], settings["k"], settings["fetch_k"], settings["mmr_lambda"])
+
+
+def build_chain(vector_store: FAISS, settings, lock=None) -> None:
+    """
+    Retriever e parte generativa della catena RAG sull'indice dato, salvati nello stato di sessione:
+    operazione leggera, rifatta a ogni cambio di k, fetch_k o lambda. La chat è pronta quando
+    ``answer_chain`` è impostata (vedi ``chain_ready``).
+    Con ``lock`` l'indice è ancora in costruzione (vedi ``IndexJob``).
+    """
+    # 1) Componenti (dalla cache delle risorse)
+    embeddings = get_embeddings()
+    llm = get_llm(settings["lmstudio_model_env"])
+
+    # 2) Retriever ottimizzato
     retriever = make_retriever(vector_store, settings)
+    if lock is not None:
+        retriever = locked_retriever(retriever, lock)
 
-    # 4) Catena RAG
-    chain = build_rag_chain(llm, retriever)
+    # 3) Retriever e parte generativa separati: in chat le fonti compaiono prima dello streaming
+    st.session_state.retriever = retriever
+    st.session_state.answer_chain = build_answer_chain(llm)
+
+    # 4) Chat interattiva (embeddings e versione dell'indice servono alla cache semantica;
+    #    sull'indice parziale le risposte non vengono messe in cache)
+    st.session_state.embeddings = embeddings
+    st.session_state.index_version = index_version(settings) if lock is None else None
+    st.session_state.retrieval_params = retrieval_params(settings)
+
+
+def chain_ready() -> bool:
+    """Se retriever e parte generativa sono pronti per la chat."""
+    return st.session_state.retriever is not None and st.session_state.answer_chain is not None
 
-    # 5) Chat interattiva
-    return chain
 
-def print_chat(chain):
+def reset_chain() -> None:
+    """Scarta retriever e parte generativa: la chat resta nascosta finché non vengono ricostruiti."""
+    st.session_state.retriever = None
+    st.session_state.answer_chain = None
+    st.session_state.retrieval_params = None
+
+
+def rag() -> None:
+    """
+    Indice dei file caricati e catena RAG. Un corpus già indicizzato si carica subito; uno nuovo
+    viene indicizzato in background e la catena è pronta dal primo batch (vedi ``refresh_chain``).
+    """
+    settings = app_settings()
+    key = corpus_key(st.session_state.uploaded_files, settings)
+    st.session_state.corpus_key = key
+    st.session_state.index_job = None
+    st.session_state.vector_store = None
+    reset_chain()
+
+    if index_exists(index_dir(key)):
+        vector_store = get_vector_store(key)
+        # Anche gli hit della cache in memoria contano come uso per l'LRU su disco
+        touch_index(index_dir(key))
+        st.session_state.vector_store = vector_store
+        build_chain(vector_store, app_settings())
+        return
+
+    files = [(f.name, f.getvalue()) for f in st.session_state.uploaded_files]
+    st.session_state.index_job = get_index_queue().submit(key, files, settings, get_embeddings())
+
+
+def refresh_chain():
+    """
+    Aggiorna la catena senza ricostruire l'indice: al primo batch indicizzato, a fine
+    indicizzazione o quando cambiano solo i parametri di retrieval.
+    Va chiamata a ogni run anche senza un metodo di ricerca valido: un job concluso viene
+    comunque chiuso, e la catena si costruisce appena il metodo torna valido.
+    """
+    settings = app_settings()
+    valid_method = settings["search_type"] in SEARCH_METHODS
+    params_changed = retrieval_params(settings) != st.session_state.retrieval_params
+    job = st.session_state.index_job
+    if job is None:
+        if valid_method and st.session_state.vector_store is not None and params_changed:
+            # Cambiano solo i parametri di retrieval: nuovo retriever sullo stesso indice
+            build_chain(st.session_state.vector_store, settings)
+        return
+
+    if job.error is not None:
+        st.sidebar.error(f"Indicizzazione fallita: {job.error}")
+        st.session_state.index_job = None
+        # Niente catena sull'indice parziale di un job fallito
+        reset_chain()
+    elif job.done:
+        st.session_state.index_job = None
+        if job.vector_store is None:
+            st.sidebar.warning("Nessun contenuto da indicizzare nei file caricati.")
+            return
+        # Indice completo (ormai anche su disco): niente più lock
+        st.session_state.vector_store = job.vector_store
+        if valid_method:
+            build_chain(job.vector_store, settings)
+        else:
+            # La catena sull'indice parziale non va più usata: si ricostruisce col prossimo metodo valido
+            reset_chain()
+    elif valid_method and job.vector_store is not None and (not chain_ready() or params_changed):
+        build_chain(job.vector_store, settings, lock=job.lock)
+
+
+@st.fragment(run_every=PROGRESS_REFRESH_SECONDS)
+def show_index_progress():
+    """
+    Avanzamento dell'indicizzazione in background, aggiornato senza rieseguire tutta l'app.
+    """
+    job = st.session_state.index_job
+    if job is None:
+        return
+    if not job.started:
+        st.progress(0.0, text="Indicizzazione in coda...")
+    elif not job.done:
+        st.progress(
+            job.progress(),
+            text=(
+                f"File {min(job.files_done + 1, job.total_files)}/{job.total_files} ({job.current_file}): "
+                f"batch {job.file_batches_done}/{job.file_batches}, {job.chunks_indexed} chunk indicizzati"
+            ),
+        )
+    # Primo batch pronto (con un metodo di ricerca scelto) o job concluso: rerun completo per aggiornare la catena
+    first_batch = job.vector_store is not None and not chain_ready()
+    if job.done or (first_batch and st.session_state.search_method in SEARCH_METHODS):
+        st.rerun()
+
+def print_chat():
     # Initialize chat history
     if "messages" not in st.session_state:
         st.session_state.messages = []
@@ -391,6 +889,8 @@ def print_chat(chain):
     # Display chat messages from history on app rerun
     for message in st.session_state.messages:
         with st.chat_message(message["role"]):
+            if message.get("sources"):
+                st.caption(message["sources"])
             st.markdown(message["content"])
 
     # React to user input
@@ -401,29 +901,60 @@ def print_chat(chain):
         with st.chat_message("user"):
             st.markdown(prompt)
 
-        ans = rag_answer(prompt, chain)
+        cache = get_response_cache()
+        version = st.session_state.index_version
+        hit = None
+        if cache is not None and version is not None:
+            vector = st.session_state.embeddings.embed_query(prompt)
+            hit = cache.lookup(vector, version)
+        sources = None
         # Display assistant response in chat message container
         with st.chat_message("assistant"):
-            st.markdown(ans)
+            if hit is not None:
+                ans = hit.answer
+                # Le fonti della risposta originale, come per una risposta generata
+                sources = hit.contexts
+                if sources:
+                    st.caption(sources)
+                st.markdown(ans)
+                stats = cache.stats()
+                st.caption(
+                    f"Risposta dalla cache (similarità {hit.similarity:.2f}, "
+                    f"hit rate {stats['hit_rate']:.0%})"
+                )
+            else:
+                # Le fonti compaiono appena finisce il retrieval, poi la risposta token per token
+                with st.spinner("Ricerca nei documenti..."):
+                    docs, tokens = rag_answer_stream(
+                        prompt, st.session_state.retriever, st.session_state.answer_chain
+                    )
+                if docs:
+                    sources = format_sources(docs)
+                    st.caption(sources)
+                ans = st.write_stream(tokens)
+                if cache is not None and version is not None:
+                    cache.put(vector, version, answer=ans, contexts=sources)
 
         # Add assistant response to chat history
-        st.session_state.messages.append({"role": "assistant", "content": ans})
+        st.session_state.messages.append({"role": "assistant", "content": ans, "sources": sources})
             
 
 def main():
+    init_session_state()
     selection()
-    
-    if "chain" not in st.session_state:
-        st.session_state.chain = None
-        
+
+    valid_method = st.session_state.search_method in SEARCH_METHODS
     if st.session_state.ready:
-        if (st.session_state.search_method == "MMR" or st.session_state.search_method == "Similarity") and st.session_state.uploaded_files is not None:
-            st.session_state.chain = rag()
+        if valid_method and st.session_state.uploaded_files:
+            rag()
         else:
             st.sidebar.warning("Set all parameters or upload at least one file!")
-    
-    if st.session_state.chain is not None:
-        print_chat(st.session_state.chain)
+    else:
+        refresh_chain()
+
+    show_index_progress()
+    if chain_ready():
+        print_chat()
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
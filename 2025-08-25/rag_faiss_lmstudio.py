@@ -1,15 +1,18 @@
 from __future__ import annotations
 
 import os
+import sys
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import List, Tuple
 
 import faiss
+import numpy as np
 from langchain.schema import Document
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_openai import AzureOpenAIEmbeddings
 
@@ -24,7 +27,17 @@ from langchain.chat_models import init_chat_model
 from dotenv import load_dotenv
 import getpass
 
-from ragas import evaluate, EvaluationDataset
+# Moduli condivisi con il pacchetto rag_or_search (2025_08_27): unica copia nel repository
+try:
+    import rag_or_search  # noqa: F401  (installato con pip install -e)
+except ImportError:
+    sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "2025_08_27" / "rag_or_search" / "src"))
+
+from rag_or_search.tools.embedding_cache import CachedEmbeddings, EmbeddingCache
+from rag_or_search.tools.rag_utils import iter_md_documents
+from ragas_runner import evaluate_dataset
+
+import pandas as pd
 from ragas.metrics import (
     context_precision,   # "precision@k" sui chunk recuperati
     context_recall,      # copertura dei chunk rilevanti
@@ -55,6 +68,9 @@ class Settings:
     hf_model_name: str = "sentence-transformers/all-MiniLM-L6-v2" #TODO change to correct model name ??
     # LM Studio (OpenAI-compatible)
     lmstudio_model_env: str = "LMSTUDIO_MODEL"  # nome del modello in LM Studio, via env var
+    # Cache persistente degli embedding (None = disabilitata)
+    embedding_cache_dir: str | None = "embedding_cache"
+    embedding_cache_max_mb: int = 512
 
 
 
@@ -65,19 +81,31 @@ SETTINGS = Settings()
 # Componenti di base
 # =========================
 
-def get_embeddings():
+def get_embeddings(settings: Settings | None = None):
+    """
+    Inizializza gli embedding Azure OpenAI. Se la cache è abilitata nei settings,
+    chunk e query già visti vengono letti da disco invece di essere ricalcolati.
+    """
 
     if not os.getenv("AZURE_OPENAI_KEY"):
         os.environ["AZURE_OPENAI_KEY"] = getpass.getpass(
             "Enter your AzureOpenAI API key: "
         )
     
-    return AzureOpenAIEmbeddings(
+    embeddings = AzureOpenAIEmbeddings(
         azure_deployment=os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"),
         azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
         openai_api_key=os.getenv("AZURE_OPENAI_KEY"),
         openai_api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
     )
+    if settings is None or not settings.embedding_cache_dir:
+        return embeddings
+
+    cache = EmbeddingCache(
+        settings.embedding_cache_dir,
+        max_bytes=settings.embedding_cache_max_mb * 1024 * 1024,
+    )
+    return CachedEmbeddings(embeddings, cache, model=os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT") or "default")
 
 
 def get_llm_from_lmstudio(settings: Settings):
@@ -114,24 +142,7 @@ def load_md_documents(file_path: str) -> List[Document]:
     """
     Legge un file Markdown e restituisce una lista di Document (uno per ogni sezione separata da titoli).
     """
-    documents = []
-    if not os.path.isfile(file_path):
-        raise FileNotFoundError(f"File not found: {file_path}")
-
-    with open(file_path, "r", encoding="utf-8") as f:
-        content = f.read()
-
-    documents = [
-        Document(
-            page_content=section,
-            metadata={"source": os.path.basename(file_path), "section": i}
-        )
-        for i, section in enumerate(content.split("---"), start=1)
-        if section.strip()
-    ]
-    
-    return documents
-    
+    return list(iter_md_documents(file_path))
 
 def simulate_corpus() -> List[Document]:
     """
@@ -183,7 +194,13 @@ def split_documents(docs: List[Document], settings: Settings) -> List[Document]:
     """
     Applica uno splitting robusto ai documenti per ottimizzare il retrieval.
     """
-    splitter = RecursiveCharacterTextSplitter(
+    return make_splitter(settings).split_documents(docs)
+
+def make_splitter(settings: Settings) -> RecursiveCharacterTextSplitter:
+    """
+    Crea lo splitter usato da split_documents.
+    """
+    return RecursiveCharacterTextSplitter(
         chunk_size=settings.chunk_size,
         chunk_overlap=settings.chunk_overlap,
         separators=[
@@ -191,7 +208,6 @@ def split_documents(docs: List[Document], settings: Settings) -> List[Document]:
             ", ", " ", ""  # fallback aggressivo
         ],
     )
-    return splitter.split_documents(docs)
 
 
 def build_faiss_vectorstore(chunks: List[Document], embeddings, persist_dir: str) -> FAISS:
@@ -256,9 +272,10 @@ def format_docs_for_prompt(docs: List[Document]) -> str:
     return "\n\n".join(lines)
 
 
-def build_rag_chain(llm, retriever):
+def build_answer_chain(llm):
     """
-    Costruisce la catena RAG (retrieval -> prompt -> LLM) con citazioni e regole anti-hallucination.
+    Costruisce la parte generativa della catena RAG (prompt -> LLM) con citazioni e regole
+    anti-hallucination. Riceve un dict con 'question' e 'context' già formattato.
     """
     system_prompt = (
         "Sei un assistente esperto. Rispondi in italiano. "
@@ -279,15 +296,20 @@ def build_rag_chain(llm, retriever):
          "3) La risposta è sempre presente nel contesto.")
     ])
 
+    return prompt | llm | StrOutputParser()
+
+
+def build_rag_chain(llm, retriever):
+    """
+    Costruisce la catena RAG (retrieval -> prompt -> LLM) con citazioni e regole anti-hallucination.
+    """
     # LCEL: dict -> prompt -> llm -> parser
     chain = (
         {
             "context": retriever | format_docs_for_prompt,
             "question": RunnablePassthrough(),
         }
-        | prompt
-        | llm
-        | StrOutputParser()
+        | build_answer_chain(llm)
     )
     return chain
 
@@ -298,26 +320,80 @@ def rag_answer(question: str, chain) -> str:
     """
     return chain.invoke(question)
 
+def rag_answer_batch(
+    questions: List[str],
+    retriever,
+    llm,
+    max_concurrency: int = 8,
+) -> Tuple[List[str], List[List[Document]]]:
+    """
+    Esegue la pipeline RAG per molte domande: retrieval in batch (un'unica richiesta di
+    embedding e un'unica ricerca FAISS), poi generazione in parallelo con al massimo
+    max_concurrency chiamate all'LLM. Ritorna risposte e documenti nell'ordine delle domande.
+    """
+    docs_per_question = retrieve_batch(retriever, questions)
+    inputs = [
+        {"question": q, "context": format_docs_for_prompt(docs)}
+        for q, docs in zip(questions, docs_per_question)
+    ]
+    answers = build_answer_chain(llm).batch(inputs, config={"max_concurrency": max_concurrency})
+    return answers, docs_per_question
+
 def get_contexts_for_question(retriever, question: str, k: int) -> List[str]:
     """Ritorna i testi dei top-k documenti (chunk) usati come contesto."""
     docs = docs = retriever.invoke(question)[:k]
     return [d.page_content for d in docs]
 
+def retrieve_batch(retriever, questions: List[str]) -> List[List[Document]]:
+    """
+    Retrieval di molte domande in un colpo solo, con gli stessi risultati di retriever.invoke:
+    tutte le domande vengono embeddate con una sola richiesta e FAISS viene interrogato
+    con un'unica matrice di query (per MMR si cercano fetch_k candidati e si riordinano).
+    """
+    if not questions:
+        return []
+    vs = retriever.vectorstore
+    search_kwargs = retriever.search_kwargs
+    k = search_kwargs.get("k", 4)
+    mmr = retriever.search_type == "mmr"
+    fetch_k = search_kwargs.get("fetch_k", 20) if mmr else k
+
+    vectors = np.asarray(vs.embedding_function.embed_documents(list(questions)), dtype=np.float32)
+    _, indices = vs.index.search(vectors, fetch_k)
+
+    results = []
+    for vector, row in zip(vectors, indices):
+        positions = [int(i) for i in row if i != -1]
+        if mmr and positions:
+            candidates = [vs.index.reconstruct(i) for i in positions]
+            picked = maximal_marginal_relevance(
+                vector, candidates, k=k, lambda_mult=search_kwargs.get("lambda_mult", 0.5)
+            )
+            positions = [positions[i] for i in picked]
+        results.append([vs.docstore.search(vs.index_to_docstore_id[i]) for i in positions])
+    return results
+
+def get_contexts_for_questions(retriever, questions: List[str], k: int) -> List[List[str]]:
+    """Versione batch di get_contexts_for_question: una lista di contesti per domanda."""
+    return [[d.page_content for d in docs[:k]] for docs in retrieve_batch(retriever, questions)]
+
 def build_ragas_dataset(
     questions: List[str],
     retriever,
-    chain,
+    llm,
     k: int,
     ground_truth: dict[str, str] | None = None,
+    max_concurrency: int = 8,
 ):
     """
-    Esegue la pipeline RAG per ogni domanda e costruisce il dataset per Ragas.
+    Esegue la pipeline RAG per tutte le domande in batch e costruisce il dataset per Ragas.
     Ogni riga contiene: question, contexts, answer, (opzionale) ground_truth.
+    I contesti sono gli stessi documenti passati all'LLM, quindi il retrieval avviene una volta sola.
     """
+    answers, docs_per_question = rag_answer_batch(questions, retriever, llm, max_concurrency)
     dataset = []
-    for q in questions:
-        contexts = get_contexts_for_question(retriever, q, k)
-        answer = chain.invoke(q)
+    for q, answer, docs in zip(questions, answers, docs_per_question):
+        contexts = [d.page_content for d in docs[:k]]
 
         row = {
             # chiavi richieste da molte metriche Ragas
@@ -336,24 +412,23 @@ def build_ragas_dataset(
 # Esecuzione dimostrativa
 # =========================
 
-def main():
+def main(paths: List[str] | None = None):
     settings = SETTINGS
+    # File markdown da indicizzare: argomenti da riga di comando, altrimenti l'esempio accanto allo script
+    paths = paths or sys.argv[1:] or [str(Path(__file__).with_name("rispostesbagliate.md"))]
 
     # 1) Componenti
-    embeddings = get_embeddings()
+    embeddings = get_embeddings(settings)
     llm = get_llm_from_lmstudio(settings)
 
     # 2) Dati simulati e indicizzazione (load or build)
     # docs = simulate_corpus()
-    docs = load_documents("md", "C:\\Users\\XZ374JM\\OneDrive - EY\\Desktop\\AI Academy\\Deposito-Buda-AI-Academy\\2025-08-25\\rispostesbagliate.md")
+    docs = [doc for path in paths for doc in load_documents("md", path)]
     vector_store = load_or_build_vectorstore(settings, embeddings, docs)
 
     # 3) Retriever ottimizzato
     retriever = make_retriever(vector_store, settings)
 
-    # 4) Catena RAG
-    chain = build_rag_chain(llm, retriever)
-
     questions = [
         "Dimmi qual è la capitale d'Italia", 
         "Quanti minuti ci sono in un'ora?",
@@ -376,7 +451,7 @@ def main():
     #     print("Retrieved documents:")
     #     print(retrieved_docs)
     #     print("-" * 80)
-    #     ans = rag_answer(q, chain)
+    #     ans = rag_answer(q, build_rag_chain(llm, retriever))
     #     print(ans)
     #     print()
     
@@ -396,40 +471,40 @@ def main():
         questions[3]: "Il presidente degli USA è Paperino",
     }
 
-    # 6) Costruisci dataset per Ragas (stessi top-k del tuo retriever)
+    # 6) Costruisci dataset per Ragas (stessi top-k del tuo retriever, domande in batch)
     dataset = build_ragas_dataset(
         questions=questions,
         retriever=retriever,
-        chain=chain,
+        llm=llm,
         k=settings.k,
         ground_truth=ground_truth,  # rimuovi se non vuoi correctness
     )
 
-    evaluation_dataset = EvaluationDataset.from_list(dataset)
-
     # 7) Scegli le metriche
     metrics = [context_precision, context_recall, faithfulness, answer_relevancy]
     # Aggiungi correctness solo se tutte le righe hanno ground_truth
     if all("ground_truth" in row for row in dataset):
         metrics.append(answer_correctness)
 
-    # 8) Esegui la valutazione con il TUO LLM e le TUE embeddings
-    ragas_result = evaluate(
-        dataset=evaluation_dataset,
+    # 8) Esegui la valutazione con il TUO LLM e le TUE embeddings: righe in parallelo,
+    #    score già calcolati letti dalla cache, risultati scritti man mano su ragas_results.csv
+    records = evaluate_dataset(
+        dataset,
         metrics=metrics,
         llm=llm,                 # passa l'istanza LangChain del tuo LLM (LM Studio)
-        embeddings=get_embeddings(),  # o riusa 'embeddings' creato sopra
+        embeddings=embeddings,   # riusa gli embedding (e la cache) creati sopra
+        cache_path="ragas_cache.jsonl",
+        output_path="ragas_results.csv",
     )
 
-    df = ragas_result.to_pandas()
+    df = pd.DataFrame(records)
     cols = ["user_input", "response", "context_precision", "context_recall", "faithfulness", "answer_relevancy"]
     print("\n=== DETTAGLIO PER ESEMPIO ===\n")
     print(df[cols].round(4).to_string(index=False))
     
     df.head()
 
-    # (facoltativo) salva per revisione umana
-    df.to_csv("ragas_results.csv", index=False)
+    # ragas_results.csv viene scritto in streaming da evaluate_dataset
     print("Salvato: ragas_results.csv")
 
 if __name__ == "__main__":
@@ -0,0 +1,273 @@
+"""Parallel, resumable Ragas evaluation with a persistent score cache.
+
+``ragas.evaluate`` scores the whole dataset in one call: a failure halfway
+loses every score, and a re-run scores unchanged rows again. This runner
+scores rows independently in a thread pool and stores each score in an
+append-only JSON Lines cache keyed by metric, question, contexts, answer and
+reference. On the next run cached scores are reused, so an interrupted run
+resumes where it stopped and, after a prompt change, only rows whose answer
+changed are sent to the judge LLM again.
+
+Finished rows are streamed to a CSV or Parquet file as soon as they are
+scored.
+"""
+
+from __future__ import annotations
+
+import csv
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from ragas import EvaluationDataset, evaluate
+
+# Colonne non numeriche dell'output, prima degli score
+_TEXT_COLUMNS = ("row", "user_input", "response", "reference")
+
+
+def _digest(*parts: str) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def row_key(row: dict) -> str:
+    """Return the cache key of a dataset row (without the metric).
+
+    The key covers ``user_input``, the hash of ``retrieved_contexts``, the
+    hash of ``response`` and the optional ``reference``, which metrics such as
+    ``context_recall`` depend on.
+    """
+    contexts = _digest(*row.get("retrieved_contexts", []))
+    answer = _digest(row.get("response", ""))
+    return _digest(row["user_input"], contexts, answer, row.get("reference") or "")
+
+
+class ScoreCache:
+    """Append-only on-disk cache of ``(row key, metric) -> score``.
+
+    Parameters
+    ----------
+    path : str
+        JSON Lines file; created on first write. Truncated trailing lines
+        (e.g. from a killed run) are ignored.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.hits = 0
+        self.misses = 0
+        self._scores: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        if self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._scores[(entry["key"], entry["metric"])] = entry["score"]
+
+    def get(self, key: str, metric: str) -> Optional[float]:
+        """Return the cached score, or ``None`` on a miss."""
+        with self._lock:
+            score = self._scores.get((key, metric))
+            if score is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return score
+
+    def put(self, key: str, scores: Dict[str, float]) -> None:
+        """Persist the scores of one row, one line per metric."""
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                for metric, score in scores.items():
+                    self._scores[(key, metric)] = score
+                    f.write(json.dumps({"key": key, "metric": metric, "score": score}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def _arrow_type(pa, column: str):
+    if column == "row":
+        return pa.int64()
+    return pa.string() if column in _TEXT_COLUMNS else pa.float64()
+
+
+class ResultWriter:
+    """Stream scored rows to a ``.csv`` or ``.parquet`` file.
+
+    Parquet output requires ``pyarrow``; every row is written as its own
+    row group, so the file is readable up to the last finished row.
+
+    Parameters
+    ----------
+    path : str
+        Output file; the format is chosen by its suffix.
+    columns : sequence of str
+        Column order of the output.
+    """
+
+    def __init__(self, path: str, columns: Sequence[str]):
+        self.path = Path(path)
+        self.columns = list(columns)
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.path.suffix == ".parquet":
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError as exc:
+                raise ImportError("Parquet output requires pyarrow: pip install pyarrow") from exc
+            self._pa = pa
+            self._schema = pa.schema([(c, _arrow_type(pa, c)) for c in self.columns])
+            self._writer = pq.ParquetWriter(str(self.path), self._schema)
+            self._file = None
+        elif self.path.suffix == ".csv":
+            self._file = open(self.path, "w", encoding="utf-8", newline="")
+            self._writer = csv.DictWriter(self._file, fieldnames=self.columns)
+            self._writer.writeheader()
+        else:
+            raise ValueError(f"Unsupported output format: {self.path.suffix}. Use .csv or .parquet.")
+
+    def write(self, record: dict) -> None:
+        """Append one scored row and flush it to disk."""
+        record = {c: record.get(c) for c in self.columns}
+        with self._lock:
+            if self._file is None:
+                table = self._pa.Table.from_pylist([record], schema=self._schema)
+                self._writer.write_table(table)
+            else:
+                self._writer.writerow(record)
+                self._file.flush()
+
+    def close(self) -> None:
+        """Close the output file."""
+        with self._lock:
+            if self._file is None:
+                self._writer.close()
+            else:
+                self._file.close()
+
+
+def _score_row(row: dict, metrics: list, llm, embeddings) -> Dict[str, float]:
+    # Una valutazione Ragas per riga: un errore fa fallire solo questa riga
+    result = evaluate(
+        dataset=EvaluationDataset.from_list([row]),
+        metrics=metrics,
+        llm=llm,
+        embeddings=embeddings,
+        raise_exceptions=True,
+        show_progress=False,
+    )
+    record = result.to_pandas().iloc[0]
+    return {m.name: float(record[m.name]) for m in metrics}
+
+
+def evaluate_dataset(
+    dataset: List[dict],
+    metrics: list,
+    llm,
+    embeddings,
+    cache_path: str = "ragas_cache.jsonl",
+    output_path: Optional[str] = "ragas_results.csv",
+    max_workers: int = 4,
+) -> List[dict]:
+    """Score ``dataset`` row by row in parallel, reusing cached scores.
+
+    Parameters
+    ----------
+    dataset : list of dict
+        Rows as built by ``build_ragas_dataset`` (``user_input``,
+        ``retrieved_contexts``, ``response`` and optional ``reference``).
+    metrics : list
+        Ragas metric objects.
+    llm : Any
+        Judge LLM passed to ``ragas.evaluate``.
+    embeddings : Any
+        Embeddings passed to ``ragas.evaluate``.
+    cache_path : str, optional
+        JSON Lines score cache, shared across runs.
+    output_path : str, optional
+        ``.csv`` or ``.parquet`` file receiving rows as they finish;
+        ``None`` disables streaming output.
+    max_workers : int, optional
+        Rows scored concurrently.
+
+    Returns
+    -------
+    list of dict
+        One record per row, in dataset order, with ``row``, ``user_input``,
+        ``response``, ``reference`` and one score per metric. Scores of rows
+        that failed are ``nan`` and are retried on the next run.
+    """
+    start = time.perf_counter()
+    cache = ScoreCache(cache_path)
+    names = [m.name for m in metrics]
+    writer = ResultWriter(output_path, list(_TEXT_COLUMNS) + names) if output_path else None
+    records: List[Optional[dict]] = [None] * len(dataset)
+    failed = 0
+
+    def finish(i: int, scores: Dict[str, float]) -> None:
+        row = dataset[i]
+        record = {
+            "row": i,
+            "user_input": row["user_input"],
+            "response": row.get("response"),
+            "reference": row.get("reference"),
+            **{name: scores.get(name, math.nan) for name in names},
+        }
+        records[i] = record
+        if writer is not None:
+            writer.write(record)
+
+    def run(i: int, key: str, pending: list, cached: Dict[str, float]) -> Dict[str, float]:
+        scores = _score_row(dataset[i], pending, llm, embeddings)
+        cache.put(key, scores)
+        return {**cached, **scores}
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            futures = {}
+            for i, row in enumerate(dataset):
+                key = row_key(row)
+                cached = {}
+                pending = []
+                for metric in metrics:
+                    score = cache.get(key, metric.name)
+                    if score is None:
+                        pending.append(metric)
+                    else:
+                        cached[metric.name] = score
+                if pending:
+                    futures[pool.submit(run, i, key, pending, cached)] = (i, cached)
+                else:
+                    finish(i, cached)
+
+            for future in as_completed(futures):
+                i, cached = futures[future]
+                try:
+                    finish(i, future.result())
+                except Exception as exc:
+                    failed += 1
+                    print(f"Riga {i} non valutata: {exc!r}")
+                    finish(i, cached)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    print(
+        f"Valutate {len(dataset)} righe in {time.perf_counter() - start:.2f}s "
+        f"(score in cache: {cache.hits}, da calcolare: {cache.misses}, righe fallite: {failed})"
+    )
+    return records
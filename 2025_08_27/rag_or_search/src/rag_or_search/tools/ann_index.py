@@ -0,0 +1,254 @@
+"""Approximate-nearest-neighbour FAISS indexes selectable from ``Settings``.
+
+Supported index families (``Settings.index_type``):
+
+- ``"flat"``: exact ``IndexFlatL2`` (the LangChain default)
+- ``"ivf"``: ``IndexIVFFlat`` with k-means centroids trained on a sample
+- ``"hnsw"``: ``IndexHNSWFlat`` graph index, no training required
+- ``"ivfpq"``: ``IndexIVFPQ`` with product quantization for memory compression
+
+``Settings.vector_storage`` stores the vectors of flat, IVF and HNSW indexes
+as ``"float16"`` or ``"int8"`` scalar-quantized codes instead of ``"float32"``
+(``IndexScalarQuantizer``, ``IndexIVFScalarQuantizer``, ``IndexHNSWSQ``); see
+``quantization`` for full-precision re-ranking.
+
+Query-time knobs (``nprobe`` for IVF, ``efSearch`` for HNSW) are applied by
+``configure_search`` and can be tuned without rebuilding. ``recall_report``
+measures recall@k and latency of a configuration against exact search.
+"""
+
+from __future__ import annotations
+
+import time
+from typing import Dict, List, Optional, Sequence
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf", "hnsw", "ivfpq")
+VECTOR_STORAGES = ("float32", "float16", "int8")
+_SQ_TYPES = {"float16": faiss.ScalarQuantizer.QT_fp16, "int8": faiss.ScalarQuantizer.QT_8bit}
+
+
+def _effective_nlist(settings, n: int) -> int:
+    # FAISS raccomanda almeno ~39 punti di training per centroide
+    return max(1, min(settings.ivf_nlist, n // 39))
+
+
+def create_index(vectors: np.ndarray, settings) -> faiss.Index:
+    """Create, train and fill a FAISS index of type ``settings.index_type``.
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        Matrix of shape ``(n, d)`` with the vectors to index, in the order of
+        their docstore positions.
+    settings : Settings
+        Index configuration (``index_type``, ``vector_storage``,
+        ``ivf_nlist``, ``hnsw_m``, ``pq_m``, ``pq_nbits``, ``train_sample``).
+
+    Returns
+    -------
+    faiss.Index
+        The populated index, with search parameters already applied.
+
+    Raises
+    ------
+    ValueError
+        If the index type or storage is unknown or incompatible with the
+        dimension (``ivfpq`` is already compressed and takes only
+        ``"float32"``).
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, d = vectors.shape
+    index_type = settings.index_type
+    storage = getattr(settings, "vector_storage", "float32")
+    if storage not in VECTOR_STORAGES:
+        raise ValueError(f"Unsupported vector storage: {storage}. Choose one of {VECTOR_STORAGES}.")
+    if storage != "float32" and index_type == "ivfpq":
+        raise ValueError("ivfpq already compresses vectors; use vector_storage='float32'.")
+    qtype = _SQ_TYPES.get(storage)
+
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(d) if qtype is None else faiss.IndexScalarQuantizer(d, qtype, faiss.METRIC_L2)
+    elif index_type == "hnsw":
+        if qtype is None:
+            index = faiss.IndexHNSWFlat(d, settings.hnsw_m)
+        else:
+            index = faiss.IndexHNSWSQ(d, qtype, settings.hnsw_m)
+        index.hnsw.efConstruction = settings.ef_construction
+    elif index_type in ("ivf", "ivfpq"):
+        nlist = _effective_nlist(settings, n)
+        quantizer = faiss.IndexFlatL2(d)
+        if index_type == "ivf" and qtype is not None:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, d, nlist, qtype, faiss.METRIC_L2)
+        elif index_type == "ivf":
+            index = faiss.IndexIVFFlat(quantizer, d, nlist)
+        else:
+            if d % settings.pq_m:
+                raise ValueError(f"pq_m={settings.pq_m} must divide the embedding dimension {d}.")
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, settings.pq_m, settings.pq_nbits)
+        # Direct map: necessaria per reconstruct (MMR, cancellazioni incrementali)
+        index.make_direct_map()
+    else:
+        raise ValueError(f"Unsupported index type: {index_type}. Choose one of {INDEX_TYPES}.")
+
+    if not index.is_trained:
+        train_on_sample(index, vectors, settings.train_sample)
+    index.add(vectors)
+    configure_search(index, settings)
+    return index
+
+
+def train_on_sample(index: faiss.Index, vectors: np.ndarray, sample_size: int, seed: int = 0) -> None:
+    """Train ``index`` on a random sample of at most ``sample_size`` vectors."""
+    if len(vectors) > sample_size:
+        rows = np.random.default_rng(seed).choice(len(vectors), size=sample_size, replace=False)
+        vectors = vectors[np.sort(rows)]
+    index.train(vectors)
+
+
+def configure_search(index: faiss.Index, settings, nprobe: Optional[int] = None, ef_search: Optional[int] = None) -> None:
+    """Apply query-time parameters to ``index`` in place.
+
+    Parameters
+    ----------
+    index : faiss.Index
+        Any FAISS index; parameters that do not apply are ignored.
+    settings : Settings
+        Default ``nprobe`` and ``ef_search`` values.
+    nprobe : int, optional
+        Override for the number of IVF lists visited per query.
+    ef_search : int, optional
+        Override for the HNSW search beam width.
+    """
+    nprobe = settings.nprobe if nprobe is None else nprobe
+    ef_search = settings.ef_search if ef_search is None else ef_search
+    shards = getattr(index, "shards", None)
+    if shards is not None:
+        # sharding.ShardedIndex: parametri applicati a ogni shard
+        for shard in shards:
+            configure_search(shard, settings, nprobe, ef_search)
+        return
+    base_index = getattr(index, "base_index", None)
+    if base_index is not None:
+        # quantization.RerankedIndex: parametri dell'indice quantizzato
+        configure_search(base_index, settings, nprobe, ef_search)
+        return
+    try:
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    except RuntimeError:
+        pass
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        hnsw.efSearch = ef_search
+
+
+def delete_documents(vector_store, ids: Sequence[str]) -> None:
+    """Delete docstore ``ids`` from a LangChain ``FAISS`` store of any index type.
+
+    Flat indexes compact positions on ``remove_ids``, which is what
+    ``FAISS.delete`` expects. IVF indexes do not renumber positions and HNSW
+    cannot remove at all, so for them the remaining vectors are re-added to
+    the reset index: trained centroids are kept and nothing is re-embedded.
+
+    Parameters
+    ----------
+    vector_store : FAISS
+        The store to update in place.
+    ids : sequence of str
+        Docstore ids to delete.
+    """
+    index = faiss.downcast_index(vector_store.index)
+    if isinstance(index, faiss.IndexFlat):
+        vector_store.delete(list(ids))
+        return
+
+    doomed = set(ids)
+    keep = [
+        (pos, doc_id)
+        for pos, doc_id in sorted(vector_store.index_to_docstore_id.items())
+        if doc_id not in doomed
+    ]
+    positions = np.array([pos for pos, _ in keep], dtype=np.int64)
+    vectors = index.reconstruct_batch(positions) if len(positions) else None
+    index.reset()
+    if vectors is not None:
+        index.add(vectors)
+    vector_store.index_to_docstore_id = {i: doc_id for i, (_, doc_id) in enumerate(keep)}
+    vector_store.docstore.delete([doc_id for doc_id in ids])
+
+
+def rebuild_index(vector_store, settings) -> None:
+    """Replace the index of a LangChain ``FAISS`` store with ``settings.index_type``.
+
+    The vectors are read back from the current (exact) index, so docstore
+    positions are preserved.
+    """
+    flat = vector_store.index
+    vectors = flat.reconstruct_n(0, flat.ntotal)
+    vector_store.index = create_index(vectors, settings)
+
+
+def recall_report(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    settings,
+    k: int = 10,
+    sweep: Sequence[int] = (1, 2, 4, 8, 16, 32, 64, 128),
+) -> List[Dict[str, float]]:
+    """Measure recall@k and latency of ``settings.index_type`` vs exact search.
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        Corpus vectors, shape ``(n, d)``.
+    queries : numpy.ndarray
+        Query vectors, shape ``(q, d)``.
+    settings : Settings
+        Index configuration to evaluate.
+    k : int, optional
+        Number of neighbours compared against the exact result.
+    sweep : sequence of int, optional
+        Values of ``nprobe`` (IVF) or ``efSearch`` (HNSW) to try.
+
+    Returns
+    -------
+    list of dict
+        One row per setting with ``index_type``, ``param``, ``value``,
+        ``recall_at_k`` and ``latency_ms`` (mean per query). The first row is
+        the exact baseline.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    start = time.perf_counter()
+    _, truth = exact.search(queries, k)
+    baseline_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    rows = [{"index_type": "flat", "param": "", "value": 0, "recall_at_k": 1.0, "latency_ms": baseline_ms}]
+
+    index = create_index(vectors, settings)
+    if settings.index_type in ("ivf", "ivfpq"):
+        param = "nprobe"
+    elif settings.index_type == "hnsw":
+        param = "ef_search"
+    else:
+        param, sweep = "", (0,)
+
+    for value in sweep:
+        if param:
+            configure_search(index, settings, **{param: value})
+        start = time.perf_counter()
+        _, found = index.search(queries, k)
+        latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+        rows.append({
+            "index_type": settings.index_type,
+            "param": param,
+            "value": value,
+            "recall_at_k": hits / (k * len(queries)),
+            "latency_ms": latency_ms,
+        })
+    return rows
@@ -0,0 +1,307 @@
+"""Retrieval benchmark for ``rag_utils`` on synthetic corpora.
+
+Generates corpora of increasing size, embeds them with a deterministic
+offline embedder (no API calls) and measures, for each size:
+
+- build time of ``load_or_build_vectorstore`` on an empty directory
+- size of the persisted index on disk
+- load time of ``load_or_build_vectorstore`` on the persisted index (page
+  cache not dropped)
+- p50/p95/p99 latency of ``get_contexts_for_question`` in similarity, MMR
+  and hybrid (vector + BM25) mode
+- recall@k of each mode against exact vector search over the same vectors
+
+Results are written as JSON so runs can be compared across commits::
+
+    python -m rag_or_search.tools.benchmark --sizes 1000 10000 100000 --out bench.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, replace
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import faiss
+import numpy as np
+from langchain.schema import Document
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+
+from .rag_utils import Settings, get_contexts_for_question, load_or_build_vectorstore, make_retriever
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000, 1_000_000)
+
+
+class HashingEmbeddings(Embeddings):
+    """Deterministic bag-of-words embedder for offline benchmarks.
+
+    Each token maps to a fixed pseudo-random unit vector seeded by its hash;
+    a text is the normalized sum of its token vectors. Texts sharing words
+    are therefore close, which gives the corpus a realistic neighbour
+    structure without calling an embedding API.
+
+    Parameters
+    ----------
+    size : int, optional
+        Embedding dimension.
+    """
+
+    def __init__(self, size: int = 128):
+        self.size = size
+        self._tokens: Dict[str, np.ndarray] = {}
+
+    def _token(self, token: str) -> np.ndarray:
+        vector = self._tokens.get(token)
+        if vector is None:
+            seed = int.from_bytes(hashlib.sha256(token.encode("utf-8")).digest()[:8], "little")
+            vector = np.random.default_rng(seed).standard_normal(self.size).astype(np.float32)
+            self._tokens[token] = vector
+        return vector
+
+    def _embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.size, dtype=np.float32)
+        for token in text.lower().split():
+            vector += self._token(token)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed a list of texts."""
+        return [self._embed(t).tolist() for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a single query."""
+        return self._embed(text).tolist()
+
+
+def synthetic_corpus(
+    n_chunks: int,
+    words_per_chunk: int = 40,
+    vocabulary: int = 20_000,
+    topics: int = 200,
+    seed: int = 0,
+) -> List[Document]:
+    """Generate ``n_chunks`` topical pseudo-text chunks.
+
+    Every chunk draws most of its words from the vocabulary slice of one
+    topic and the rest from the whole vocabulary (Zipf-like), so chunks of
+    the same topic are semantically close.
+
+    Parameters
+    ----------
+    n_chunks : int
+        Number of chunks.
+    words_per_chunk : int, optional
+        Words per chunk.
+    vocabulary : int, optional
+        Vocabulary size.
+    topics : int, optional
+        Number of topics; also the number of ``source`` files.
+    seed : int, optional
+        Random seed; the same arguments always give the same corpus.
+
+    Returns
+    -------
+    list of Document
+        Chunks with ``source`` and ``section`` metadata, like
+        ``load_md_documents``.
+    """
+    rng = np.random.default_rng(seed)
+    words = np.array([f"w{i}" for i in range(vocabulary)])
+    topic_width = max(1, vocabulary // topics)
+    topic_of = rng.integers(0, topics, size=n_chunks)
+    n_topical = words_per_chunk * 3 // 4
+    docs = []
+    for i, topic in enumerate(topic_of):
+        topical = topic * topic_width + rng.integers(0, topic_width, size=n_topical)
+        common = np.minimum(rng.zipf(1.3, size=words_per_chunk - n_topical) - 1, vocabulary - 1)
+        tokens = words[np.concatenate([topical, common])]
+        docs.append(Document(
+            page_content=" ".join(tokens),
+            metadata={"source": f"topic-{topic}.md", "section": i + 1},
+        ))
+    return docs
+
+
+def make_queries(docs: List[Document], n_queries: int, words: int = 8, seed: int = 1) -> List[str]:
+    """Build queries from random word subsets of random chunks."""
+    rng = np.random.default_rng(seed)
+    queries = []
+    for i in rng.integers(0, len(docs), size=n_queries):
+        tokens = docs[i].page_content.split()
+        picked = rng.choice(len(tokens), size=min(words, len(tokens)), replace=False)
+        queries.append(" ".join(tokens[j] for j in sorted(picked)))
+    return queries
+
+
+def _percentiles(samples: Sequence[float]) -> Dict[str, float]:
+    p50, p95, p99 = np.percentile(np.asarray(samples) * 1000, [50, 95, 99])
+    return {"p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)}
+
+
+def _dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def _exact_store(vector_store: FAISS, vectors: np.ndarray) -> FAISS:
+    # Stesso docstore e stesse posizioni, ma ricerca esatta sui vettori originali
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+    mapping = {i: vector_store.index_to_docstore_id[i] for i in range(len(vectors))}
+    return FAISS(
+        embedding_function=vector_store.embedding_function,
+        index=index,
+        docstore=vector_store.docstore,
+        index_to_docstore_id=mapping,
+    )
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_size(n_chunks: int, settings: Settings, embeddings, n_queries: int = 200) -> dict:
+    """Benchmark build, load and queries for one corpus size.
+
+    Parameters
+    ----------
+    n_chunks : int
+        Corpus size in chunks.
+    settings : Settings
+        Index and retrieval configuration; ``persist_dir`` is replaced by a
+        temporary directory.
+    embeddings : Any
+        Offline embeddings model.
+    n_queries : int, optional
+        Number of timed queries per mode.
+
+    Returns
+    -------
+    dict
+        Measurements for this size.
+    """
+    docs = synthetic_corpus(n_chunks)
+    queries = make_queries(docs, n_queries)
+    result: dict = {"chunks": n_chunks, "queries": n_queries}
+
+    with tempfile.TemporaryDirectory(prefix="rag-bench-") as tmp:
+        run_settings = replace(settings, persist_dir=str(Path(tmp) / "index"), incremental=False)
+
+        start = time.perf_counter()
+        load_or_build_vectorstore(run_settings, embeddings, docs)
+        result["build_s"] = time.perf_counter() - start
+        result["index_bytes"] = _dir_size(Path(run_settings.persist_dir))
+
+        start = time.perf_counter()
+        vector_store = load_or_build_vectorstore(run_settings, embeddings, docs)
+        result["load_s"] = time.perf_counter() - start
+
+        # Vettori originali (l'indice ANN può restituirne solo un'approssimazione)
+        texts = [
+            vector_store.docstore.search(vector_store.index_to_docstore_id[i]).page_content
+            for i in range(vector_store.index.ntotal)
+        ]
+        vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+        exact = _exact_store(vector_store, vectors)
+
+        for mode in ("similarity", "mmr", "hybrid"):
+            mode_settings = replace(run_settings, search_type=mode)
+            retriever = make_retriever(vector_store, mode_settings)
+            reference = make_retriever(exact, replace(mode_settings, index_type="flat"))
+
+            latencies = []
+            for q in queries:
+                start = time.perf_counter()
+                get_contexts_for_question(retriever, q, mode_settings.k)
+                latencies.append(time.perf_counter() - start)
+
+            hits = 0
+            for q in queries:
+                found = {d.id for d in retriever.invoke(q)}
+                truth = {d.id for d in reference.invoke(q)}
+                hits += len(found & truth)
+            result[mode] = {
+                **_percentiles(latencies),
+                "recall_at_k": hits / (mode_settings.k * len(queries)),
+            }
+    return result
+
+
+def run_benchmark(
+    sizes: Sequence[int] = DEFAULT_SIZES,
+    settings: Optional[Settings] = None,
+    dim: int = 128,
+    n_queries: int = 200,
+) -> dict:
+    """Run ``bench_size`` for every corpus size.
+
+    Returns
+    -------
+    dict
+        ``{"meta": {...}, "results": [...]}`` with the commit, platform and
+        settings used, and one result per size.
+    """
+    settings = settings or Settings(k=10, embedding_cache_dir=None)
+    embeddings = HashingEmbeddings(dim)
+    results = []
+    for n in sizes:
+        print(f"Benchmark su {n} chunk...")
+        results.append(bench_size(n, settings, embeddings, n_queries))
+        print(json.dumps(results[-1]))
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "faiss": getattr(faiss, "__version__", None),
+            "dim": dim,
+            "settings": asdict(settings),
+        },
+        "results": results,
+    }
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """Command-line entry point."""
+    parser = argparse.ArgumentParser(description="Retrieval benchmark for rag_utils on synthetic corpora.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="Corpus sizes in chunks.")
+    parser.add_argument("--dim", type=int, default=128, help="Embedding dimension.")
+    parser.add_argument("--queries", type=int, default=200, help="Timed queries per mode.")
+    parser.add_argument("--k", type=int, default=10, help="Results per query (recall@k).")
+    parser.add_argument("--fetch-k", type=int, default=20, help="MMR candidate pool.")
+    parser.add_argument("--index-type", default="flat", help="flat, ivf, hnsw or ivfpq.")
+    parser.add_argument("--shards", type=int, default=1, help="On-disk shards searched in parallel.")
+    parser.add_argument("--out", default="bench_retrieval.json", help="Output JSON file.")
+    args = parser.parse_args(argv)
+
+    settings = Settings(
+        k=args.k,
+        fetch_k=args.fetch_k,
+        mmr_lambda=0.5,
+        index_type=args.index_type,
+        shards=args.shards,
+        embedding_cache_dir=None,
+    )
+    report = run_benchmark(args.sizes, settings, dim=args.dim, n_queries=args.queries)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Salvato: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
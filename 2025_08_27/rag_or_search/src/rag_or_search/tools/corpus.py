@@ -0,0 +1,307 @@
+"""Parallel ingestion of many Markdown/text files into one FAISS index.
+
+Files are given as paths, directories (searched recursively) or glob
+patterns. Each file is read and split in a process pool with the same
+"---" section semantics as ``load_md_documents`` and the same splitter as
+``split_documents``; identical chunks are kept once, and the chunks are
+streamed into ``build_faiss_vectorstore``, which embeds and persists the
+consolidated corpus under ``Settings.persist_dir`` while later files are
+still being parsed::
+
+    python -m rag_or_search.tools.corpus docs/ "notes/**/*.md" --workers 8
+"""
+
+from __future__ import annotations
+
+import argparse
+import glob
+import hashlib
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from itertools import islice
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from langchain.schema import Document
+from langchain_community.vectorstores import FAISS
+
+from .rag_utils import Settings, build_faiss_vectorstore, get_embeddings, iter_md_documents, iter_split_documents
+
+EXTENSIONS = (".md", ".txt")
+# Oltre questa dimensione un file non passa dai worker ma viene letto in streaming
+LARGE_FILE_BYTES = 64 << 20
+
+
+@dataclass
+class IngestReport:
+    """Throughput statistics of an ``ingest_paths`` run.
+
+    Attributes
+    ----------
+    files : int
+        Number of files read.
+    chunks : int
+        Number of unique chunks indexed.
+    duplicates : int
+        Chunks dropped because an identical one was already indexed.
+    parse_seconds : float
+        Time spent reading and splitting files (waiting on the worker
+        processes included), excluding the time the consumer holds each
+        chunk.
+    seconds : float
+        Total wall-clock time, embedding and persistence included.
+    """
+
+    files: int = 0
+    chunks: int = 0
+    duplicates: int = 0
+    parse_seconds: float = 0.0
+    seconds: float = 0.0
+
+    @property
+    def files_per_sec(self) -> float:
+        """Files ingested per second (end to end)."""
+        return self.files / self.seconds if self.seconds else 0.0
+
+    @property
+    def chunks_per_sec(self) -> float:
+        """Chunks ingested per second (end to end)."""
+        return self.chunks / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"Ingested {self.files} files and {self.chunks} chunks "
+            f"({self.duplicates} duplicates skipped) in {self.seconds:.2f}s "
+            f"(parsing {self.parse_seconds:.2f}s): "
+            f"{self.files_per_sec:.1f} files/sec, {self.chunks_per_sec:.1f} chunks/sec"
+        )
+
+
+def expand_paths(patterns: Sequence[str], extensions: Sequence[str] = EXTENSIONS) -> List[Path]:
+    """Resolve files, directories and glob patterns into a sorted file list.
+
+    Parameters
+    ----------
+    patterns : sequence of str
+        File paths, directories (searched recursively) or glob patterns
+        (``**`` is supported).
+    extensions : sequence of str, optional
+        File suffixes kept when scanning directories and globs.
+
+    Returns
+    -------
+    list of Path
+        Unique matching files, sorted.
+    """
+    files = set()
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_file():
+            files.add(path)
+            continue
+        if path.is_dir():
+            candidates = path.rglob("*")
+        else:
+            candidates = (Path(p) for p in glob.glob(pattern, recursive=True))
+        files.update(p for p in candidates if p.is_file() and p.suffix.lower() in extensions)
+    return sorted(files)
+
+
+def _load_and_split(paths: Sequence[Path], settings: Settings) -> List[Optional[List[Tuple[str, dict]]]]:
+    # Eseguita nei processi worker: restituisce tuple leggere invece di Document.
+    # I file grandi (None) restano al processo principale, che li legge in streaming
+    out = []
+    for path in paths:
+        if path.stat().st_size > LARGE_FILE_BYTES:
+            out.append(None)
+            continue
+        chunks = iter_split_documents(iter_md_documents(str(path)), settings)
+        out.append([(d.page_content, d.metadata) for d in chunks])
+    return out
+
+
+def _iter_chunks(
+    files: List[Path], settings: Settings, workers: int, report: IngestReport
+) -> Iterator[Document]:
+    seen = set()
+    # Blocchi di file per worker: meno overhead di IPC con molti file piccoli
+    size = max(1, min(64, len(files) // (workers * 4)))
+    groups = iter([files[i:i + size] for i in range(0, len(files), size)])
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Finestra di blocchi in volo: se l'embedding è più lento del parsing
+        # i chunk non si accumulano in memoria
+        pending = deque(pool.submit(_load_and_split, group, settings) for group in islice(groups, 2 * workers))
+        done = 0
+        while pending:
+            results = pending.popleft().result()
+            group = next(groups, None)
+            if group is not None:
+                pending.append(pool.submit(_load_and_split, group, settings))
+            group_paths = files[done:done + len(results)]
+            done += len(results)
+            report.files += len(results)
+            for path, file_chunks in zip(group_paths, results):
+                if file_chunks is None:
+                    docs = iter_split_documents(iter_md_documents(str(path)), settings)
+                    file_chunks = ((d.page_content, d.metadata) for d in docs)
+                for text, metadata in file_chunks:
+                    key = hashlib.sha256(text.encode("utf-8")).digest()
+                    if key in seen:
+                        report.duplicates += 1
+                        continue
+                    seen.add(key)
+                    report.chunks += 1
+                    report.parse_seconds += time.perf_counter() - start
+                    yield Document(page_content=text, metadata=metadata)
+                    # Il tempo del consumatore (embedding) non conta come parsing
+                    start = time.perf_counter()
+    report.parse_seconds += time.perf_counter() - start
+
+
+def iter_corpus(
+    patterns: Sequence[str],
+    settings: Settings,
+    max_workers: Optional[int] = None,
+    report: Optional[IngestReport] = None,
+) -> Iterator[Document]:
+    """Stream the unique chunks of every matching file, read and split in parallel.
+
+    Files are parsed by a process pool a few blocks ahead of the consumer;
+    files over ``LARGE_FILE_BYTES`` are streamed section by section in the
+    calling process instead, so memory stays bounded by the blocks in flight
+    and not by the corpus.
+
+    Parameters
+    ----------
+    patterns : sequence of str
+        Files, directories or glob patterns (see ``expand_paths``).
+    settings : Settings
+        Chunking configuration.
+    max_workers : int, optional
+        Worker processes; defaults to the number of CPUs.
+    report : IngestReport, optional
+        Updated with files, chunks, duplicates and parsing time as the
+        chunks are consumed.
+
+    Returns
+    -------
+    iterator of Document
+        Unique chunks in file order.
+
+    Raises
+    ------
+    FileNotFoundError
+        If no file matches ``patterns`` (raised before iterating).
+    """
+    files = expand_paths(patterns)
+    if not files:
+        raise FileNotFoundError(f"No {'/'.join(EXTENSIONS)} files match: {', '.join(patterns)}")
+    workers = max_workers or os.cpu_count() or 1
+    return _iter_chunks(files, settings, workers, report if report is not None else IngestReport())
+
+
+def load_corpus(
+    patterns: Sequence[str],
+    settings: Settings,
+    max_workers: Optional[int] = None,
+) -> Tuple[List[Document], IngestReport]:
+    """Read and split every matching file in parallel, dropping duplicate chunks.
+
+    Parameters
+    ----------
+    patterns : sequence of str
+        Files, directories or glob patterns (see ``expand_paths``).
+    settings : Settings
+        Chunking configuration.
+    max_workers : int, optional
+        Worker processes; defaults to the number of CPUs.
+
+    Returns
+    -------
+    list of Document
+        Unique chunks in file order.
+    IngestReport
+        Parsing statistics (``seconds`` covers parsing only).
+
+    Raises
+    ------
+    FileNotFoundError
+        If no file matches ``patterns``.
+    """
+    report = IngestReport()
+    chunks = list(iter_corpus(patterns, settings, max_workers, report))
+    report.seconds = report.parse_seconds
+    return chunks, report
+
+
+def ingest_paths(
+    patterns: Sequence[str],
+    settings: Settings,
+    embeddings=None,
+    max_workers: Optional[int] = None,
+) -> Tuple[FAISS, IngestReport]:
+    """Build one consolidated index under ``settings.persist_dir`` from many files.
+
+    Parameters
+    ----------
+    patterns : sequence of str
+        Files, directories or glob patterns (see ``expand_paths``).
+    settings : Settings
+        Chunking, index and embedding batch configuration.
+    embeddings : Any, optional
+        Embeddings model. Defaults to ``get_embeddings(settings)``.
+    max_workers : int, optional
+        Worker processes for parsing; defaults to the number of CPUs.
+
+    Returns
+    -------
+    FAISS
+        The persisted vector store.
+    IngestReport
+        End-to-end throughput statistics.
+
+    Notes
+    -----
+    Chunks are streamed from ``iter_corpus`` into ``build_faiss_vectorstore``,
+    which embeds and indexes them in fixed-size steps while the next files
+    are being parsed.
+    """
+    start = time.perf_counter()
+    report = IngestReport()
+    chunks = iter_corpus(patterns, settings, max_workers, report)
+    embeddings = embeddings if embeddings is not None else get_embeddings(settings)
+    vector_store = build_faiss_vectorstore(chunks, embeddings, settings.persist_dir, settings)
+    report.seconds = time.perf_counter() - start
+    return vector_store, report
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """Command-line entry point."""
+    defaults = Settings()
+    parser = argparse.ArgumentParser(description="Index many Markdown/text files into one FAISS store.")
+    parser.add_argument("paths", nargs="+", help="Files, directories or glob patterns.")
+    parser.add_argument("--persist-dir", default=defaults.persist_dir, help="Output index directory.")
+    parser.add_argument("--chunk-size", type=int, default=defaults.chunk_size)
+    parser.add_argument("--chunk-overlap", type=int, default=defaults.chunk_overlap)
+    parser.add_argument("--index-type", default=defaults.index_type, help="flat, ivf, hnsw or ivfpq.")
+    parser.add_argument("--workers", type=int, default=None, help="Parsing processes (default: CPU count).")
+    args = parser.parse_args(argv)
+
+    settings = replace(
+        defaults,
+        persist_dir=args.persist_dir,
+        chunk_size=args.chunk_size,
+        chunk_overlap=args.chunk_overlap,
+        index_type=args.index_type,
+    )
+    _, report = ingest_paths(args.paths, settings, max_workers=args.workers)
+    print(report)
+    print(f"Indice salvato in: {settings.persist_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""Persistent, content-addressed cache for text embeddings.
+
+Embeddings are stored as ``float32`` blobs in a SQLite database, one row
+per cached text, safe to share between processes. Keys are derived from the model
+deployment name and a hash of the normalized text, so the same chunk or query
+is embedded at most once per model, across index rebuilds and processes.
+
+The module provides:
+
+- ``EmbeddingCache``: the on-disk store with LRU eviction bounded by size
+- ``CachedEmbeddings``: a LangChain ``Embeddings`` wrapper that looks up the
+  cache before calling the wrapped model
+- ``FakeEmbeddings``: a deterministic offline embedder for tests and benchmarks
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+_WHITESPACE = re.compile(r"\s+")
+# Variabili per query SQLite (limite di default 999 nelle build più vecchie)
+_SQL_BATCH = 900
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text before hashing (NFC, collapsed whitespace, stripped)."""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+def embedding_key(model: str, text: str) -> str:
+    """Return the cache key for ``text`` embedded with ``model``.
+
+    Parameters
+    ----------
+    model : str
+        Embedding model or deployment name.
+    text : str
+        Raw text; it is normalized before hashing.
+
+    Returns
+    -------
+    str
+        Hex digest identifying the ``(model, text)`` pair.
+    """
+    payload = f"{model}\x00{normalize_text(text)}".encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()
+
+
+class EmbeddingCache:
+    """On-disk embedding store with LRU eviction by size.
+
+    Vectors live in a SQLite database, one row per key: a miss writes only
+    its own rows, and several processes can share the same directory
+    (SQLite serializes the writers, WAL mode lets readers proceed).
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding ``embeddings.sqlite``.
+    max_bytes : int, optional
+        Upper bound for the database pages in use (vectors, keys and
+        index). When exceeded, the least recently used rows are deleted.
+
+    Notes
+    -----
+    The embedding dimension is fixed by the first stored vector. All methods
+    are thread-safe; ``hits`` and ``misses`` count this process only.
+    """
+
+    DB_FILE = "embeddings.sqlite"
+    # Frazione di righe eliminate quando si supera max_bytes, per non farlo a ogni put
+    EVICT_FRACTION = 0.1
+
+    def __init__(self, cache_dir: str, max_bytes: int = 512 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(self.cache_dir / self.DB_FILE, timeout=60, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used INTEGER NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.dim: Optional[int] = self._stored_dim()
+
+    def _stored_dim(self) -> Optional[int]:
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        return int(row[0]) if row else None
+
+    def flush(self) -> None:
+        """No-op, kept for compatibility: every ``put_many`` is committed."""
+
+    def close(self) -> None:
+        """Close the database connection."""
+        with self._lock:
+            self._db.close()
+
+    # ---------- gestione spazio ----------
+
+    @property
+    def max_rows(self) -> int:
+        """Maximum number of vectors allowed by ``max_bytes``."""
+        return max(1, self.max_bytes // (4 * (self.dim or 1)))
+
+    def _used_bytes(self) -> int:
+        # Pagine occupate del database: costo costante, senza contare le righe
+        page_size = self._db.execute("PRAGMA page_size").fetchone()[0]
+        pages = self._db.execute("PRAGMA page_count").fetchone()[0]
+        free = self._db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free) * page_size
+
+    def _evict(self) -> None:
+        if self._used_bytes() <= self.max_bytes:
+            return
+        self._db.execute(
+            "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_used LIMIT ?)",
+            (max(1, int(self.max_rows * self.EVICT_FRACTION)),),
+        )
+
+    # ---------- API ----------
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Return cached vectors for ``keys`` (``None`` for misses).
+
+        Parameters
+        ----------
+        keys : sequence of str
+            Keys produced by ``embedding_key``.
+
+        Returns
+        -------
+        list of numpy.ndarray or None
+            Copies of the cached vectors, aligned with ``keys``.
+        """
+        found: Dict[str, np.ndarray] = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            for start in range(0, len(unique), _SQL_BATCH):
+                batch = unique[start:start + _SQL_BATCH]
+                marks = ",".join("?" * len(batch))
+                rows = self._db.execute(f"SELECT key, vector FROM entries WHERE key IN ({marks})", batch)
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).copy()
+            if found:
+                with self._db:
+                    self._db.executemany(
+                        "UPDATE entries SET last_used = ? WHERE key = ?",
+                        [(time.time_ns(), key) for key in found],
+                    )
+            out = [found.get(key) for key in keys]
+            hits = sum(vector is not None for vector in out)
+            self.hits += hits
+            self.misses += len(out) - hits
+        return out
+
+    def put_many(self, keys: Sequence[str], vectors: Sequence[Sequence[float]]) -> None:
+        """Store vectors under ``keys``, evicting LRU rows when full.
+
+        Parameters
+        ----------
+        keys : sequence of str
+            Keys produced by ``embedding_key``.
+        vectors : sequence of array-like
+            Embeddings aligned with ``keys``.
+
+        Raises
+        ------
+        ValueError
+            If a vector dimension differs from the cached dimension.
+        """
+        if not keys:
+            return
+        matrix = np.asarray(vectors, dtype=np.float32)
+        with self._lock, self._db:
+            # La dimensione può essere stata fissata da un altro processo
+            self._db.execute("INSERT OR IGNORE INTO meta VALUES ('dim', ?)", (str(matrix.shape[1]),))
+            self.dim = self._stored_dim()
+            if matrix.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {matrix.shape[1]} does not match cache dimension {self.dim}.")
+            now = time.time_ns()
+            self._db.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                [(key, vector.tobytes(), now) for key, vector in zip(keys, matrix)],
+            )
+            self._evict()
+
+
+class CachedEmbeddings(Embeddings):
+    """LangChain embeddings wrapper that consults an ``EmbeddingCache`` first.
+
+    Only the texts missing from the cache are sent to the wrapped model, in a
+    single ``embed_documents`` call. The async methods use the wrapped
+    model's async client and write the cache off the event loop.
+
+    Parameters
+    ----------
+    embeddings : Embeddings
+        The underlying embeddings model.
+    cache : EmbeddingCache
+        Cache shared by document and query embeddings.
+    model : str
+        Deployment or model name; part of every cache key.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model
+
+    def _lookup(self, texts: List[str]):
+        keys = [embedding_key(self.model, t) for t in texts]
+        cached = self.cache.get_many(keys)
+        missing: Dict[str, int] = {}
+        for i, (key, vector) in enumerate(zip(keys, cached)):
+            if vector is None and key not in missing:
+                missing[key] = i
+        return keys, cached, missing
+
+    def _store(self, keys: List[str], vectors: Sequence[Sequence[float]]) -> None:
+        self.cache.put_many(keys, vectors)
+
+    @staticmethod
+    def _combine(keys, cached, missing, fresh) -> List[List[float]]:
+        if missing:
+            by_key = dict(zip(missing, fresh))
+            cached = [v if v is not None else by_key[key] for key, v in zip(keys, cached)]
+        return [list(map(float, v)) for v in cached]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed documents, calling the model only for cache misses."""
+        keys, cached, missing = self._lookup(texts)
+        fresh = []
+        if missing:
+            fresh = self.embeddings.embed_documents([texts[i] for i in missing.values()])
+            self._store(list(missing), fresh)
+        return self._combine(keys, cached, missing, fresh)
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query, reusing a cached vector when available."""
+        key = embedding_key(self.model, text)
+        vector = self.cache.get_many([key])[0]
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self._store([key], [vector])
+        return list(map(float, vector))
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Async ``embed_documents``: misses are awaited on the model's async client."""
+        keys, cached, missing = self._lookup(texts)
+        fresh = []
+        if missing:
+            fresh = await self.embeddings.aembed_documents([texts[i] for i in missing.values()])
+            # Scrittura su disco fuori dall'event loop
+            await asyncio.to_thread(self._store, list(missing), fresh)
+        return self._combine(keys, cached, missing, fresh)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """Async ``embed_query``, reusing a cached vector when available."""
+        key = embedding_key(self.model, text)
+        vector = self.cache.get_many([key])[0]
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            await asyncio.to_thread(self._store, [key], [vector])
+        return list(map(float, vector))
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic offline embedder for tests and benchmarks.
+
+    Each text is mapped to a unit vector seeded by the hash of its normalized
+    form, so equal texts always produce equal vectors. Calls are counted to
+    check how many round-trips a real model would have received.
+
+    Parameters
+    ----------
+    size : int, optional
+        Embedding dimension.
+    """
+
+    def __init__(self, size: int = 64):
+        self.size = size
+        self.calls = 0
+        self.texts_embedded = 0
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(normalize_text(text).encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.size).astype(np.float32)
+        vector /= np.linalg.norm(vector)
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed a list of texts deterministically."""
+        self.calls += 1
+        self.texts_embedded += len(texts)
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a single query deterministically."""
+        self.calls += 1
+        self.texts_embedded += 1
+        return self._vector(text)
@@ -0,0 +1,231 @@
+"""Metadata pre-filtering for FAISS searches.
+
+A filter is a dict like LangChain's FAISS ``filter``: ``{"source": "a.md"}``
+matches one value, ``{"source": ["a.md", "b.md"]}`` any of several; keys are
+combined with AND. Candidates are restricted before scoring:
+
+- the positions of every metadata value (e.g. each ``source`` file) are
+  computed once from the store's metadata columns and cached as a sorted
+  array; a filter is the union/intersection of those arrays
+- small subsets (up to ``exact_max`` vectors) are searched exactly over just
+  their reconstructed vectors, so a query scoped to one document costs
+  proportional to that document's size
+- larger subsets are searched with the ANN index restricted by a packed
+  bitmap (``faiss.IDSelectorBitmap``); rows that come back with fewer than
+  ``k`` results are redone exactly, so a filter never truncates ``k``
+"""
+
+from __future__ import annotations
+
+import json
+import threading
+import weakref
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain.schema import Document
+
+_BITMAPS: "weakref.WeakKeyDictionary[Any, Tuple[Any, int, MetadataBitmaps]]" = weakref.WeakKeyDictionary()
+_BITMAPS_LOCK = threading.Lock()
+_EXACT_BLOCK = 16_384
+
+
+def _value_key(value: Any) -> str:
+    # Stessa codifica dei dizionari delle colonne in save_store
+    return json.dumps(value, sort_keys=True)
+
+
+class MetadataBitmaps:
+    """Positions of each metadata value of a store.
+
+    Parameters
+    ----------
+    count : int
+        Number of indexed vectors.
+    columns : mapping
+        ``{name: (codes, values)}``: per-position dictionary codes (``-1``
+        when missing) and the value of each code, as in
+        ``MmapDocstore.metadata_columns``.
+    """
+
+    def __init__(self, count: int, columns: Mapping[str, tuple]):
+        self.count = count
+        self._columns = {
+            name: (codes, {_value_key(value): code for code, value in enumerate(values)})
+            for name, (codes, values) in columns.items()
+        }
+        self._positions: Dict[Tuple[str, int], np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_store(cls, vector_store) -> "MetadataBitmaps":
+        """Index the metadata of a LangChain FAISS store."""
+        docstore = vector_store.docstore
+        count = vector_store.index.ntotal
+        # MmapDocstore o ShardedDocstore: colonne già codificate su disco
+        if hasattr(docstore, "metadata_columns") and getattr(docstore, "count", None) == count:
+            return cls(count, docstore.metadata_columns())
+
+        codes: Dict[str, np.ndarray] = {}
+        lookups: Dict[str, Dict[str, int]] = {}
+        values: Dict[str, list] = {}
+        for position in range(count):
+            doc_id = vector_store.index_to_docstore_id[position]
+            doc = vector_store.docstore.search(doc_id)
+            if not isinstance(doc, Document):
+                raise ValueError(f"Could not find document for id {doc_id}, got {doc}")
+            for name, value in doc.metadata.items():
+                if name not in codes:
+                    codes[name] = np.full(count, -1, dtype=np.int32)
+                    lookups[name], values[name] = {}, []
+                code = lookups[name].setdefault(_value_key(value), len(values[name]))
+                if code == len(values[name]):
+                    values[name].append(value)
+                codes[name][position] = code
+        return cls(count, {name: (codes[name], values[name]) for name in codes})
+
+    def value_positions(self, name: str, value: Any) -> np.ndarray:
+        """Return the sorted positions whose metadata ``name`` equals ``value``."""
+        column = self._columns.get(name)
+        code = column[1].get(_value_key(value)) if column is not None else None
+        if code is None:
+            return np.zeros(0, dtype=np.int64)
+        positions = self._positions.get((name, code))
+        if positions is None:
+            with self._lock:
+                positions = self._positions.get((name, code))
+                if positions is None:
+                    positions = np.flatnonzero(np.asarray(column[0]) == code).astype(np.int64)
+                    self._positions[(name, code)] = positions
+        return positions
+
+    def positions(self, filter: Mapping[str, Any]) -> np.ndarray:
+        """Return the sorted positions matching ``filter``.
+
+        A list, tuple or set value matches any of its elements; keys are
+        combined with AND. An empty filter matches every position.
+        """
+        result: Optional[np.ndarray] = None
+        for name, wanted in filter.items():
+            options = wanted if isinstance(wanted, (list, tuple, set, frozenset)) else [wanted]
+            parts = [self.value_positions(name, value) for value in options]
+            matched = parts[0] if len(parts) == 1 else np.unique(np.concatenate(parts or [np.zeros(0, np.int64)]))
+            result = matched if result is None else np.intersect1d(result, matched, assume_unique=True)
+            if not len(result):
+                break
+        return np.arange(self.count, dtype=np.int64) if result is None else result
+
+
+def metadata_bitmaps_for(vector_store) -> MetadataBitmaps:
+    """Return the cached ``MetadataBitmaps`` of ``vector_store``.
+
+    Rebuilt only when the index object or its size changes.
+    """
+    index = vector_store.index
+    entry = _BITMAPS.get(vector_store)
+    if entry is None or entry[0] is not index or entry[1] != index.ntotal:
+        with _BITMAPS_LOCK:
+            entry = _BITMAPS.get(vector_store)
+            if entry is None or entry[0] is not index or entry[1] != index.ntotal:
+                entry = (index, index.ntotal, MetadataBitmaps.from_store(vector_store))
+                _BITMAPS[vector_store] = entry
+    return entry[2]
+
+
+def packed_bitmap(positions: np.ndarray, count: int) -> np.ndarray:
+    """Pack ``positions`` into the little-endian bitmap read by ``faiss.IDSelectorBitmap``."""
+    mask = np.zeros(count, dtype=bool)
+    mask[positions] = True
+    return np.packbits(mask, bitorder="little")
+
+
+def _search_parameters(index: faiss.Index, selector) -> faiss.SearchParameters:
+    # Parametri di ricerca del tipo di indice, con i valori configurati da configure_search
+    if hasattr(index, "hnsw"):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return faiss.SearchParameters(sel=selector)
+    return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+
+
+def exact_search(index: faiss.Index, queries: np.ndarray, positions: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact k-NN restricted to ``positions``, reading only their vectors.
+
+    Returns ``(distances, positions)`` like ``index.search``, padded with
+    ``-1`` when fewer than ``k`` positions are given.
+    """
+    inner_product = index.metric_type == faiss.METRIC_INNER_PRODUCT
+    distances = np.full((len(queries), k), -np.inf if inner_product else np.inf, dtype=np.float32)
+    labels = np.full((len(queries), k), -1, dtype=np.int64)
+    for start in range(0, len(positions), _EXACT_BLOCK):
+        block = positions[start:start + _EXACT_BLOCK]
+        vectors = index.reconstruct_batch(block)
+        d, i = faiss.knn(queries, vectors, min(k, len(block)), metric=index.metric_type)
+        # Fusione con i migliori dei blocchi precedenti
+        distances = np.concatenate([distances, d], axis=1)
+        labels = np.concatenate([labels, np.where(i >= 0, block[np.maximum(i, 0)], -1)], axis=1)
+        order = np.argsort(-distances if inner_product else distances, axis=1, kind="stable")[:, :k]
+        distances = np.take_along_axis(distances, order, axis=1)
+        labels = np.take_along_axis(labels, order, axis=1)
+    return distances, labels
+
+
+def filtered_search(
+    vector_store,
+    query_vectors: np.ndarray,
+    k: int,
+    positions: np.ndarray,
+    exact_max: int = 20_000,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Search ``vector_store`` among ``positions`` only.
+
+    Parameters
+    ----------
+    vector_store : FAISS
+        LangChain FAISS store.
+    query_vectors : numpy.ndarray
+        Query embeddings, shape ``(q, d)``.
+    k : int
+        Number of results per query.
+    positions : numpy.ndarray
+        Sorted allowed positions (see ``MetadataBitmaps.positions``).
+    exact_max : int, optional
+        Subsets up to this size are searched exactly; larger ones use the ANN
+        index with a bitmap selector.
+
+    Returns
+    -------
+    numpy.ndarray
+        Distances, shape ``(q, k)``.
+    numpy.ndarray
+        Positions, shape ``(q, k)``, ``-1`` where fewer than ``k`` match.
+    """
+    queries = np.ascontiguousarray(np.atleast_2d(query_vectors), dtype=np.float32)
+    return filtered_index_search(vector_store.index, queries, k, positions, exact_max)
+
+
+def filtered_index_search(
+    index, queries: np.ndarray, k: int, positions: np.ndarray, exact_max: int = 20_000
+) -> Tuple[np.ndarray, np.ndarray]:
+    """``filtered_search`` on a bare index; ``queries`` must be ``float32``, ``(q, d)``.
+
+    Indexes that define ``search_positions`` (e.g. ``sharding.ShardedIndex``)
+    restrict the search themselves.
+    """
+    search_positions = getattr(index, "search_positions", None)
+    if search_positions is not None:
+        return search_positions(queries, k, positions, exact_max)
+    if len(positions) <= exact_max:
+        return exact_search(index, queries, positions, k)
+
+    bitmap = packed_bitmap(positions, index.ntotal)
+    selector = faiss.IDSelectorBitmap(index.ntotal, faiss.swig_ptr(bitmap))
+    distances, labels = index.search(queries, k, params=_search_parameters(index, selector))
+    # L'ANN può perdere candidati del sottoinsieme: quelle righe si rifanno in modo esatto
+    short = (labels[:, :min(k, len(positions))] < 0).any(axis=1)
+    if short.any():
+        distances[short], labels[short] = exact_search(index, queries[short], positions, k)
+    return distances, labels
@@ -0,0 +1,550 @@
+"""Incremental updates of a persisted FAISS index.
+
+Every chunk gets a stable id derived from its ``source`` and content (its
+fingerprint), used both as FAISS docstore id and as manifest key. When the
+source documents change, only new chunks are embedded and only removed chunks
+are deleted from the index; unchanged chunks keep their vectors.
+
+The manifest (``manifest.json`` in the index directory) records the chunk
+fingerprints per source and section as produced by ``load_md_documents`` and
+``split_documents``.
+
+Updates are persisted as deltas, so their cost follows the change, not the
+corpus:
+
+- added chunks (and chunks whose metadata changed, with their vector read
+  back from the index) are written as a new small flat store,
+  ``delta-XXXX/``, next to the base store
+- removed and relabeled positions are recorded in ``tombstones-XXXX.npy``
+- the new manifest is written as ``manifest-XXXX.json``
+- ``store.json`` lists the live segments, tombstones and manifest; replacing
+  it commits the update, so an interrupted update leaves the previous store
+  and manifest in place
+
+``load_live_store`` opens the base store with its segments laid after it and
+the tombstoned positions hidden from every search. Once the segments and
+tombstones exceed ``compact_ratio`` of the base store they are folded back
+into it by ``compact_store``, the only step that rewrites the whole store.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import faiss
+import numpy as np
+from langchain.schema import Document
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+from .ann_index import delete_documents
+from .filters import filtered_index_search
+from .index_store import load_store, materialize_store, read_schema, save_store, update_schema
+from .ingest import embed_chunks
+from .quantization import FULL_VECTORS_FILE, realign_full_vectors
+from .sharding import ShardedDocstore, ShardedIdMap, ShardedIndex
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_PREFIX = "manifest-"
+DELTA_PREFIX = "delta-"
+TOMBSTONES_PREFIX = "tombstones-"
+COMPACT_RATIO = 0.2
+
+
+@dataclass
+class IndexUpdate:
+    """Summary of an incremental index update.
+
+    Attributes
+    ----------
+    added : list of str
+        Fingerprints of chunks embedded and added to the index.
+    removed : list of str
+        Fingerprints of chunks deleted from the index.
+    relabeled : list of str
+        Fingerprints whose metadata changed (e.g. section renumbering)
+        without re-embedding.
+    unchanged : int
+        Number of chunks left untouched.
+    """
+
+    added: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    relabeled: List[str] = field(default_factory=list)
+    unchanged: int = 0
+
+    @property
+    def changed(self) -> bool:
+        """Whether the index content differs from the persisted one."""
+        return bool(self.added or self.removed or self.relabeled)
+
+
+def chunk_fingerprint(doc: Document) -> str:
+    """Return the content fingerprint of a chunk (``source`` + text)."""
+    source = str(doc.metadata.get("source", ""))
+    payload = f"{source}\x00{doc.page_content}".encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()[:32]
+
+
+def assign_chunk_ids(chunks: List[Document]) -> Dict[str, Document]:
+    """Map each chunk to a unique fingerprint id.
+
+    Identical chunks within the same source get an ordinal suffix so that
+    every chunk keeps its own vector.
+
+    Parameters
+    ----------
+    chunks : list of Document
+        Chunks from ``split_documents``.
+
+    Returns
+    -------
+    dict
+        Ordered mapping ``fingerprint -> Document``.
+    """
+    return dict(iter_chunk_ids(chunks))
+
+
+def iter_chunk_ids(chunks: Iterable[Document]) -> Iterator[Tuple[str, Document]]:
+    """Streaming ``assign_chunk_ids``: yield ``(id, chunk)`` pairs as chunks arrive."""
+    seen: Dict[str, int] = defaultdict(int)
+    for doc in chunks:
+        fp = chunk_fingerprint(doc)
+        n = seen[fp]
+        seen[fp] += 1
+        yield (fp if n == 0 else f"{fp}-{n}"), doc
+
+
+def build_manifest(chunks_by_id: Dict[str, Document]) -> dict:
+    """Group chunk fingerprints by source and section."""
+    sources: Dict[str, Dict[str, List[str]]] = defaultdict(lambda: defaultdict(list))
+    for chunk_id, doc in chunks_by_id.items():
+        source = str(doc.metadata.get("source", ""))
+        section = str(doc.metadata.get("section", ""))
+        sources[source][section].append(chunk_id)
+    return {"version": 1, "sources": {s: dict(sections) for s, sections in sources.items()}}
+
+
+def manifest_ids(manifest: dict) -> List[str]:
+    """Return every chunk fingerprint listed in ``manifest``."""
+    return [
+        chunk_id
+        for sections in manifest.get("sources", {}).values()
+        for ids in sections.values()
+        for chunk_id in ids
+    ]
+
+
+def load_manifest(persist_dir: str) -> Optional[dict]:
+    """Read the manifest from ``persist_dir``, or ``None`` if missing.
+
+    After an incremental update the manifest is the one named in the
+    ``store.json`` delta, committed together with the segment it describes.
+    """
+    try:
+        name = (read_schema(persist_dir).get("delta") or {}).get("manifest") or MANIFEST_FILE
+    except FileNotFoundError:
+        name = MANIFEST_FILE
+    path = Path(persist_dir) / name
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict, persist_dir: str, name: str = MANIFEST_FILE) -> None:
+    """Atomically write the manifest into ``persist_dir`` as ``name``."""
+    Path(persist_dir).mkdir(parents=True, exist_ok=True)
+    path = Path(persist_dir) / name
+    tmp_path = path.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+class TombstonedIndex:
+    """Index view that hides deleted positions.
+
+    Implements the part of the ``faiss.Index`` API used by the retrieval
+    code; positions are those of the wrapped index.
+
+    Parameters
+    ----------
+    base_index : faiss.Index
+        The base index, or a ``ShardedIndex`` of the base store followed by
+        its delta segments.
+    tombstones : numpy.ndarray
+        Sorted positions deleted since the last compaction.
+    """
+
+    def __init__(self, base_index, tombstones: np.ndarray):
+        self.base_index = base_index
+        self.tombstones = np.asarray(tombstones, dtype=np.int64)
+        self.d = base_index.d
+        self.metric_type = base_index.metric_type
+        self.is_trained = True
+
+    @property
+    def ntotal(self) -> int:
+        return self.base_index.ntotal
+
+    def search(self, x: np.ndarray, k: int, params=None) -> Tuple[np.ndarray, np.ndarray]:
+        """Search ``k`` live results, over-fetching one candidate per tombstone."""
+        queries = np.ascontiguousarray(np.atleast_2d(x), dtype=np.float32)
+        fetch = max(1, min(self.ntotal, k + len(self.tombstones)))
+        if params is None:
+            distances, labels = self.base_index.search(queries, fetch)
+        else:
+            distances, labels = self.base_index.search(queries, fetch, params=params)
+        dead = (labels < 0) | np.isin(labels, self.tombstones)
+        # I vivi prima, nell'ordine di distanza originale
+        order = np.argsort(dead, axis=1, kind="stable")[:, :k]
+        distances = np.take_along_axis(distances, order, axis=1)
+        labels = np.take_along_axis(labels, order, axis=1)
+        dead = np.take_along_axis(dead, order, axis=1)
+
+        inner_product = self.metric_type == faiss.METRIC_INNER_PRODUCT
+        out_distances = np.full((len(queries), k), -np.inf if inner_product else np.inf, dtype=np.float32)
+        out_labels = np.full((len(queries), k), -1, dtype=np.int64)
+        width = labels.shape[1]
+        out_distances[:, :width] = np.where(dead, out_distances[:, :width], distances)
+        out_labels[:, :width] = np.where(dead, -1, labels)
+        return out_distances, out_labels
+
+    def search_positions(
+        self, queries: np.ndarray, k: int, positions: np.ndarray, exact_max: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Filtered search (see ``filters``) among the live ``positions``."""
+        live = positions[~np.isin(positions, self.tombstones)]
+        return filtered_index_search(self.base_index, queries, k, live, exact_max)
+
+    def reconstruct(self, key: int) -> np.ndarray:
+        return self.base_index.reconstruct(key)
+
+    def reconstruct_batch(self, keys: np.ndarray) -> np.ndarray:
+        return self.base_index.reconstruct_batch(keys)
+
+    def reconstruct_n(self, i0: int, ni: int) -> np.ndarray:
+        return self.base_index.reconstruct_n(i0, ni)
+
+
+class LiveDocstore(ShardedDocstore):
+    """Docstore of a base store and its delta segments, skipping deleted entries.
+
+    A chunk relabeled by an update lives in a newer segment than its
+    tombstoned original, so lookups go from the newest segment back.
+    """
+
+    def __init__(self, docstores: Sequence[Docstore], counts: Sequence[int], tombstones: np.ndarray):
+        super().__init__(docstores, counts)
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        self.tombstones = np.asarray(tombstones, dtype=np.int64)
+
+    def _dead(self, position: int) -> bool:
+        i = int(np.searchsorted(self.tombstones, position))
+        return i < len(self.tombstones) and int(self.tombstones[i]) == position
+
+    def position(self, doc_id: str) -> Optional[int]:
+        """Return the live position of ``doc_id``, or ``None`` if unknown or deleted."""
+        for segment in range(len(self.docstores) - 1, -1, -1):
+            local = self.docstores[segment].position(doc_id)
+            if local is not None:
+                position = int(self.offsets[segment] + local)
+                return None if self._dead(position) else position
+        return None
+
+    def deleted_positions(self) -> np.ndarray:
+        """Sorted tombstoned positions."""
+        return self.tombstones
+
+    def search(self, search: str) -> Union[str, Document]:
+        """Return the live document with id ``search`` (LangChain ``Docstore`` API)."""
+        position = self.position(search)
+        if position is None:
+            return f"ID {search} not found."
+        segment = int(np.searchsorted(self.offsets, position, side="right") - 1)
+        return self.docstores[segment].document_at(position - int(self.offsets[segment]))
+
+
+def _delta(persist_dir: str) -> dict:
+    return read_schema(persist_dir).get("delta") or {"seq": 0, "segments": [], "tombstones": None, "manifest": None}
+
+
+def _load_tombstones(persist_dir: str, delta: dict) -> np.ndarray:
+    if not delta.get("tombstones"):
+        return np.zeros(0, dtype=np.int64)
+    return np.load(Path(persist_dir) / delta["tombstones"])
+
+
+def load_live_store(persist_dir: str, embeddings, wrap_base: Optional[Callable[[FAISS], FAISS]] = None) -> FAISS:
+    """Open a persisted store with its delta segments and tombstones applied.
+
+    Parameters
+    ----------
+    persist_dir : str
+        Directory written by ``save_store`` and updated by
+        ``update_vectorstore``.
+    embeddings : Any
+        Embeddings model used for queries.
+    wrap_base : callable, optional
+        Applied to the base store before the segments are added (e.g. the
+        full-precision re-ranking of ``quantization.with_rerank``).
+
+    Returns
+    -------
+    FAISS
+        The base store itself when there are no deltas, otherwise a
+        read-only store whose index is a ``TombstonedIndex``.
+    """
+    base = load_store(persist_dir, embeddings)
+    if wrap_base is not None:
+        base = wrap_base(base)
+    delta = base.docstore.schema.get("delta")
+    if not delta:
+        return base
+
+    stores = [base] + [load_store(str(Path(persist_dir) / name), embeddings) for name in delta["segments"]]
+    counts = [s.index.ntotal for s in stores]
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    tombstones = _load_tombstones(persist_dir, delta)
+    # Segmenti piccoli: cercati in sequenza, senza un pool di thread per ogni caricamento
+    index = ShardedIndex([s.index for s in stores]) if len(stores) > 1 else base.index
+    return FAISS(
+        embedding_function=embeddings,
+        index=TombstonedIndex(index, tombstones),
+        docstore=LiveDocstore([s.docstore for s in stores], counts, tombstones),
+        index_to_docstore_id=ShardedIdMap([s.index_to_docstore_id for s in stores], offsets),
+    )
+
+
+def _save_segment(
+    path: Path, embeddings, metric: int, texts: List[str], vectors: Sequence, metadatas: List[dict], ids: List[str]
+) -> None:
+    # Segmento piatto e non quantizzato: pochi vettori, ricerca esatta
+    index = faiss.IndexFlat(len(vectors[0]), metric)
+    segment = FAISS(embedding_function=embeddings, index=index, docstore=InMemoryDocstore(), index_to_docstore_id={})
+    segment.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas, ids=ids)
+    save_store(segment, str(path))
+
+
+def drop_deltas(persist_dir: str, keep: Sequence[str] = ()) -> None:
+    """Delete delta segments, tombstone and delta manifest files of ``persist_dir`` not listed in ``keep``."""
+    for path in Path(persist_dir).iterdir():
+        if path.name in keep:
+            continue
+        if path.is_dir() and path.name.startswith(DELTA_PREFIX):
+            shutil.rmtree(path, ignore_errors=True)
+        elif path.name.startswith((TOMBSTONES_PREFIX, MANIFEST_PREFIX)):
+            path.unlink(missing_ok=True)
+
+
+def compact_store(persist_dir: str, embeddings) -> bool:
+    """Fold the delta segments and tombstones into the base store.
+
+    The base store is materialized, tombstoned entries are deleted (see
+    ``ann_index.delete_documents``) and the live segment entries appended with
+    their stored vectors; nothing is re-embedded. Costs time and memory
+    proportional to the corpus.
+
+    Returns
+    -------
+    bool
+        Whether there was anything to compact.
+    """
+    delta = _delta(persist_dir)
+    if not delta["segments"] and not delta.get("tombstones"):
+        return False
+
+    live = load_live_store(persist_dir, embeddings)
+    base = load_store(persist_dir, embeddings)
+    base_count = base.index.ntotal
+    tombstones = _load_tombstones(persist_dir, delta)
+    old_ids = [base.index_to_docstore_id[p] for p in range(base_count)]
+    dead_ids = [old_ids[p] for p in tombstones if p < base_count]
+
+    positions = np.setdiff1d(np.arange(base_count, live.index.ntotal, dtype=np.int64), tombstones)
+    ids = [live.index_to_docstore_id[int(p)] for p in positions]
+    docs = [live.docstore.search(doc_id) for doc_id in ids]
+    vectors = live.index.reconstruct_batch(positions) if len(positions) else np.zeros((0, base.index.d), np.float32)
+
+    materialize_store(base)
+    if dead_ids:
+        delete_documents(base, dead_ids)
+    if ids:
+        base.add_embeddings(
+            list(zip([d.page_content for d in docs], vectors)), metadatas=[d.metadata for d in docs], ids=ids
+        )
+    manifest = load_manifest(persist_dir)
+    if manifest is not None:
+        # Il manifest del delta torna in manifest.json prima che store.json smetta di indicarlo
+        save_manifest(manifest, persist_dir)
+    # save_store riscrive store.json senza la chiave "delta"
+    save_store(base, persist_dir)
+    if (Path(persist_dir) / FULL_VECTORS_FILE).exists():
+        new_ids = [base.index_to_docstore_id[p] for p in range(base.index.ntotal)]
+        realign_full_vectors(persist_dir, old_ids, new_ids, dict(zip(ids, vectors)))
+    drop_deltas(persist_dir)
+    return True
+
+
+def _metadata_changed(vector_store: FAISS, docs: List[Document], ids: List[str], position_of) -> List[bool]:
+    # Per ogni chunk già indicizzato: i metadati correnti differiscono da quelli salvati?
+    docstore = vector_store.docstore
+    if not hasattr(docstore, "metadata_columns"):
+        changed = []
+        for chunk_id, doc in zip(ids, docs):
+            stored = docstore.search(chunk_id)
+            changed.append(isinstance(stored, Document) and stored.metadata != doc.metadata)
+        return changed
+
+    # Store mappato: confronto sui codici delle colonne, senza ricostruire i documenti
+    found = [position_of(chunk_id) for chunk_id in ids]
+    positions = np.array([-1 if p is None else p for p in found], dtype=np.int64)
+    columns = docstore.metadata_columns()
+    changed = np.array([any(name not in columns for name in doc.metadata) for doc in docs], dtype=bool)
+    for name, (codes, values) in columns.items():
+        lookup = {json.dumps(value, sort_keys=True): code for code, value in enumerate(values)}
+        # -2: valore mai salvato in questa colonna, diverso da ogni codice
+        expected = np.array(
+            [lookup.get(json.dumps(doc.metadata[name], sort_keys=True), -2) if name in doc.metadata else -1 for doc in docs],
+            dtype=np.int32,
+        )
+        changed |= np.asarray(codes)[positions] != expected
+    changed &= positions >= 0
+    return changed.tolist()
+
+
+def update_vectorstore(
+    vector_store: FAISS,
+    chunks: List[Document],
+    persist_dir: str,
+    batch_size: int = 64,
+    max_workers: int = 4,
+    compact_ratio: float = COMPACT_RATIO,
+) -> IndexUpdate:
+    """Bring a persisted FAISS store in line with ``chunks``, persisting only the delta.
+
+    New chunks are embedded and written to a new delta segment; removed
+    chunks are tombstoned; chunks whose text is unchanged but whose metadata
+    moved are tombstoned and re-added to the segment with their stored
+    vector. Nothing is written when nothing changed. The store is compacted
+    (``compact_store``) once the deltas exceed ``compact_ratio`` of it.
+
+    Parameters
+    ----------
+    vector_store : FAISS
+        Store opened with ``load_live_store`` (or ``index_store.load_store``)
+        from ``persist_dir``, built with fingerprint ids. It is not modified:
+        reopen the store to see the update.
+    chunks : list of Document
+        Current chunks of the whole corpus.
+    persist_dir : str
+        Directory of the persisted index and manifest.
+    batch_size : int, optional
+        Chunks per embedding request for the added chunks.
+    max_workers : int, optional
+        Maximum concurrent embedding requests.
+    compact_ratio : float, optional
+        Segment entries plus tombstones, as a fraction of the base store,
+        above which the deltas are compacted.
+
+    Returns
+    -------
+    IndexUpdate
+        What was added, removed and relabeled.
+
+    Raises
+    ------
+    FileNotFoundError
+        If ``persist_dir`` has no manifest to diff against.
+    """
+    manifest = load_manifest(persist_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No {MANIFEST_FILE} in {persist_dir}: rebuild the index first.")
+
+    current = assign_chunk_ids(chunks)
+    previous = set(manifest_ids(manifest))
+
+    update = IndexUpdate()
+    update.added = [chunk_id for chunk_id in current if chunk_id not in previous]
+    update.removed = [chunk_id for chunk_id in previous if chunk_id not in current]
+
+    position_of = getattr(vector_store.docstore, "position", None)
+    if position_of is None:
+        # Store in memoria: mappa inversa costruita una volta
+        reverse = {doc_id: p for p, doc_id in vector_store.index_to_docstore_id.items()}
+        position_of = reverse.get
+
+    common = [chunk_id for chunk_id in current if chunk_id in previous]
+    changed = _metadata_changed(vector_store, [current[chunk_id] for chunk_id in common], common, position_of)
+    update.relabeled = [chunk_id for chunk_id, moved in zip(common, changed) if moved]
+    update.unchanged = len(common) - len(update.relabeled)
+
+    if not update.changed:
+        return update
+
+    removed = [position_of(chunk_id) for chunk_id in update.removed]
+    relabeled = np.array([position_of(chunk_id) for chunk_id in update.relabeled], dtype=np.int64)
+    doomed = np.concatenate((np.array([p for p in removed if p is not None], dtype=np.int64), relabeled))
+
+    texts: List[str] = []
+    vectors: List = []
+    metadatas: List[dict] = []
+    ids: List[str] = []
+    if update.relabeled:
+        # Metadati cambiati: stesso vettore, riletto dall'indice
+        texts += [current[chunk_id].page_content for chunk_id in update.relabeled]
+        vectors += list(vector_store.index.reconstruct_batch(relabeled))
+        metadatas += [current[chunk_id].metadata for chunk_id in update.relabeled]
+        ids += update.relabeled
+    if update.added:
+        added = [current[chunk_id] for chunk_id in update.added]
+        fresh, _ = embed_chunks(
+            [d.page_content for d in added],
+            vector_store.embedding_function,
+            batch_size=batch_size,
+            max_workers=max_workers,
+        )
+        texts += [d.page_content for d in added]
+        vectors += list(fresh)
+        metadatas += [d.metadata for d in added]
+        ids += update.added
+
+    delta = _delta(persist_dir)
+    seq = delta["seq"] + 1
+    segments = list(delta["segments"])
+    if ids:
+        name = f"{DELTA_PREFIX}{seq:04d}"
+        _save_segment(
+            Path(persist_dir) / name, vector_store.embedding_function, vector_store.index.metric_type,
+            texts, vectors, metadatas, ids,
+        )
+        segments.append(name)
+    tombstones = np.union1d(_load_tombstones(persist_dir, delta), doomed).astype(np.int64)
+    tombstones_file = None
+    if len(tombstones):
+        tombstones_file = f"{TOMBSTONES_PREFIX}{seq:04d}.npy"
+        np.save(Path(persist_dir) / tombstones_file, tombstones)
+
+    manifest_file = f"{MANIFEST_PREFIX}{seq:04d}.json"
+    save_manifest(build_manifest(current), persist_dir, name=manifest_file)
+
+    # store.json per ultimo: rende visibili segmento, tombstone e manifest in un colpo solo
+    update_schema(
+        persist_dir, delta={"seq": seq, "segments": segments, "tombstones": tombstones_file, "manifest": manifest_file}
+    )
+    drop_deltas(persist_dir, keep=segments + [tombstones_file, manifest_file])
+
+    base_count = read_schema(persist_dir)["count"]
+    delta_count = vector_store.index.ntotal - base_count + len(ids)
+    if delta_count + len(tombstones) > compact_ratio * max(base_count, 1):
+        compact_store(persist_dir, vector_store.embedding_function)
+    return update
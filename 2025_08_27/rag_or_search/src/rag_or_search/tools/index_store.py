@@ -0,0 +1,296 @@
+"""Memory-mapped persistence for FAISS vector stores, without pickle.
+
+A persisted store is a directory with:
+
+- ``index.faiss``: the raw FAISS index, opened with mmap on load
+- ``texts.bin``: every chunk text as one contiguous UTF-8 blob
+- ``offsets.npy``: ``int64`` byte offsets of each text in the blob (``n + 1``)
+- ``ids.npy``: docstore ids, one fixed-width bytes row per position
+- ``ids_sorted.npy`` / ``ids_order.npy``: ids in sorted order and their
+  positions, for binary search by id
+- ``meta/<column>.npy``: dictionary codes of each metadata column
+- ``store.json``: schema (row count, index family, column dictionaries);
+  replaced last, so a store is complete once it exists. Incremental updates
+  record their delta segments here too (see ``incremental``)
+
+Loading touches only the small schema; ``Document`` objects are built lazily
+for the ids a query returns, so cold-start time and resident memory do not
+grow with the corpus.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+import faiss
+import numpy as np
+from langchain.schema import Document
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+INDEX_FILE = "index.faiss"
+STORE_FILE = "store.json"
+TEXTS_FILE = "texts.bin"
+OFFSETS_FILE = "offsets.npy"
+IDS_FILE = "ids.npy"
+IDS_SORTED_FILE = "ids_sorted.npy"
+IDS_ORDER_FILE = "ids_order.npy"
+META_DIR = "meta"
+
+
+def store_exists(persist_dir: str) -> bool:
+    """Whether ``persist_dir`` holds a complete memory-mapped store."""
+    path = Path(persist_dir)
+    return (path / INDEX_FILE).exists() and (path / STORE_FILE).exists()
+
+
+def _index_family(index: faiss.Index) -> str:
+    try:
+        faiss.extract_index_ivf(index)
+        return "ivf"
+    except RuntimeError:
+        return "flat"
+
+
+def _mmap_flags(index_family: str) -> int:
+    # IVF: liste invertite mappate da disco; flat/HNSW: codici mappati (FAISS >= 1.8)
+    if index_family == "ivf":
+        return faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    return getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+
+class LazyIdMap(Mapping):
+    """Read-only ``position -> docstore id`` mapping backed by ``ids.npy``."""
+
+    def __init__(self, ids: np.ndarray):
+        self._ids = ids
+
+    def __getitem__(self, position: int) -> str:
+        if not 0 <= position < len(self._ids):
+            raise KeyError(position)
+        return self._ids[position].decode("utf-8")
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(len(self._ids)))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+
+class MmapDocstore(Docstore):
+    """Docstore that materializes ``Document`` objects on demand.
+
+    Parameters
+    ----------
+    persist_dir : str
+        Directory of a store written by ``save_store``.
+    """
+
+    def __init__(self, persist_dir: str):
+        self.persist_dir = str(persist_dir)
+        path = Path(persist_dir)
+        self.schema = read_schema(persist_dir)
+        self.count = int(self.schema["count"])
+        texts_path = path / TEXTS_FILE
+        if texts_path.stat().st_size:
+            self._texts = np.memmap(texts_path, dtype=np.uint8, mode="r")
+        else:
+            self._texts = np.zeros(0, dtype=np.uint8)
+        self._offsets = np.load(path / OFFSETS_FILE, mmap_mode="r")
+        self.ids = np.load(path / IDS_FILE, mmap_mode="r")
+        self._ids_sorted = np.load(path / IDS_SORTED_FILE, mmap_mode="r")
+        self._ids_order = np.load(path / IDS_ORDER_FILE, mmap_mode="r")
+        self._columns = {
+            name: (np.load(path / META_DIR / f"{i}.npy", mmap_mode="r"), spec["values"])
+            for i, (name, spec) in enumerate(self.schema["columns"].items())
+        }
+
+    def position(self, doc_id: str) -> Optional[int]:
+        """Return the index position of ``doc_id``, or ``None`` if unknown."""
+        key = doc_id.encode("utf-8")
+        # Ricerca binaria sul file mappato: tocca solo O(log n) pagine
+        i = int(np.searchsorted(self._ids_sorted, key))
+        if i < self.count and self._ids_sorted[i] == key:
+            return int(self._ids_order[i])
+        return None
+
+    def metadata_columns(self) -> Dict[str, tuple]:
+        """Return ``{name: (codes, values)}`` for every metadata column.
+
+        ``codes`` is the memory-mapped ``int32`` array of dictionary codes per
+        position (``-1`` when the document lacks the key) and ``values`` the
+        decoded value of each code.
+        """
+        return dict(self._columns)
+
+    def text_at(self, position: int) -> str:
+        """Return the text stored at ``position``, without its metadata."""
+        start, end = int(self._offsets[position]), int(self._offsets[position + 1])
+        return bytes(self._texts[start:end]).decode("utf-8")
+
+    def document_at(self, position: int) -> Document:
+        """Build the ``Document`` stored at ``position``."""
+        text = self.text_at(position)
+        metadata = {}
+        for name, (codes, values) in self._columns.items():
+            code = int(codes[position])
+            if code >= 0:
+                metadata[name] = values[code]
+        return Document(page_content=text, metadata=metadata, id=self.ids[position].decode("utf-8"))
+
+    def search(self, search: str) -> Union[str, Document]:
+        """Return the document with id ``search`` (LangChain ``Docstore`` API)."""
+        position = self.position(search)
+        if position is None:
+            return f"ID {search} not found."
+        return self.document_at(position)
+
+
+def read_schema(persist_dir: str) -> dict:
+    """Return the ``store.json`` schema of a persisted store."""
+    with open(Path(persist_dir) / STORE_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def update_schema(persist_dir: str, **fields) -> None:
+    """Atomically set (or, with ``None``, remove) top-level ``store.json`` fields.
+
+    Replacing ``store.json`` changes the store signature, so cached readers
+    (``RagEngine``, the lexical index) reload.
+    """
+    schema = read_schema(persist_dir)
+    for name, value in fields.items():
+        if value is None:
+            schema.pop(name, None)
+        else:
+            schema[name] = value
+    path = Path(persist_dir) / STORE_FILE
+    tmp_path = path.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(schema, f)
+    os.replace(tmp_path, path)
+
+
+def save_store(vector_store: FAISS, persist_dir: str) -> None:
+    """Write ``vector_store`` in the memory-mapped format.
+
+    Parameters
+    ----------
+    vector_store : FAISS
+        Store with any docstore (in-memory or ``MmapDocstore``).
+    persist_dir : str
+        Target directory; existing files are replaced.
+    """
+    path = Path(persist_dir)
+    path.mkdir(parents=True, exist_ok=True)
+    # Scrive in una cartella temporanea e sostituisce i file con os.replace:
+    # eventuali lettori con i vecchi file mappati continuano a vedere dati validi
+    tmp = path / f".tmp-{os.getpid()}"
+    (tmp / META_DIR).mkdir(parents=True, exist_ok=True)
+
+    faiss.write_index(vector_store.index, str(tmp / INDEX_FILE))
+
+    n = len(vector_store.index_to_docstore_id)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    ids: List[bytes] = []
+    column_values: Dict[str, Dict[str, int]] = {}
+    column_lists: Dict[str, list] = {}
+    column_codes: Dict[str, np.ndarray] = {}
+
+    with open(tmp / TEXTS_FILE, "wb") as blob:
+        for position in range(n):
+            doc_id = vector_store.index_to_docstore_id[position]
+            doc = vector_store.docstore.search(doc_id)
+            if not isinstance(doc, Document):
+                raise ValueError(f"Could not find document for id {doc_id}, got {doc}")
+            data = doc.page_content.encode("utf-8")
+            blob.write(data)
+            offsets[position + 1] = offsets[position] + len(data)
+            ids.append(doc_id.encode("utf-8"))
+            for name, value in doc.metadata.items():
+                if name not in column_codes:
+                    column_values[name] = {}
+                    column_lists[name] = []
+                    column_codes[name] = np.full(n, -1, dtype=np.int32)
+                key = json.dumps(value, sort_keys=True)
+                code = column_values[name].get(key)
+                if code is None:
+                    code = column_values[name][key] = len(column_lists[name])
+                    column_lists[name].append(value)
+                column_codes[name][position] = code
+
+    ids_array = np.array(ids, dtype=f"S{max((len(i) for i in ids), default=1)}")
+    order = np.argsort(ids_array, kind="stable")
+    np.save(tmp / OFFSETS_FILE, offsets)
+    np.save(tmp / IDS_FILE, ids_array)
+    np.save(tmp / IDS_SORTED_FILE, ids_array[order])
+    np.save(tmp / IDS_ORDER_FILE, order.astype(np.int64))
+    for i, codes in enumerate(column_codes.values()):
+        np.save(tmp / META_DIR / f"{i}.npy", codes)
+
+    schema = {
+        "version": 1,
+        "count": n,
+        "index_family": _index_family(vector_store.index),
+        "columns": {name: {"values": column_lists[name]} for name in column_codes},
+    }
+    with open(tmp / STORE_FILE, "w", encoding="utf-8") as f:
+        json.dump(schema, f)
+
+    (path / META_DIR).mkdir(exist_ok=True)
+    for old in (path / META_DIR).glob("*.npy"):
+        old.unlink()
+    for name in (INDEX_FILE, TEXTS_FILE, OFFSETS_FILE, IDS_FILE, IDS_SORTED_FILE, IDS_ORDER_FILE):
+        os.replace(tmp / name, path / name)
+    for column_file in (tmp / META_DIR).glob("*.npy"):
+        os.replace(column_file, path / META_DIR / column_file.name)
+    # store.json per ultimo: la sua presenza indica uno store completo
+    os.replace(tmp / STORE_FILE, path / STORE_FILE)
+    (tmp / META_DIR).rmdir()
+    tmp.rmdir()
+
+
+def load_store(persist_dir: str, embeddings) -> FAISS:
+    """Open a memory-mapped store as a LangChain ``FAISS`` vector store.
+
+    Parameters
+    ----------
+    persist_dir : str
+        Directory written by ``save_store``.
+    embeddings : Any
+        Embeddings model used for queries.
+
+    Returns
+    -------
+    FAISS
+        A read-only store; call ``materialize_store`` before modifying it.
+    """
+    docstore = MmapDocstore(persist_dir)
+    flags = _mmap_flags(docstore.schema.get("index_family", "flat"))
+    index = faiss.read_index(str(Path(persist_dir) / INDEX_FILE), flags)
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=LazyIdMap(docstore.ids),
+    )
+
+
+def materialize_store(vector_store: FAISS) -> None:
+    """Turn a memory-mapped store into a writable in-memory one, in place.
+
+    Needed before adding or deleting documents; costs memory proportional to
+    the corpus.
+    """
+    docstore = vector_store.docstore
+    if not isinstance(docstore, MmapDocstore):
+        return
+    vector_store.index = faiss.read_index(str(Path(docstore.persist_dir) / INDEX_FILE))
+    mapping = {position: vector_store.index_to_docstore_id[position] for position in range(docstore.count)}
+    vector_store.docstore = InMemoryDocstore({doc_id: docstore.document_at(p) for p, doc_id in mapping.items()})
+    vector_store.index_to_docstore_id = mapping
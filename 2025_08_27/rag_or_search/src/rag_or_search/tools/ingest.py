@@ -0,0 +1,235 @@
+"""Ingestion pipeline stages for building the RAG index.
+
+Currently provides ``embed_chunks``: embeds chunks in configurable batches
+with bounded concurrency, adaptive backoff on throttling (HTTP 429) and
+on-disk checkpoints, so an interrupted build resumes from the last completed
+batch instead of starting over.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Errori di rete ritentati come il throttling: eccezioni builtin e, se installato, quelle del client openai
+TRANSIENT_ERRORS: Tuple[type, ...] = (ConnectionError, TimeoutError)
+try:
+    import openai
+except ImportError:
+    openai = None
+else:
+    TRANSIENT_ERRORS += (openai.APIConnectionError, openai.APITimeoutError)
+
+
+@dataclass
+class EmbeddingReport:
+    """Throughput statistics of an ``embed_chunks`` run.
+
+    Attributes
+    ----------
+    chunks : int
+        Number of chunks embedded (including resumed ones).
+    batches : int
+        Number of batches.
+    resumed_batches : int
+        Batches read back from checkpoints instead of being embedded.
+    retries : int
+        Retries caused by throttling or transient errors.
+    seconds : float
+        Wall-clock time of the run.
+    """
+
+    chunks: int = 0
+    batches: int = 0
+    resumed_batches: int = 0
+    retries: int = 0
+    seconds: float = 0.0
+
+    @property
+    def chunks_per_sec(self) -> float:
+        """Embedding throughput in chunks per second."""
+        return self.chunks / self.seconds if self.seconds else 0.0
+
+    def add(self, other: "EmbeddingReport") -> None:
+        """Accumulate the statistics of another run (e.g. the next batch of a stream)."""
+        self.chunks += other.chunks
+        self.batches += other.batches
+        self.resumed_batches += other.resumed_batches
+        self.retries += other.retries
+        self.seconds += other.seconds
+
+    def __str__(self) -> str:
+        return (
+            f"Embedded {self.chunks} chunks in {self.batches} batches "
+            f"({self.resumed_batches} resumed, {self.retries} retries) "
+            f"in {self.seconds:.2f}s: {self.chunks_per_sec:.1f} chunks/sec"
+        )
+
+
+def is_throttled(exc: BaseException) -> bool:
+    """Whether ``exc`` is a rate-limit error (HTTP 429) from the embedding API."""
+    if type(exc).__name__ == "RateLimitError":
+        return True
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status == 429
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Whether ``exc`` is worth retrying: throttling, or a connection error or timeout."""
+    return is_throttled(exc) or isinstance(exc, TRANSIENT_ERRORS)
+
+
+def _retry_after(exc: BaseException) -> Optional[float]:
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveBackoff:
+    """Delay shared by all workers, doubled on throttling and decayed on success.
+
+    Parameters
+    ----------
+    initial : float, optional
+        First delay in seconds after a throttled request.
+    maximum : float, optional
+        Upper bound of the delay.
+    """
+
+    def __init__(self, initial: float = 1.0, maximum: float = 60.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.delay = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Sleep for the current delay (with jitter) before a request."""
+        delay = self.delay
+        if delay:
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def throttled(self, retry_after: Optional[float] = None) -> None:
+        """Record a throttled request and increase the delay."""
+        with self._lock:
+            self.delay = min(self.maximum, max(retry_after or 0.0, self.delay * 2 or self.initial))
+
+    def succeeded(self) -> None:
+        """Record a successful request and decrease the delay."""
+        with self._lock:
+            self.delay = self.delay / 2 if self.delay > self.initial / 8 else 0.0
+
+
+def _batch_key(texts: Sequence[str]) -> str:
+    digest = hashlib.sha256()
+    for text in texts:
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()[:24]
+
+
+def embed_chunks(
+    texts: Sequence[str],
+    embeddings,
+    batch_size: int = 64,
+    max_workers: int = 4,
+    max_retries: int = 6,
+    checkpoint_dir: Optional[str] = None,
+    on_batch: Optional[Callable[[int, int], None]] = None,
+) -> Tuple[np.ndarray, EmbeddingReport]:
+    """Embed ``texts`` in batches with bounded concurrency and checkpoints.
+
+    Parameters
+    ----------
+    texts : sequence of str
+        Chunk texts, e.g. ``[d.page_content for d in chunks]``.
+    embeddings : Any
+        LangChain embeddings model (``embed_documents`` is called per batch).
+    batch_size : int, optional
+        Texts per embedding request.
+    max_workers : int, optional
+        Maximum number of concurrent requests.
+    max_retries : int, optional
+        Retries per batch on throttling, connection errors and timeouts
+        (see ``is_transient``).
+    checkpoint_dir : str, optional
+        Directory where each completed batch is saved as ``.npy``, keyed by
+        the hash of its texts. Existing checkpoints are reused.
+    on_batch : callable, optional
+        Called as ``on_batch(done_chunks, total_chunks)`` after each batch.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``float32`` matrix of shape ``(len(texts), d)``.
+    EmbeddingReport
+        Throughput statistics.
+
+    Raises
+    ------
+    Exception
+        The last error of a batch that exhausted its retries, or any
+        non-transient error raised by the embeddings model.
+    """
+    start = time.perf_counter()
+    report = EmbeddingReport(chunks=len(texts))
+    batches = [list(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)]
+    report.batches = len(batches)
+    checkpoint = Path(checkpoint_dir) if checkpoint_dir else None
+    if checkpoint is not None:
+        checkpoint.mkdir(parents=True, exist_ok=True)
+
+    backoff = AdaptiveBackoff()
+    lock = threading.Lock()
+    done = [0]
+
+    def run(batch: List[str]) -> np.ndarray:
+        path = checkpoint / f"{_batch_key(batch)}.npy" if checkpoint is not None else None
+        if path is not None and path.exists():
+            vectors = np.load(path)
+            with lock:
+                report.resumed_batches += 1
+        else:
+            for attempt in range(max_retries + 1):
+                backoff.wait()
+                try:
+                    vectors = np.asarray(embeddings.embed_documents(batch), dtype=np.float32)
+                    backoff.succeeded()
+                    break
+                except Exception as exc:
+                    if not is_transient(exc) or attempt == max_retries:
+                        raise
+                    if is_throttled(exc):
+                        backoff.throttled(_retry_after(exc))
+                    else:
+                        time.sleep(min(backoff.maximum, backoff.initial * 2 ** attempt))
+                    with lock:
+                        report.retries += 1
+            if path is not None:
+                tmp_path = path.with_suffix(".tmp.npy")
+                np.save(tmp_path, vectors)
+                tmp_path.replace(path)
+        with lock:
+            done[0] += len(batch)
+            if on_batch is not None:
+                on_batch(done[0], len(texts))
+        return vectors
+
+    if not batches:
+        return np.zeros((0, 0), dtype=np.float32), report
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        results = list(pool.map(run, batches))
+
+    report.seconds = time.perf_counter() - start
+    return np.vstack(results), report
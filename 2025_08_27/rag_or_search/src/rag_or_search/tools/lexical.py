@@ -0,0 +1,366 @@
+"""BM25 inverted index over the chunks of a FAISS store.
+
+Used by ``search_type="hybrid"`` next to vector search, so exact-term queries
+(error codes, names) are found without a large ``fetch_k``. Document ids are
+FAISS index positions, so results map to the same docstore entries.
+
+Postings are stored compressed: for every term, the delta-encoded positions
+followed by the term frequencies, as LEB128 varints in one byte array. Terms
+are kept sorted for binary search.
+
+Every persisted segment of a store (the base store, each delta segment of
+an incremental update, each shard) has its own index in
+``<segment_dir>/lexical/``, as ``.npy`` files opened with mmap plus
+``lexical.json`` with the BM25 parameters and the signature of the segment
+it was built from; a stale one is rebuilt on load. ``LayeredBM25Index``
+stacks them in position order and hides the tombstoned positions, so an
+incremental update only indexes its new segment, not the whole corpus.
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import os
+import re
+import threading
+import weakref
+from collections import Counter
+from pathlib import Path
+from typing import Any, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+from .index_store import IDS_FILE, MmapDocstore, store_exists
+
+LEXICAL_DIR = "lexical"
+LEXICAL_FILE = "lexical.json"
+_TOKEN = re.compile(r"\w+(?:[-.]\w+)*")
+
+_INDEXES: "weakref.WeakKeyDictionary[Any, BM25Index]" = weakref.WeakKeyDictionary()
+_INDEXES_LOCK = threading.Lock()
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens; ``-`` and ``.`` inside a token are kept (``ERR-404``, ``v1.2``)."""
+    return _TOKEN.findall(text.lower())
+
+
+def encode_varints(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Encode non-negative integers as LEB128 varints.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Integers below ``2**35``.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``uint8`` byte stream.
+    numpy.ndarray
+        Byte offset of each value in the stream.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28):
+        nbytes += values >= (1 << shift)
+    ends = np.cumsum(nbytes)
+    starts = ends - nbytes
+    out = np.empty(int(ends[-1]) if len(ends) else 0, dtype=np.uint8)
+    for i in range(int(nbytes.max()) if len(nbytes) else 0):
+        mask = nbytes > i
+        byte = (values[mask] >> np.uint64(7 * i)) & np.uint64(0x7F)
+        more = (nbytes[mask] > i + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[mask] + i] = (byte | more).astype(np.uint8)
+    return out, starts
+
+
+def decode_varints(data: np.ndarray) -> np.ndarray:
+    """Decode a LEB128 varint byte stream into ``int64`` values."""
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    group = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shift = (np.arange(len(data)) - starts[group]) * 7
+    parts = (data & 0x7F).astype(np.uint64) << shift.astype(np.uint64)
+    return np.add.reduceat(parts, starts).astype(np.int64)
+
+
+class BM25Index:
+    """Okapi BM25 over a fixed list of texts, with compressed postings.
+
+    Parameters
+    ----------
+    terms : numpy.ndarray
+        Sorted vocabulary (unicode array).
+    offsets : numpy.ndarray
+        Byte offset of each term's postings (``len(terms) + 1``).
+    doc_freq : numpy.ndarray
+        Number of texts containing each term.
+    postings : numpy.ndarray
+        ``uint8`` varint stream (see module docstring).
+    doc_len : numpy.ndarray
+        Token count of each text.
+    k1, b : float, optional
+        BM25 parameters.
+    """
+
+    def __init__(self, terms, offsets, doc_freq, postings, doc_len, k1: float = 1.5, b: float = 0.75):
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_freq = doc_freq
+        self.postings_data = postings
+        self.doc_len = doc_len
+        self.k1 = k1
+        self.b = b
+        self.count = len(doc_len)
+        self.avgdl = float(np.mean(doc_len)) if self.count else 0.0
+
+    @classmethod
+    def build(cls, texts: Sequence[str], k1: float = 1.5, b: float = 0.75) -> "BM25Index":
+        """Tokenize ``texts`` and build the index; position ``i`` is ``texts[i]``."""
+        vocabulary: dict = {}
+        term_col: List[int] = []
+        doc_col: List[int] = []
+        freq_col: List[int] = []
+        doc_len = np.zeros(len(texts), dtype=np.int32)
+        for doc, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            doc_len[doc] = sum(counts.values())
+            for term, tf in counts.items():
+                term_col.append(vocabulary.setdefault(term, len(vocabulary)))
+                doc_col.append(doc)
+                freq_col.append(tf)
+
+        terms = np.array(sorted(vocabulary), dtype=str) if vocabulary else np.zeros(0, dtype="<U1")
+        rank = np.empty(len(vocabulary), dtype=np.int64)
+        rank[[vocabulary[t] for t in terms.tolist()]] = np.arange(len(terms))
+        term_ids = rank[np.asarray(term_col, dtype=np.int64)]
+        # Ordinamento stabile per termine: le posizioni restano crescenti dentro ogni posting list
+        order = np.argsort(term_ids, kind="stable")
+        term_ids = term_ids[order]
+        docs = np.asarray(doc_col, dtype=np.int64)[order]
+        freqs = np.asarray(freq_col, dtype=np.int64)[order]
+
+        doc_freq = np.bincount(term_ids, minlength=len(terms)).astype(np.int64)
+        first = np.concatenate(([0], np.cumsum(doc_freq)[:-1])) if len(terms) else np.zeros(0, dtype=np.int64)
+        deltas = np.diff(docs, prepend=0)
+        deltas[first] = docs[first]
+
+        # Per ogni termine: [delta delle posizioni..., frequenze...]
+        group_start = np.repeat(first, doc_freq)
+        within = np.arange(len(docs)) - group_start
+        values = np.empty(2 * len(docs), dtype=np.int64)
+        values[2 * group_start + within] = deltas
+        values[2 * group_start + np.repeat(doc_freq, doc_freq) + within] = freqs
+        postings, value_offsets = encode_varints(values)
+        offsets = np.append(value_offsets[2 * first] if len(first) else np.zeros(0, np.int64), len(postings))
+        return cls(terms, offsets.astype(np.int64), doc_freq, postings, doc_len, k1=k1, b=b)
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Return ``(positions, term frequencies)`` of ``term`` (empty if unknown)."""
+        i = int(np.searchsorted(self.terms, term))
+        if i >= len(self.terms) or self.terms[i] != term:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty
+        n = int(self.doc_freq[i])
+        values = decode_varints(self.postings_data[self.offsets[i]:self.offsets[i + 1]])
+        return np.cumsum(values[:n]), values[n:]
+
+    def search(self, query: str, k: int = 10, allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the top-``k`` positions for ``query`` and their BM25 scores.
+
+        Ties are broken by position, so results are deterministic. With
+        ``allowed`` (sorted positions, e.g. from a metadata filter) only those
+        positions are ranked.
+        """
+        positions, scores = [], []
+        for term in set(tokenize(query)):
+            docs, tfs = self.postings(term)
+            if not len(docs):
+                continue
+            idf = math.log(1 + (self.count - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.doc_len[docs] / self.avgdl)
+            positions.append(docs)
+            scores.append(idf * tfs * (self.k1 + 1) / (tfs + norm))
+        if not positions:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        docs, inverse = np.unique(np.concatenate(positions), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores))
+        if allowed is not None:
+            keep = np.isin(docs, allowed, assume_unique=True)
+            docs, totals = docs[keep], totals[keep]
+        if 0 < k < len(docs):
+            # Tiene anche i pari merito del k-esimo, poi ordina per punteggio e posizione
+            threshold = -np.partition(-totals, k - 1)[k - 1]
+            keep = totals >= threshold
+            docs, totals = docs[keep], totals[keep]
+        order = np.lexsort((docs, -totals))[:k]
+        return docs[order], totals[order]
+
+    def save(self, persist_dir: str, store_signature: Optional[list] = None) -> None:
+        """Write the index under ``<persist_dir>/lexical``."""
+        path = Path(persist_dir) / LEXICAL_DIR
+        path.mkdir(parents=True, exist_ok=True)
+        for name in ("terms", "offsets", "doc_freq", "postings_data", "doc_len"):
+            np.save(path / f"{name}.npy", getattr(self, name))
+        meta = {"k1": self.k1, "b": self.b, "count": self.count, "store_signature": store_signature}
+        tmp_path = path / f"{LEXICAL_FILE}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path / LEXICAL_FILE)
+
+    @classmethod
+    def load(cls, persist_dir: str) -> Tuple["BM25Index", dict]:
+        """Open the index saved under ``persist_dir`` with mmap; return it and its metadata."""
+        path = Path(persist_dir) / LEXICAL_DIR
+        with open(path / LEXICAL_FILE, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        arrays = {
+            name: np.load(path / f"{name}.npy", mmap_mode="r")
+            for name in ("terms", "offsets", "doc_freq", "postings_data", "doc_len")
+        }
+        index = cls(
+            arrays["terms"], arrays["offsets"], arrays["doc_freq"], arrays["postings_data"], arrays["doc_len"],
+            k1=meta["k1"], b=meta["b"],
+        )
+        return index, meta
+
+
+class LayeredBM25Index(BM25Index):
+    """BM25 over consecutive segment indexes, with deleted positions hidden.
+
+    Scores are those of a ``BM25Index`` built over every position with the
+    deleted texts left empty: collection statistics are recomputed over the
+    live postings, the per-segment arrays are never copied.
+
+    Parameters
+    ----------
+    parts : sequence of BM25Index
+        Index of each segment, in position order; same ``k1`` and ``b``.
+    deleted : numpy.ndarray
+        Sorted global positions to hide.
+    """
+
+    def __init__(self, parts: Sequence[BM25Index], deleted: np.ndarray):
+        self.parts = list(parts)
+        self.part_offsets = np.concatenate(([0], np.cumsum([p.count for p in self.parts]))).astype(np.int64)
+        self.deleted = np.asarray(deleted, dtype=np.int64)
+        doc_len = np.concatenate([np.asarray(p.doc_len, dtype=np.int32) for p in self.parts])
+        doc_len[self.deleted] = 0
+        self.doc_len = doc_len
+        self.k1 = self.parts[0].k1
+        self.b = self.parts[0].b
+        self.count = len(doc_len)
+        self.avgdl = float(np.mean(doc_len)) if self.count else 0.0
+
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the live ``(positions, term frequencies)`` of ``term`` across the segments."""
+        positions, freqs = [], []
+        for offset, part in zip(self.part_offsets, self.parts):
+            docs, tfs = part.postings(term)
+            positions.append(docs + offset)
+            freqs.append(tfs)
+        docs, tfs = np.concatenate(positions), np.concatenate(freqs)
+        if len(self.deleted):
+            keep = ~np.isin(docs, self.deleted, assume_unique=True)
+            docs, tfs = docs[keep], tfs[keep]
+        return docs, tfs
+
+    def save(self, persist_dir: str, store_signature: Optional[list] = None) -> None:
+        raise NotImplementedError("Each segment index is saved on its own")
+
+
+def _segment_signature(persist_dir: str) -> list:
+    # ids.npy viene riscritto solo da save_store: i delta (che cambiano store.json) non lo toccano
+    stat = os.stat(Path(persist_dir) / IDS_FILE)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _segments(docstore) -> Optional[List[MmapDocstore]]:
+    # Segmenti persistiti in ordine di posizione (base, delta, shard); None per uno store in memoria
+    if isinstance(docstore, MmapDocstore):
+        return [docstore]
+    inner = getattr(docstore, "docstores", None)
+    if inner is None:
+        return None
+    segments: List[MmapDocstore] = []
+    for child in inner:
+        found = _segments(child)
+        if found is None:
+            return None
+        segments.extend(found)
+    return segments
+
+
+def _segment_index(docstore: MmapDocstore) -> BM25Index:
+    persist_dir = docstore.persist_dir
+    signature = _segment_signature(persist_dir)
+    if (Path(persist_dir) / LEXICAL_DIR / LEXICAL_FILE).exists():
+        loaded, meta = BM25Index.load(persist_dir)
+        if meta["store_signature"] == signature and loaded.count == docstore.count:
+            return loaded
+    index = BM25Index.build([docstore.text_at(position) for position in range(docstore.count)])
+    index.save(persist_dir, signature)
+    return index
+
+
+def _texts(vector_store) -> List[str]:
+    texts = []
+    # Posizioni cancellate da un aggiornamento incrementale: testo vuoto, mai trovate
+    deleted = getattr(vector_store.docstore, "deleted_positions", None)
+    deleted = set(deleted().tolist()) if deleted is not None else set()
+    for position in range(vector_store.index.ntotal):
+        if position in deleted:
+            texts.append("")
+            continue
+        doc_id = vector_store.index_to_docstore_id[position]
+        doc = vector_store.docstore.search(doc_id)
+        if not isinstance(doc, Document):
+            raise ValueError(f"Could not find document for id {doc_id}, got {doc}")
+        texts.append(doc.page_content)
+    return texts
+
+
+def build_lexical_index(vector_store, persist_dir: Optional[str] = None) -> BM25Index:
+    """Build the BM25 index of ``vector_store`` and save it as that of the store persisted in ``persist_dir``.
+
+    ``vector_store`` must hold exactly the positions just written by
+    ``save_store`` (e.g. at the end of a build), with no delta segments.
+    """
+    index = BM25Index.build(_texts(vector_store))
+    if persist_dir and store_exists(persist_dir):
+        index.save(persist_dir, _segment_signature(persist_dir))
+    return index
+
+
+def lexical_index_for(vector_store) -> BM25Index:
+    """Return the BM25 index of ``vector_store``, loading or (re)building it once.
+
+    For a memory-mapped store the index of each segment (base store, delta
+    segments, shards) is loaded, or built and saved when missing or older
+    than its segment, and the segments are stacked with the tombstoned
+    positions hidden (``LayeredBM25Index``). Other stores are indexed in
+    memory from the docstore.
+    """
+    index = _INDEXES.get(vector_store)
+    if index is not None and index.count == vector_store.index.ntotal:
+        return index
+    with _INDEXES_LOCK:
+        index = _INDEXES.get(vector_store)
+        if index is not None and index.count == vector_store.index.ntotal:
+            return index
+        segments = _segments(vector_store.docstore)
+        if segments is not None and sum(s.count for s in segments) == vector_store.index.ntotal:
+            parts = [_segment_index(segment) for segment in segments]
+            deleted = getattr(vector_store.docstore, "deleted_positions", None)
+            deleted = deleted() if deleted is not None else np.zeros(0, dtype=np.int64)
+            index = parts[0] if len(parts) == 1 and not len(deleted) else LayeredBM25Index(parts, deleted)
+        else:
+            index = BM25Index.build(_texts(vector_store))
+        _INDEXES[vector_store] = index
+        return index
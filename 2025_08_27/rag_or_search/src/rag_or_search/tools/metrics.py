@@ -0,0 +1,468 @@
+"""Per-stage timings and counters of the retrieval path.
+
+``METRICS`` is the process-wide registry. It is disabled by default: every
+instrumentation point then costs one attribute check (``stage`` returns a
+shared no-op context manager), so the hot path is unaffected. Once enabled
+(``configure_metrics`` or ``METRICS.enable``) it records:
+
+- latency histograms per stage, in seconds: ``embeddings.init``,
+  ``index.load``, ``query.embed``, ``filter.positions``, ``faiss.search``,
+  ``mmr.select``, ``lexical.search``, ``docstore.lookup``,
+  ``retriever.invoke``, ``contexts.question(s)``, ``engine.search``
+- value histograms: ``candidates`` (FAISS candidates per query),
+  ``filter.allowed`` (positions left by a metadata filter)
+- counters, including the hits and misses of the embedding and response
+  caches, with the derived hit rates
+
+Snapshots are pushed to a pluggable exporter: ``LoggingExporter``,
+``JsonFileExporter`` or ``PrometheusExporter`` (text exposition format,
+e.g. for the node_exporter textfile collector)::
+
+    python -m rag_or_search.tools.metrics --exporter prometheus
+"""
+
+from __future__ import annotations
+
+import argparse
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+
+EXPORTERS = ("logging", "json", "prometheus")
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+VALUE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1_000, 5_000, 20_000, 100_000, 1_000_000)
+
+
+class Histogram:
+    """Fixed-bucket histogram with count, sum and max.
+
+    Parameters
+    ----------
+    buckets : sequence of float
+        Sorted upper bounds; larger observations fall in the ``+Inf`` bucket.
+    """
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the ``q`` quantile (capped at ``max``)."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> Dict[str, Any]:
+        cumulative = np.cumsum(self.counts).tolist()
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": self.max,
+            "buckets": [[bound, c] for bound, c in zip(self.buckets, cumulative)] + [["+Inf", cumulative[-1]]],
+        }
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        return None
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ("_metrics", "_name", "_start")
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._metrics.observe_seconds(self._name, time.perf_counter() - self._start)
+
+
+class Metrics:
+    """Thread-safe registry of stage latencies, values and counters.
+
+    Parameters
+    ----------
+    exporter : object, optional
+        Object with an ``export(snapshot)`` method.
+    export_interval : float or None, optional
+        Minimum seconds between two exports triggered by ``maybe_export``;
+        ``None`` exports only on explicit ``export`` calls.
+    """
+
+    def __init__(self, exporter=None, export_interval: Optional[float] = 60.0):
+        self.enabled = False
+        self.exporter = exporter
+        self.export_interval = export_interval
+        self._stages: Dict[str, Histogram] = {}
+        self._values: Dict[str, Histogram] = {}
+        self._counters: Dict[str, int] = {}
+        self._sources: Dict[str, Callable[[], Mapping[str, int]]] = {}
+        self._last_export = time.monotonic()
+        self._lock = threading.Lock()
+
+    def enable(self, exporter=None, export_interval: Optional[float] = 60.0) -> None:
+        """Start recording; ``exporter`` replaces the current one when given."""
+        if exporter is not None:
+            self.exporter = exporter
+        self.export_interval = export_interval
+        self.enabled = True
+
+    def disable(self) -> None:
+        """Stop recording; collected data is kept until ``reset``."""
+        self.enabled = False
+
+    def reset(self) -> None:
+        """Drop all collected data (registered sources are kept)."""
+        with self._lock:
+            self._stages.clear()
+            self._values.clear()
+            self._counters.clear()
+
+    def stage(self, name: str):
+        """Context manager timing a stage; a shared no-op when disabled."""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def observe_seconds(self, name: str, seconds: float) -> None:
+        """Record the latency of one run of stage ``name``."""
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._stages.get(name)
+            if histogram is None:
+                histogram = self._stages[name] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+
+    def observe(self, name: str, values) -> None:
+        """Record one value, or each of an array of values, in histogram ``name``."""
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._values.get(name)
+            if histogram is None:
+                histogram = self._values[name] = Histogram(VALUE_BUCKETS)
+            for value in np.atleast_1d(values).tolist():
+                histogram.observe(value)
+
+    def count(self, name: str, n: int = 1) -> None:
+        """Add ``n`` to counter ``name``."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def register_source(self, prefix: str, source: Callable[[], Mapping[str, int]]) -> None:
+        """Read counters kept elsewhere (e.g. cache ``hits``/``misses``) at snapshot time.
+
+        ``source()`` returns ``{name: value}``, reported as ``<prefix>.<name>``;
+        a source registered again under the same prefix replaces the old one.
+        """
+        with self._lock:
+            self._sources[prefix] = source
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return all collected data as plain JSON-serializable dicts."""
+        with self._lock:
+            counters = dict(self._counters)
+            sources = list(self._sources.items())
+            snapshot = {
+                "timestamp": time.time(),
+                "stages": {name: h.snapshot() for name, h in sorted(self._stages.items())},
+                "values": {name: h.snapshot() for name, h in sorted(self._values.items())},
+            }
+        for prefix, source in sources:
+            for name, value in source().items():
+                counters[f"{prefix}.{name}"] = value
+        snapshot["counters"] = dict(sorted(counters.items()))
+        hit_rates = {}
+        for name, hits in counters.items():
+            if name.endswith(".hits"):
+                prefix = name[:-len(".hits")]
+                total = hits + counters.get(f"{prefix}.misses", 0)
+                hit_rates[prefix] = hits / total if total else 0.0
+        snapshot["hit_rates"] = hit_rates
+        return snapshot
+
+    def export(self) -> Optional[Dict[str, Any]]:
+        """Push a snapshot to the exporter and return it (``None`` without exporter)."""
+        self._last_export = time.monotonic()
+        if self.exporter is None:
+            return None
+        snapshot = self.snapshot()
+        self.exporter.export(snapshot)
+        return snapshot
+
+    def maybe_export(self) -> None:
+        """``export`` if enabled and ``export_interval`` seconds have passed."""
+        if not self.enabled or self.exporter is None or self.export_interval is None:
+            return
+        if time.monotonic() - self._last_export >= self.export_interval:
+            self.export()
+
+
+METRICS = Metrics()
+
+
+def stage(name: str):
+    """``METRICS.stage``: time the enclosed block as stage ``name``."""
+    return METRICS.stage(name)
+
+
+def timed(name: str):
+    """Decorator timing every call of the function as stage ``name``."""
+
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not METRICS.enabled:
+                return function(*args, **kwargs)
+            with METRICS.stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def instrumented_search(
+    search: Callable[[np.ndarray, int], Tuple[np.ndarray, np.ndarray]]
+) -> Callable[[np.ndarray, int], Tuple[np.ndarray, np.ndarray]]:
+    """Wrap a ``search(queries, k)`` callable to time it and count its candidates.
+
+    Returns ``search`` itself when metrics are disabled.
+    """
+    if not METRICS.enabled:
+        return search
+
+    def wrapper(queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        with METRICS.stage("faiss.search"):
+            distances, labels = search(queries, k)
+        METRICS.observe("candidates", (labels >= 0).sum(axis=1))
+        return distances, labels
+
+    return wrapper
+
+
+class LoggingExporter:
+    """Write a summary line per stage, value and counter to a logger.
+
+    Parameters
+    ----------
+    logger : logging.Logger, optional
+        Defaults to the ``rag_or_search.metrics`` logger.
+    level : int, optional
+        Log level of the records.
+    """
+
+    def __init__(self, logger: Optional[logging.Logger] = None, level: int = logging.INFO):
+        self.logger = logger or logging.getLogger("rag_or_search.metrics")
+        self.level = level
+
+    def export(self, snapshot: Mapping[str, Any]) -> None:
+        for name, h in snapshot["stages"].items():
+            self.logger.log(
+                self.level, "stage %s: n=%d mean=%.2fms p50<=%.2fms p95<=%.2fms max=%.2fms",
+                name, h["count"], h["mean"] * 1e3, h["p50"] * 1e3, h["p95"] * 1e3, h["max"] * 1e3,
+            )
+        for name, h in snapshot["values"].items():
+            self.logger.log(self.level, "value %s: n=%d mean=%.1f p95<=%g max=%g", name, h["count"], h["mean"], h["p95"], h["max"])
+        for name, value in snapshot["counters"].items():
+            self.logger.log(self.level, "counter %s: %d", name, value)
+        for name, rate in snapshot["hit_rates"].items():
+            self.logger.log(self.level, "hit rate %s: %.1f%%", name, rate * 100)
+
+
+def _write_atomic(path: Path, text: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class JsonFileExporter:
+    """Atomically rewrite a JSON file with the latest snapshot.
+
+    Parameters
+    ----------
+    path : str
+        Target file.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+
+    def export(self, snapshot: Mapping[str, Any]) -> None:
+        _write_atomic(self.path, json.dumps(snapshot, indent=2))
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+class PrometheusExporter:
+    """Render snapshots in the Prometheus text exposition format.
+
+    Parameters
+    ----------
+    path : str, optional
+        File atomically rewritten on every export (node_exporter textfile
+        collector); without it ``export`` only keeps the text in ``last``.
+    namespace : str, optional
+        Prefix of the metric names.
+    """
+
+    def __init__(self, path: Optional[str] = None, namespace: str = "rag"):
+        self.path = Path(path) if path else None
+        self.namespace = namespace
+        self.last = ""
+
+    def _histogram(self, lines: List[str], metric: str, label: str, name: str, h: Mapping[str, Any]) -> None:
+        for bound, count in h["buckets"]:
+            lines.append(f'{metric}_bucket{{{label}="{_label(name)}",le="{bound}"}} {count}')
+        lines.append(f'{metric}_sum{{{label}="{_label(name)}"}} {h["sum"]}')
+        lines.append(f'{metric}_count{{{label}="{_label(name)}"}} {h["count"]}')
+
+    def render(self, snapshot: Mapping[str, Any]) -> str:
+        """Return ``snapshot`` as Prometheus text."""
+        ns = self.namespace
+        lines = [f"# HELP {ns}_stage_seconds Latency of retrieval stages.", f"# TYPE {ns}_stage_seconds histogram"]
+        for name, h in snapshot["stages"].items():
+            self._histogram(lines, f"{ns}_stage_seconds", "stage", name, h)
+        lines += [f"# HELP {ns}_values Sizes observed along the retrieval path.", f"# TYPE {ns}_values histogram"]
+        for name, h in snapshot["values"].items():
+            self._histogram(lines, f"{ns}_values", "name", name, h)
+        lines += [f"# HELP {ns}_events_total Retrieval event counters.", f"# TYPE {ns}_events_total counter"]
+        for name, value in snapshot["counters"].items():
+            lines.append(f'{ns}_events_total{{name="{_label(name)}"}} {value}')
+        lines += [f"# HELP {ns}_hit_ratio Cache hit ratios.", f"# TYPE {ns}_hit_ratio gauge"]
+        for name, rate in snapshot["hit_rates"].items():
+            lines.append(f'{ns}_hit_ratio{{cache="{_label(name)}"}} {rate}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, snapshot: Mapping[str, Any]) -> None:
+        self.last = self.render(snapshot)
+        if self.path is not None:
+            _write_atomic(self.path, self.last)
+
+
+def make_exporter(kind: str, path: Optional[str] = None):
+    """Create the exporter named ``kind`` (one of ``EXPORTERS``).
+
+    Raises
+    ------
+    ValueError
+        If ``kind`` is unknown, or ``"json"`` is requested without ``path``.
+    """
+    if kind == "logging":
+        return LoggingExporter()
+    if kind == "json":
+        if not path:
+            raise ValueError("The json metrics exporter needs a path")
+        return JsonFileExporter(path)
+    if kind == "prometheus":
+        return PrometheusExporter(path)
+    raise ValueError(f"Unsupported metrics exporter: {kind}. Choose one of {EXPORTERS}.")
+
+
+def configure_metrics(settings) -> None:
+    """Enable ``METRICS`` with the exporter of ``settings.metrics_exporter``.
+
+    Does nothing when ``settings.metrics_exporter`` is ``None``, so metrics
+    enabled elsewhere are not switched off.
+    """
+    if settings.metrics_exporter is None:
+        return
+    METRICS.enable(make_exporter(settings.metrics_exporter, settings.metrics_path), settings.metrics_interval)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """Measure the instrumentation overhead and print an export on a synthetic corpus."""
+    from dataclasses import replace
+
+    from .benchmark import HashingEmbeddings, make_queries, synthetic_corpus
+    # Con "python -m" questo file è __main__: il registro usato dal retriever è quello del package
+    from .metrics import METRICS as metrics
+    from .rag_utils import Settings, load_or_build_vectorstore, make_retriever
+
+    parser = argparse.ArgumentParser(description="Retrieval metrics: overhead and sample export.")
+    parser.add_argument("--chunks", type=int, default=20_000, help="Corpus size.")
+    parser.add_argument("--queries", type=int, default=500, help="Queries per measurement.")
+    parser.add_argument("--search-type", default="mmr", help="similarity, mmr or hybrid.")
+    parser.add_argument("--exporter", default="logging", choices=EXPORTERS, help="Exporter of the final snapshot.")
+    parser.add_argument("--path", default=None, help="Output file of the json/prometheus exporters.")
+    parser.add_argument("--persist-dir", default="metrics_index", help="Directory of the benchmark index.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    embeddings = HashingEmbeddings()
+    docs = synthetic_corpus(args.chunks)
+    questions = make_queries(docs, args.queries)
+    settings = Settings(
+        persist_dir=args.persist_dir, embedding_cache_dir=None, search_type=args.search_type, k=4, fetch_k=20
+    )
+    retriever = make_retriever(load_or_build_vectorstore(settings, embeddings, docs), replace(settings))
+
+    def run() -> float:
+        start = time.perf_counter()
+        for question in questions:
+            retriever.invoke(question)
+        return (time.perf_counter() - start) / len(questions) * 1e6
+
+    run()
+    disabled = run()
+    metrics.enable(make_exporter(args.exporter, args.path), export_interval=None)
+    enabled = run()
+    print(f"Metriche disabilitate: {disabled:.1f} us/query, abilitate: {enabled:.1f} us/query")
+    snapshot = metrics.export()
+    if args.exporter == "prometheus" and not args.path:
+        print(metrics.exporter.last)
+    elif args.exporter == "json" and snapshot is not None:
+        print(f"Snapshot scritto in {args.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Vectorized Maximal Marginal Relevance (MMR) over a FAISS store.
+
+LangChain's FAISS MMR reconstructs each candidate vector from the index and
+scores candidates in Python loops. Here the candidates of a block of queries
+are reconstructed together (each distinct position once), the candidate
+similarity matrix is computed with one batched NumPy matmul, and the greedy
+selection runs on that matrix for the whole block at once. Selections are identical to
+``langchain_community.vectorstores.utils.maximal_marginal_relevance``, except
+for candidates whose scores tie within float32 rounding (e.g. duplicated
+chunks), where either implementation may pick any of the tied ones.
+
+No copy of the corpus vectors is kept: memory is bounded by the query block
+(``fetch_k`` candidates per query). With quantized storage and
+full-precision vectors on disk (``quantization.RerankedIndex``) the
+candidates are read from the memory-mapped file.
+"""
+
+from __future__ import annotations
+
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+from .metrics import stage
+
+_MAX_BLOCK_FLOATS = 64 * 1024 * 1024
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def candidate_vectors(index, positions: np.ndarray) -> np.ndarray:
+    """Reconstruct and L2-normalize the vectors at ``positions``.
+
+    Each distinct position is reconstructed once, however many queries
+    fetched it.
+
+    Parameters
+    ----------
+    index : faiss.Index
+        Index (or index wrapper) implementing ``reconstruct_batch``.
+    positions : numpy.ndarray
+        Candidate positions of a block of queries, shape ``(q, f)``.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``float32`` array of shape ``(q, f, d)``.
+    """
+    unique, inverse = np.unique(positions, return_inverse=True)
+    vectors = _normalize(np.asarray(index.reconstruct_batch(unique), dtype=np.float32))
+    return vectors[inverse.reshape(positions.shape)]
+
+
+def mmr_select(
+    query_similarity: np.ndarray,
+    candidate_similarity: np.ndarray,
+    valid: np.ndarray,
+    k: int,
+    lambda_mult: float,
+) -> List[List[int]]:
+    """Greedy MMR selection for a batch of queries.
+
+    Parameters
+    ----------
+    query_similarity : numpy.ndarray
+        Cosine similarity query/candidate, shape ``(q, f)``.
+    candidate_similarity : numpy.ndarray
+        Cosine similarity among candidates, shape ``(q, f, f)``.
+    valid : numpy.ndarray
+        Boolean mask of real candidates (FAISS pads with ``-1``), ``(q, f)``.
+    k : int
+        Number of candidates to select per query.
+    lambda_mult : float
+        0 = maximum diversity, 1 = maximum relevance.
+
+    Returns
+    -------
+    list of list of int
+        Selected candidate positions per query, in selection order.
+    """
+    q, f = query_similarity.shape
+    rows = np.arange(q)
+    available = valid.copy()
+    n_select = np.minimum(k, valid.sum(axis=1))
+    selected = np.full((q, max(k, 0)), -1, dtype=np.int64)
+    max_redundancy = np.full((q, f), -np.inf, dtype=np.float32)
+
+    for step in range(min(k, f)):
+        active = n_select > step
+        if not active.any():
+            break
+        if step == 0:
+            score = np.where(available, query_similarity, -np.inf)
+        else:
+            score = lambda_mult * query_similarity - (1 - lambda_mult) * max_redundancy
+            score = np.where(available, score, -np.inf)
+        pick = np.argmax(score, axis=1)
+        selected[active, step] = pick[active]
+        available[rows, pick] = False
+        max_redundancy = np.maximum(max_redundancy, candidate_similarity[rows, :, pick])
+
+    return [list(selected[i, : n_select[i]]) for i in range(q)]
+
+
+def mmr_search_by_vectors(
+    vector_store,
+    query_vectors: np.ndarray,
+    k: int = 4,
+    fetch_k: int = 20,
+    lambda_mult: float = 0.5,
+    search: Optional[Callable[[np.ndarray, int], Tuple[np.ndarray, np.ndarray]]] = None,
+) -> List[List[Tuple[Document, float]]]:
+    """Run MMR for a batch of query vectors against a FAISS store.
+
+    Parameters
+    ----------
+    vector_store : FAISS
+        LangChain FAISS store.
+    query_vectors : numpy.ndarray
+        Query embeddings, shape ``(q, d)``.
+    k : int, optional
+        Number of documents returned per query.
+    fetch_k : int, optional
+        Number of nearest candidates re-ranked by MMR.
+    lambda_mult : float, optional
+        0 = maximum diversity, 1 = maximum relevance.
+    search : callable, optional
+        ``search(queries, fetch_k) -> (distances, positions)`` used to fetch
+        the candidates (e.g. a metadata-filtered search); defaults to
+        ``vector_store.index.search``.
+
+    Returns
+    -------
+    list of list of (Document, float)
+        Per query, the selected documents with their FAISS distance; empty
+        lists when the store is empty.
+    """
+    queries = np.ascontiguousarray(np.atleast_2d(query_vectors), dtype=np.float32)
+    index = vector_store.index
+    if index.ntotal == 0:
+        return [[] for _ in queries]
+    fetch_k = max(1, min(fetch_k, index.ntotal))
+    scores, indices = (search or index.search)(queries, fetch_k)
+    valid = indices >= 0
+    normalized_queries = _normalize(queries)
+
+    # Blocchi di query per limitare la matrice (q, f, f) a ~256 MB
+    block = max(1, _MAX_BLOCK_FLOATS // (fetch_k * fetch_k))
+    picks: List[List[int]] = []
+    with stage("mmr.select"):
+        for start in range(0, len(queries), block):
+            rows = slice(start, start + block)
+            positions = np.where(valid[rows], indices[rows], 0)
+            candidates = candidate_vectors(index, positions)                            # (q, f, d)
+            query_similarity = np.einsum("qfd,qd->qf", candidates, normalized_queries[rows])
+            candidate_similarity = candidates @ candidates.transpose(0, 2, 1)           # (q, f, f)
+            picks.extend(mmr_select(query_similarity, candidate_similarity, valid[rows], k, lambda_mult))
+
+    results = []
+    with stage("docstore.lookup"):
+        for qi, selected in enumerate(picks):
+            docs = []
+            for pick in selected:
+                doc_id = vector_store.index_to_docstore_id[int(indices[qi, pick])]
+                doc = vector_store.docstore.search(doc_id)
+                if not isinstance(doc, Document):
+                    raise ValueError(f"Could not find document for id {doc_id}, got {doc}")
+                docs.append((doc, float(scores[qi, pick])))
+            results.append(docs)
+    return results
+
@@ -0,0 +1,276 @@
+"""Scalar-quantized vector storage with full-precision re-ranking.
+
+With ``Settings.vector_storage`` set to ``"float16"`` or ``"int8"`` the FAISS
+index keeps 2 or 1 bytes per dimension instead of 4 (see
+``ann_index.create_index``). The float32 vectors are also written to
+``vectors.npy`` in the index directory, one row per FAISS position, and
+opened with mmap: ``RerankedIndex`` fetches ``k * rerank_factor`` candidates
+from the quantized index and re-ranks them by exact distance, reading only
+those rows from disk. Resident memory is the quantized codes plus the pages
+of the candidates actually touched.
+
+``storage_report`` measures memory and recall@k of every storage mode
+against exact float32 search::
+
+    python -m rag_or_search.tools.quantization --chunks 20000 --dim 1536
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+
+from .filters import exact_search, filtered_index_search
+
+FULL_VECTORS_FILE = "vectors.npy"
+
+
+def save_full_vectors(vectors: np.ndarray, persist_dir: str) -> None:
+    """Atomically write the float32 vectors of a store, in position order."""
+    path = Path(persist_dir)
+    path.mkdir(parents=True, exist_ok=True)
+    tmp_path = path / f".{FULL_VECTORS_FILE}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.ascontiguousarray(vectors, dtype=np.float32))
+    os.replace(tmp_path, path / FULL_VECTORS_FILE)
+
+
+def load_full_vectors(persist_dir: str, count: int) -> Optional[np.ndarray]:
+    """Open ``vectors.npy`` with mmap, or ``None`` if missing or not ``count`` rows."""
+    path = Path(persist_dir) / FULL_VECTORS_FILE
+    if not path.exists():
+        return None
+    vectors = np.load(path, mmap_mode="r")
+    return vectors if len(vectors) == count else None
+
+
+def realign_full_vectors(
+    persist_dir: str,
+    old_ids: Sequence[str],
+    new_ids: Sequence[str],
+    added: Dict[str, Sequence[float]],
+) -> None:
+    """Rewrite ``vectors.npy`` after an incremental update moved positions.
+
+    Parameters
+    ----------
+    persist_dir : str
+        Index directory.
+    old_ids, new_ids : sequence of str
+        Docstore id of each position before and after the update.
+    added : dict
+        Vectors of the chunks added by the update, by id.
+    """
+    old = load_full_vectors(persist_dir, len(old_ids))
+    if old is None:
+        return
+    row_of = {doc_id: row for row, doc_id in enumerate(old_ids)}
+    vectors = np.empty((len(new_ids), old.shape[1]), dtype=np.float32)
+    for position, doc_id in enumerate(new_ids):
+        row = row_of.get(doc_id)
+        vectors[position] = old[row] if row is not None else added[doc_id]
+    del old
+    save_full_vectors(vectors, persist_dir)
+
+
+class RerankedIndex:
+    """Quantized index whose candidates are re-ranked on full-precision vectors.
+
+    Implements the part of the ``faiss.Index`` API used by the retrieval
+    code; ``reconstruct*`` return the exact float32 vectors.
+
+    Parameters
+    ----------
+    base_index : faiss.Index
+        The quantized index.
+    full_vectors : numpy.ndarray
+        Float32 vectors (usually a memmap), one row per position.
+    factor : int
+        Candidates fetched per result before re-ranking.
+    """
+
+    def __init__(self, base_index: faiss.Index, full_vectors: np.ndarray, factor: int):
+        self.base_index = base_index
+        self.full_vectors = full_vectors
+        self.factor = max(1, factor)
+        self.d = base_index.d
+        self.metric_type = base_index.metric_type
+        self.is_trained = True
+
+    @property
+    def ntotal(self) -> int:
+        return self.base_index.ntotal
+
+    def _rerank(self, queries: np.ndarray, candidates: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        inner_product = self.metric_type == faiss.METRIC_INNER_PRODUCT
+        distances = np.full((len(queries), k), -np.inf if inner_product else np.inf, dtype=np.float32)
+        labels = np.full((len(queries), k), -1, dtype=np.int64)
+        for row, (query, ids) in enumerate(zip(queries, candidates)):
+            ids = ids[ids >= 0]
+            if not len(ids):
+                continue
+            # Solo le righe dei candidati vengono lette dal file mappato (in ordine, per località)
+            order = np.argsort(ids)
+            vectors = self.full_vectors[ids[order]]
+            if inner_product:
+                exact = vectors @ query
+                best = np.argsort(-exact, kind="stable")[:k]
+            else:
+                exact = ((vectors - query) ** 2).sum(axis=1)
+                best = np.argsort(exact, kind="stable")[:k]
+            distances[row, :len(best)] = exact[best]
+            labels[row, :len(best)] = ids[order][best]
+        return distances, labels
+
+    def search(self, x: np.ndarray, k: int, params=None) -> Tuple[np.ndarray, np.ndarray]:
+        """Search the quantized index for ``k * factor`` candidates and re-rank them."""
+        queries = np.ascontiguousarray(np.atleast_2d(x), dtype=np.float32)
+        _, candidates = self.base_index.search(queries, k * self.factor, params=params)
+        return self._rerank(queries, candidates, k)
+
+    def search_positions(
+        self, queries: np.ndarray, k: int, positions: np.ndarray, exact_max: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Filtered search (see ``filters``) with full-precision re-ranking."""
+        if len(positions) <= exact_max:
+            return exact_search(self, queries, positions, k)
+        _, candidates = filtered_index_search(self.base_index, queries, k * self.factor, positions, exact_max)
+        return self._rerank(queries, candidates, k)
+
+    def reconstruct(self, key: int) -> np.ndarray:
+        return np.array(self.full_vectors[key], dtype=np.float32)
+
+    def reconstruct_batch(self, keys: np.ndarray) -> np.ndarray:
+        return np.asarray(self.full_vectors[np.asarray(keys, dtype=np.int64)], dtype=np.float32)
+
+    def reconstruct_n(self, i0: int, ni: int) -> np.ndarray:
+        return np.array(self.full_vectors[i0:i0 + ni], dtype=np.float32)
+
+
+def with_rerank(vector_store, persist_dir: str, factor: int):
+    """Wrap the index of ``vector_store`` in a ``RerankedIndex``, in place.
+
+    Nothing changes when ``factor`` is below 1, the index is already wrapped,
+    or ``persist_dir`` has no up-to-date ``vectors.npy``.
+
+    Returns
+    -------
+    FAISS
+        ``vector_store`` itself.
+    """
+    index = vector_store.index
+    if factor < 1 or isinstance(index, RerankedIndex):
+        return vector_store
+    full_vectors = load_full_vectors(persist_dir, index.ntotal)
+    if full_vectors is not None:
+        vector_store.index = RerankedIndex(index, full_vectors, factor)
+    return vector_store
+
+
+def index_bytes(index: faiss.Index) -> int:
+    """Size of ``index`` once serialized, a proxy for its resident memory."""
+    return int(faiss.serialize_index(index).size)
+
+
+def storage_report(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    settings,
+    k: int = 10,
+    storages: Sequence[str] = ("float32", "float16", "int8"),
+    rerank_factors: Sequence[int] = (0, 4),
+) -> List[Dict[str, float]]:
+    """Compare memory and recall@k of the storage modes for ``settings.index_type``.
+
+    Parameters
+    ----------
+    vectors : numpy.ndarray
+        Corpus vectors, shape ``(n, d)``.
+    queries : numpy.ndarray
+        Query vectors, shape ``(q, d)``.
+    settings : Settings
+        Index configuration; ``vector_storage`` is overridden per row.
+    k : int, optional
+        Neighbours compared against exact float32 search.
+    storages : sequence of str, optional
+        Storage modes to evaluate.
+    rerank_factors : sequence of int, optional
+        Re-ranking factors evaluated for quantized modes (0 = none).
+
+    Returns
+    -------
+    list of dict
+        One row per configuration with ``storage``, ``rerank_factor``,
+        ``index_bytes``, ``bytes_per_vector``, ``memory_ratio`` (float32
+        index / this index), ``recall_at_k`` and ``latency_ms``.
+    """
+    from dataclasses import replace
+
+    from .ann_index import create_index
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    rows = []
+    baseline = None
+    for storage in storages:
+        index = create_index(vectors, replace(settings, vector_storage=storage))
+        size = index_bytes(index)
+        baseline = baseline or size
+        for factor in (rerank_factors if storage != "float32" else (0,)):
+            searcher = RerankedIndex(index, vectors, factor) if factor else index
+            start = time.perf_counter()
+            _, found = searcher.search(queries, k)
+            latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+            hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+            rows.append({
+                "storage": storage,
+                "rerank_factor": factor,
+                "index_bytes": size,
+                "bytes_per_vector": size / len(vectors),
+                "memory_ratio": baseline / size,
+                "recall_at_k": hits / (k * len(queries)),
+                "latency_ms": latency_ms,
+            })
+    return rows
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """Print ``storage_report`` on a synthetic corpus."""
+    from .benchmark import HashingEmbeddings, make_queries, synthetic_corpus
+    from .rag_utils import Settings
+
+    parser = argparse.ArgumentParser(description="Memory and recall of quantized vector storage.")
+    parser.add_argument("--chunks", type=int, default=20_000, help="Corpus size.")
+    parser.add_argument("--dim", type=int, default=1536, help="Embedding dimension.")
+    parser.add_argument("--queries", type=int, default=200, help="Evaluation queries.")
+    parser.add_argument("--k", type=int, default=10, help="Neighbours compared (recall@k).")
+    parser.add_argument("--index-type", default="flat", help="flat, ivf or hnsw.")
+    parser.add_argument("--rerank-factor", type=int, default=4, help="Candidates per result re-ranked.")
+    args = parser.parse_args(argv)
+
+    embeddings = HashingEmbeddings(args.dim)
+    docs = synthetic_corpus(args.chunks)
+    vectors = np.asarray(embeddings.embed_documents([d.page_content for d in docs]), dtype=np.float32)
+    queries = np.asarray(embeddings.embed_documents(make_queries(docs, args.queries)), dtype=np.float32)
+    settings = Settings(index_type=args.index_type, embedding_cache_dir=None)
+    rows = storage_report(vectors, queries, settings, k=args.k, rerank_factors=(0, args.rerank_factor))
+    print(f"{'storage':8} {'rerank':>6} {'bytes/vec':>10} {'memoria':>8} {'recall@k':>9} {'ms/query':>9}")
+    for row in rows:
+        print(
+            f"{row['storage']:8} {row['rerank_factor']:>6} {row['bytes_per_vector']:>10.0f} "
+            f"{row['memory_ratio']:>7.2f}x {row['recall_at_k']:>9.4f} {row['latency_ms']:>9.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
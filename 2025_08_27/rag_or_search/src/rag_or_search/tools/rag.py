@@ -2,12 +2,17 @@
 
 Accepts a question and a ``k`` value to retrieve top-k contexts from a local
 vector store. Useful as an agent tool step before generation.
+
+``_arun`` is the non-blocking variant used by async crews: the query is
+embedded with the async embeddings client and the FAISS search runs in the
+engine's worker pool, so several agents and crews in one process can query
+concurrently.
 """
 
 from typing import Type, List
 from crewai.tools import BaseTool
 from pydantic import BaseModel, Field
-from .rag_utils import rag_search
+from .rag_utils import arag_search, rag_search
 
 class RagToolInput(BaseModel):
 	"""Input schema for ``RagTool``.
@@ -64,3 +69,27 @@ class RagTool(BaseTool):
 		results = rag_search(question, k=k)
 		
 		return results
+
+	async def _arun(self, question: str, k: int) -> List[str]:
+		"""Run retrieval asynchronously with the provided inputs.
+
+		Parameters
+		----------
+		question : str
+			The query to retrieve contexts for.
+		k : int
+			Number of contexts to retrieve.
+
+		Returns
+		-------
+		dict
+			Mapping of ``source`` to ``page_content``.
+
+		Raises
+		------
+		ValueError
+			If ``question`` is empty.
+		"""
+		if not question:
+			raise ValueError("Please provide a question for RAG search.")
+		return await arag_search(question, k=k)
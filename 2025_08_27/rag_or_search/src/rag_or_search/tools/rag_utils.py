@@ -5,11 +5,13 @@ from __future__ import annotations
 This module centralizes helpers to:
 
 - Initialize embeddings and a chat model (Azure OpenAI compatible)
-- Load or simulate documents
+- Load (or stream) or simulate documents
 - Split documents into chunks
 - Build or load a FAISS vector store
 - Configure a retriever and format contexts for prompts
-- Execute basic RAG retrieval flows
+- Execute basic RAG retrieval flows, one question at a time or in batches
+- Keep a process-wide warm engine (``RagEngine``) for repeated retrievals
+- Record per-stage retrieval metrics (see ``metrics``)
 
 Notes
 -----
@@ -18,15 +20,25 @@ These utilities expect Azure OpenAI environment variables to be configured
 deployment). When running locally, secrets may be prompted via ``getpass``.
 """
 
+import asyncio
+import hashlib
+import json
+import logging
 import os
-from dataclasses import dataclass
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from itertools import islice
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
 
 import faiss
+import numpy as np
 from langchain.schema import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_openai import AzureOpenAIEmbeddings
 
 # Chat model init (provider-agnostic, qui puntiamo a LM Studio via OpenAI-compatible)
@@ -34,12 +46,31 @@ from langchain.chat_models import init_chat_model
 from dotenv import load_dotenv
 import getpass
 
+from .ann_index import configure_search, rebuild_index
+from .embedding_cache import CachedEmbeddings, EmbeddingCache
+from .index_store import INDEX_FILE, STORE_FILE, save_store, store_exists
+from .ingest import EmbeddingReport, embed_chunks
+from .incremental import (
+    build_manifest, drop_deltas, iter_chunk_ids, load_live_store, load_manifest, save_manifest, update_vectorstore,
+)
+from .lexical import build_lexical_index, lexical_index_for
+from .metrics import METRICS, configure_metrics, stage, timed
+from .quantization import FULL_VECTORS_FILE, save_full_vectors, with_rerank
+from .retriever import FaissRetriever
+from .semantic_cache import SemanticCache
+from .sharding import (
+    SHARDS_FILE, partition_chunks, remove_stale_shards, shard_dir, sharded_store, write_shards_file,
+)
+from .splitter import FastRecursiveSplitter
+
 # =========================
 # Configurazione
 # =========================
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 @dataclass
 class Settings:
     """Configuration values for RAG utilities.
@@ -53,15 +84,93 @@ class Settings:
     chunk_overlap : int
         Overlap between adjacent chunks to preserve context.
     search_type : str
-        Retrieval mode, ``"mmr"`` or ``"similarity"``.
+        Retrieval mode, ``"mmr"``, ``"similarity"`` or ``"hybrid"`` (vector
+        and BM25 results fused by reciprocal rank).
     k : int
         Number of final retrieved documents.
     fetch_k : int
-        Initial candidate pool size for MMR.
+        Initial candidate pool size for MMR; in hybrid mode, candidates taken
+        from each of the vector and lexical rankings.
     mmr_lambda : float
         Trade-off for MMR, 0=max diversity, 1=max relevance.
+    rrf_k : int
+        Rank offset of reciprocal-rank fusion in hybrid mode.
+    filter_exact_max : int
+        Metadata-filtered searches over at most this many chunks scan just
+        those vectors exactly; larger subsets use the ANN index with an ID
+        selector.
+    shards : int
+        Number of on-disk shards; above 1 chunks are partitioned by source
+        across ``persist_dir/shard-XXX`` and searched in parallel (see
+        ``sharding``).
+    shard_workers : int or None
+        Threads searching the shards; defaults to ``shards``.
+    search_workers : int
+        Threads of ``RagEngine``'s worker pool, where the async API runs
+        FAISS searches (and index loads) off the event loop.
     lmstudio_model_env : str
         Environment variable name holding the Azure OpenAI deployment name.
+    embedding_cache_dir : str or None
+        Directory of the persistent embedding cache; ``None`` disables it.
+    embedding_cache_max_mb : int
+        Size bound of the embedding cache vectors file, in megabytes.
+    incremental : bool
+        Diff the persisted index against the current documents on load and
+        embed only the chunks that changed.
+    delta_compact_ratio : float
+        Incremental updates are persisted as delta segments and tombstones;
+        once they exceed this fraction of the base store it is rewritten
+        with them folded in (see ``incremental``).
+    index_type : str
+        FAISS index family: ``"flat"`` (exact), ``"ivf"``, ``"hnsw"`` or
+        ``"ivfpq"``.
+    ivf_nlist : int
+        Number of IVF centroids (capped by the corpus size).
+    nprobe : int
+        IVF lists visited per query; higher is slower and more accurate.
+    hnsw_m : int
+        HNSW graph degree.
+    ef_construction : int
+        HNSW beam width while building.
+    ef_search : int
+        HNSW beam width at query time.
+    pq_m : int
+        Number of PQ sub-quantizers; must divide the embedding dimension.
+    pq_nbits : int
+        Bits per PQ sub-quantizer code.
+    vector_storage : str
+        Precision of the vectors kept in the index: ``"float32"``,
+        ``"float16"`` (half the memory) or ``"int8"`` (a quarter); not
+        applicable to ``"ivfpq"``. Quantized stores also write the float32
+        vectors to disk for re-ranking.
+    rerank_factor : int
+        With quantized storage, candidates fetched per result and re-ranked
+        against the memory-mapped float32 vectors; ``0`` disables re-ranking.
+    train_sample : int
+        Maximum number of vectors used to train IVF/PQ indexes.
+    embed_batch_size : int
+        Chunks per embedding request during index builds.
+    embed_concurrency : int
+        Maximum concurrent embedding requests.
+    embed_max_retries : int
+        Retries per batch on throttling (HTTP 429) or connection errors.
+    response_cache_threshold : float or None
+        Cosine similarity above which ``RagEngine.search`` serves a query
+        from the semantic response cache (e.g. ``0.95``); ``None``, the
+        default, disables the cache, so results always reflect a fresh
+        retrieval unless a caller opts in.
+    response_cache_ttl : float or None
+        Lifetime of cached responses in seconds; ``None`` never expires.
+    response_cache_size : int
+        Maximum number of cached responses.
+    metrics_exporter : str or None
+        Where ``RagEngine`` exports per-stage timings and counters:
+        ``"logging"``, ``"json"`` or ``"prometheus"`` (see ``metrics``);
+        ``None`` leaves the instrumentation disabled.
+    metrics_path : str or None
+        Output file of the ``"json"`` and ``"prometheus"`` exporters.
+    metrics_interval : float
+        Minimum seconds between two exports.
     """
 
     # Persistenza FAISS
@@ -70,30 +179,84 @@ class Settings:
     chunk_size: int = 1000
     chunk_overlap: int = 100
     # Retriever (MMR)
-    search_type: str = "mmr"        # "mmr" o "similarity"
+    search_type: str = "mmr"        # "mmr", "similarity" o "hybrid"
     k: int = 1                      # risultati finali
     fetch_k: int = 20               # candidati iniziali (per MMR)
     mmr_lambda: float = 1         # 0 = diversificazione massima, 1 = pertinenza massima
+    rrf_k: int = 60                 # fusione ibrida vettoriale + BM25
+    filter_exact_max: int = 20_000  # filtri sui metadati: ricerca esatta sotto questa soglia
+    # Shard su disco (1 = indice unico)
+    shards: int = 1
+    shard_workers: Optional[int] = None
+    # Pool dei worker per la ricerca FAISS nell'API async
+    search_workers: int = 8
     # LM Studio (OpenAI-compatible)
     lmstudio_model_env: str = "MODEL"  # nome del modello in LM Studio, via env var
+    # Cache persistente degli embedding (None = disabilitata)
+    embedding_cache_dir: Optional[str] = "embedding_cache"
+    embedding_cache_max_mb: int = 512
+    # Aggiornamento incrementale dell'indice (solo chunk nuovi/rimossi)
+    incremental: bool = False
+    delta_compact_ratio: float = 0.2  # segmenti + tombstone oltre cui si compatta
+    # Tipo di indice FAISS: "flat", "ivf", "hnsw", "ivfpq"
+    index_type: str = "flat"
+    ivf_nlist: int = 1024
+    nprobe: int = 16
+    hnsw_m: int = 32
+    ef_construction: int = 80
+    ef_search: int = 64
+    pq_m: int = 64
+    pq_nbits: int = 8
+    train_sample: int = 100_000
+    # Precisione dei vettori nell'indice: "float32", "float16", "int8"
+    vector_storage: str = "float32"
+    rerank_factor: int = 4          # 0 = nessun re-ranking sui vettori float32
+    # Embedding in batch durante la costruzione dell'indice
+    embed_batch_size: int = 64
+    embed_concurrency: int = 4
+    embed_max_retries: int = 6
+    # Cache semantica delle risposte (None = disabilitata, opt-in con es. 0.95)
+    response_cache_threshold: Optional[float] = None
+    response_cache_ttl: Optional[float] = 3600.0
+    response_cache_size: int = 1024
+    # Metriche per fase (None = disabilitate)
+    metrics_exporter: Optional[str] = None
+    metrics_path: Optional[str] = None
+    metrics_interval: float = 60.0
 
 
 
 SETTINGS = Settings()
 
+# Separatore delle sezioni nei file Markdown
+MD_SECTION_DELIMITER = "---"
+# Separatori dello splitter, dal più al meno strutturale
+SPLIT_SEPARATORS = [
+    "\n\n", "\n", ". ", "? ", "! ", "; ", ": ",
+    ", ", " ", ""  # fallback aggressivo
+]
+
 
 # =========================
 # Componenti di base
 # =========================
 
-def get_embeddings():
+@timed("embeddings.init")
+def get_embeddings(settings: Optional[Settings] = None):
     """Initialize Azure OpenAI embeddings client.
 
-    Prompts for a key if ``AZURE_API_KEY`` is not set.
+    Prompts for a key if ``AZURE_API_KEY`` is not set. When ``settings``
+    enables the embedding cache, the client is wrapped so that documents and
+    queries already embedded with the same deployment are read from disk.
+
+    Parameters
+    ----------
+    settings : Settings, optional
+        Configuration providing the embedding cache options.
 
     Returns
     -------
-    AzureOpenAIEmbeddings
+    AzureOpenAIEmbeddings or CachedEmbeddings
         Configured embeddings instance.
     """
 
@@ -102,12 +265,20 @@ def get_embeddings():
             "Enter your AzureOpenAI API key: "
         )
     
-    return AzureOpenAIEmbeddings(
+    embeddings = AzureOpenAIEmbeddings(
         azure_deployment=os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT"),
         azure_endpoint=os.getenv("AZURE_API_BASE"),
         openai_api_key=os.getenv("AZURE_API_KEY"),
         openai_api_version=os.getenv("AZURE_API_VERSION"),
     )
+    if settings is None or not settings.embedding_cache_dir:
+        return embeddings
+
+    cache = EmbeddingCache(
+        settings.embedding_cache_dir,
+        max_bytes=settings.embedding_cache_max_mb * 1024 * 1024,
+    )
+    return CachedEmbeddings(embeddings, cache, model=os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT") or "default")
 
 
 def get_llm_from_lmstudio(settings: Settings):
@@ -182,23 +353,85 @@ def load_md_documents(file_path: str) -> List[Document]:
     FileNotFoundError
         If the path does not exist.
     """
-    documents = []
+    return list(iter_md_documents(file_path))
+
+
+def iter_sections(stream, buffer_size: int = 1 << 20, delimiter: str = MD_SECTION_DELIMITER) -> Iterator[str]:
+    """Yield the sections of a text stream as ``str.split(delimiter)`` would.
+
+    The stream is read in blocks of ``buffer_size`` characters and each
+    section is yielded as soon as its closing delimiter is read, so memory is
+    bounded by the largest section rather than by the stream size.
+
+    Parameters
+    ----------
+    stream : io.TextIOBase
+        Text stream to scan.
+    buffer_size : int, optional
+        Characters read per block.
+    delimiter : str, optional
+        Section delimiter.
+
+    Yields
+    ------
+    str
+        Sections in order, including empty ones.
+    """
+    parts: List[str] = []
+    carry = ""
+    while True:
+        block = stream.read(buffer_size)
+        if not block:
+            break
+        text = carry + block
+        start = 0
+        while True:
+            end = text.find(delimiter, start)
+            if end == -1:
+                break
+            parts.append(text[start:end])
+            yield "".join(parts)
+            parts = []
+            start = end + len(delimiter)
+        # Gli ultimi caratteri potrebbero essere l'inizio di un delimitatore a cavallo tra due blocchi
+        keep = max(start, len(text) - len(delimiter) + 1)
+        parts.append(text[start:keep])
+        carry = text[keep:]
+    parts.append(carry)
+    yield "".join(parts)
+
+
+def iter_md_documents(file_path: str, buffer_size: int = 1 << 20) -> Iterator[Document]:
+    """Stream a Markdown file as one ``Document`` per "---" section.
+
+    Same documents and metadata as ``load_md_documents``, yielded while the
+    file is being read so they can be split and embedded right away.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the Markdown file.
+    buffer_size : int, optional
+        Characters read per block.
+
+    Yields
+    ------
+    Document
+        Non-empty sections with ``source`` and ``section`` metadata.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the path does not exist.
+    """
     if not os.path.isfile(file_path):
         raise FileNotFoundError(f"File not found: {file_path}")
 
+    source = os.path.basename(file_path)
     with open(file_path, "r", encoding="utf-8") as f:
-        content = f.read()
-
-    documents = [
-        Document(
-            page_content=section,
-            metadata={"source": os.path.basename(file_path), "section": i}
-        )
-        for i, section in enumerate(content.split("---"), start=1)
-        if section.strip()
-    ]
-    
-    return documents
+        for i, section in enumerate(iter_sections(f, buffer_size), start=1):
+            if section.strip():
+                yield Document(page_content=section, metadata={"source": source, "section": i})
     
 
 def simulate_corpus() -> List[Document]:
@@ -260,45 +493,150 @@ def split_documents(docs: List[Document], settings: Settings) -> List[Document]:
     list of Document
         The resulting chunks.
     """
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=settings.chunk_size,
-        chunk_overlap=settings.chunk_overlap,
-        separators=[
-            "\n\n", "\n", ". ", "? ", "! ", "; ", ": ",
-            ", ", " ", ""  # fallback aggressivo
-        ],
-    )
-    return splitter.split_documents(docs)
+    return _make_splitter(settings).split_documents(docs)
+
+
+def iter_split_documents(docs: Iterable[Document], settings: Settings) -> Iterator[Document]:
+    """Split documents one at a time, e.g. as streamed by ``iter_md_documents``.
+
+    Yields the same chunks as ``split_documents`` without materializing the
+    input.
+
+    Parameters
+    ----------
+    docs : iterable of Document
+        Input documents, consumed lazily.
+    settings : Settings
+        Chunking configuration.
+
+    Yields
+    ------
+    Document
+        The resulting chunks, in order.
+    """
+    splitter = _make_splitter(settings)
+    for doc in docs:
+        yield from splitter.split_documents([doc])
+
 
+def _make_splitter(settings: Settings) -> FastRecursiveSplitter:
+    # Stessi chunk di RecursiveCharacterTextSplitter, senza ricorsione su sottostringhe
+    return FastRecursiveSplitter(settings.chunk_size, settings.chunk_overlap, SPLIT_SEPARATORS)
 
-def build_faiss_vectorstore(chunks: List[Document], embeddings, persist_dir: str) -> FAISS:
+
+def build_faiss_vectorstore(
+    chunks: Iterable[Document], embeddings, persist_dir: str, settings: Optional[Settings] = None
+) -> FAISS:
     """Build and persist a FAISS index from document chunks.
 
     Parameters
     ----------
-    chunks : list of Document
-        Documents to index.
+    chunks : iterable of Document
+        Documents to index, consumed lazily (e.g. ``iter_split_documents``
+        over ``iter_md_documents``).
     embeddings : Any
         Embeddings model used by FAISS.
     persist_dir : str
         Directory to persist the index.
+    settings : Settings, optional
+        Selects the index family (``index_type``) and the embedding batch
+        options; defaults to ``Settings()``.
 
     Returns
     -------
     FAISS
         The created vector store instance.
+
+    Raises
+    ------
+    ValueError
+        If ``chunks`` is empty.
+
+    Notes
+    -----
+    Chunks are stored under their content fingerprint and a manifest is
+    written next to the index, so that later incremental updates can diff
+    against it. With ``search_type="hybrid"`` the BM25 lexical index of the
+    same chunks is built and persisted too. With quantized
+    ``vector_storage`` the float32 vectors are saved for re-ranking (see
+    ``quantization``).
+
+    Chunks are consumed in fixed-size steps of ``embed_batch_size *
+    embed_concurrency``: each step is embedded in batches with bounded
+    concurrency (see ``ingest.embed_chunks``) and added to the index before
+    the next one is read, so only one step of chunks and vectors is pending
+    at a time. Completed batches are checkpointed under ``persist_dir`` so
+    that an interrupted build resumes where it stopped.
     """
-    # Determina la dimensione dell'embedding
-    vs = FAISS.from_documents(
-        documents=chunks,
-        embedding=embeddings
-    )
+    settings = settings or Settings()
+    checkpoint_dir = Path(persist_dir) / "embed_checkpoint"
+    step = settings.embed_batch_size * max(1, settings.embed_concurrency)
+    report = EmbeddingReport()
+
+    vs = None
+    pending = iter_chunk_ids(chunks)
+    while True:
+        batch = list(islice(pending, step))
+        if not batch:
+            break
+        texts = [d.page_content for _, d in batch]
+        vectors, batch_report = embed_chunks(
+            texts,
+            embeddings,
+            batch_size=settings.embed_batch_size,
+            max_workers=settings.embed_concurrency,
+            max_retries=settings.embed_max_retries,
+            checkpoint_dir=str(checkpoint_dir),
+        )
+        report.add(batch_report)
+        if vs is None:
+            # Stesso indice esatto di FAISS.from_embeddings
+            vs = FAISS(
+                embedding_function=embeddings,
+                index=faiss.IndexFlatL2(vectors.shape[1]),
+                docstore=InMemoryDocstore(),
+                index_to_docstore_id={},
+            )
+        vs.add_embeddings(
+            list(zip(texts, vectors)), metadatas=[d.metadata for _, d in batch], ids=[i for i, _ in batch]
+        )
+    if vs is None:
+        raise ValueError("No chunks to index")
+    logger.info("%s", report)
+
+    full_vectors = None
+    if settings.vector_storage != "float32":
+        full_vectors = vs.index.reconstruct_n(0, vs.index.ntotal)
+    if settings.index_type != "flat" or settings.vector_storage != "float32":
+        rebuild_index(vs, settings)
+
+    save_store(vs, persist_dir)
+    drop_deltas(persist_dir)
+    chunks_by_id = {doc_id: vs.docstore.search(doc_id) for doc_id in vs.index_to_docstore_id.values()}
+    save_manifest(build_manifest(chunks_by_id), persist_dir)
+    if full_vectors is not None:
+        save_full_vectors(full_vectors, persist_dir)
+    else:
+        (Path(persist_dir) / FULL_VECTORS_FILE).unlink(missing_ok=True)
+    if settings.search_type == "hybrid":
+        build_lexical_index(vs, persist_dir)
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    return _with_rerank(vs, persist_dir, settings)
+
 
-    Path(persist_dir).mkdir(parents=True, exist_ok=True)
-    vs.save_local(persist_dir)
-    return vs
+def _with_rerank(vs: FAISS, persist_dir: str, settings: Settings) -> FAISS:
+    # Storage quantizzato: i candidati si riordinano sui vettori float32 mappati da disco
+    if settings.vector_storage == "float32":
+        return vs
+    return with_rerank(vs, persist_dir, settings.rerank_factor)
 
 
+def _load_store(persist_dir: str, embeddings, settings: Settings) -> FAISS:
+    # Store di base con i segmenti delta degli aggiornamenti incrementali
+    return load_live_store(persist_dir, embeddings, wrap_base=lambda vs: _with_rerank(vs, persist_dir, settings))
+
+
+@timed("index.load")
 def load_or_build_vectorstore(settings: Settings, embeddings, docs: List[Document]) -> FAISS:
     """Load a persisted FAISS index or build one from documents.
 
@@ -315,21 +653,152 @@ def load_or_build_vectorstore(settings: Settings, embeddings, docs: List[Documen
     -------
     FAISS
         Loaded or newly built vector store.
+
+    Notes
+    -----
+    The index is opened with mmap and documents are materialized lazily (see
+    ``index_store``). Legacy ``index.pkl`` indexes are unpickled once and
+    converted to that format.
+
+    With ``settings.incremental`` the loaded index is diffed against
+    ``docs`` and only new or removed chunks are embedded or deleted; the
+    change is persisted as a delta segment (see ``incremental``). Indexes
+    persisted without a manifest are rebuilt once.
+
+    With quantized ``settings.vector_storage`` the index is wrapped to
+    re-rank candidates on full-precision vectors (``settings.rerank_factor``).
+
+    With ``settings.shards > 1`` see ``load_or_build_sharded_vectorstore``.
     """
+    if settings.shards > 1:
+        return load_or_build_sharded_vectorstore(settings, embeddings, docs)
+
     persist_path = Path(settings.persist_dir)
     index_file = persist_path / "index.faiss"
     meta_file = persist_path / "index.pkl"
 
-    if index_file.exists() and meta_file.exists():
-        # Dal 2024/2025 molte build richiedono il flag 'allow_dangerous_deserialization' per caricare pkl locali
-        return FAISS.load_local(
+    vs = None
+    if store_exists(settings.persist_dir):
+        vs = _load_store(settings.persist_dir, embeddings, settings)
+    elif index_file.exists() and meta_file.exists():
+        # Indice legacy: il pickle viene letto un'ultima volta e convertito nel formato mmap
+        legacy = FAISS.load_local(
             settings.persist_dir,
             embeddings,
             allow_dangerous_deserialization=True
         )
+        save_store(legacy, settings.persist_dir)
+        vs = _load_store(settings.persist_dir, embeddings, settings)
+
+    if vs is not None:
+        if not settings.incremental:
+            return vs
+        if load_manifest(settings.persist_dir) is not None:
+            update = update_vectorstore(
+                vs,
+                split_documents(docs, settings),
+                settings.persist_dir,
+                batch_size=settings.embed_batch_size,
+                max_workers=settings.embed_concurrency,
+                compact_ratio=settings.delta_compact_ratio,
+            )
+            if not update.changed:
+                return vs
+            return _load_store(settings.persist_dir, embeddings, settings)
+
+    return build_faiss_vectorstore(iter_split_documents(docs, settings), embeddings, settings.persist_dir, settings)
+
+
+DOCS_FINGERPRINT_FILE = "documents.sha256"
+
+
+def _documents_fingerprint(docs: Sequence[Document], settings: Settings) -> str:
+    # Testo, metadati e parametri di chunking: se coincidono, coincidono anche i chunk
+    digest = hashlib.sha256(json.dumps([settings.chunk_size, settings.chunk_overlap, SPLIT_SEPARATORS]).encode("utf-8"))
+    for doc in docs:
+        digest.update(doc.page_content.encode("utf-8"))
+        digest.update(b"\x00")
+        digest.update(json.dumps(doc.metadata, sort_keys=True, default=str).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+def _read_fingerprint(persist_dir: str) -> Optional[str]:
+    try:
+        return (Path(persist_dir) / DOCS_FINGERPRINT_FILE).read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return None
+
+
+def _write_fingerprint(persist_dir: str, fingerprint: str) -> None:
+    path = Path(persist_dir) / DOCS_FINGERPRINT_FILE
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(fingerprint, encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def load_or_build_sharded_vectorstore(settings: Settings, embeddings, docs: List[Document]) -> FAISS:
+    """Load or build a store partitioned into ``settings.shards`` shards.
+
+    Parameters
+    ----------
+    settings : Settings
+        Configuration including ``persist_dir`` and ``shards``.
+    embeddings : Any
+        Embeddings model for FAISS.
+    docs : list of Document
+        Documents to index.
 
-    chunks = split_documents(docs, settings)
-    return build_faiss_vectorstore(chunks, embeddings, settings.persist_dir)
+    Returns
+    -------
+    FAISS
+        Read-only combined store searched in parallel across shards.
+
+    Notes
+    -----
+    Documents (and so their chunks) are assigned to shards by a hash of
+    their ``source``. A shard whose documents, text and metadata, and
+    chunking parameters match the fingerprint recorded at its last build is
+    reopened with mmap without splitting anything; the others are split and
+    updated (``settings.incremental``, see ``incremental``) or rebuilt, so a
+    corpus change only splits and rebuilds the shards it touches.
+    """
+    # L'indice lessicale (hybrid) si costruisce sullo store combinato, non per shard
+    shard_settings = replace(settings, shards=1, search_type="similarity")
+    stores, present = [], []
+    for shard, shard_docs in enumerate(partition_chunks(docs, settings.shards)):
+        persist_dir = shard_dir(settings.persist_dir, shard)
+        fingerprint = _documents_fingerprint(shard_docs, settings)
+        manifest = load_manifest(persist_dir) if store_exists(persist_dir) else None
+        if manifest is None or _read_fingerprint(persist_dir) != fingerprint:
+            part = split_documents(shard_docs, settings)
+            if not part:
+                shutil.rmtree(persist_dir, ignore_errors=True)
+                continue
+            # Rimossa prima: uno shard scritto a metà non risulta mai invariato
+            (Path(persist_dir) / DOCS_FINGERPRINT_FILE).unlink(missing_ok=True)
+            if manifest is not None and settings.incremental:
+                # Rileva anche i chunk con gli stessi testi ma metadati diversi
+                update_vectorstore(
+                    _load_store(persist_dir, embeddings, settings),
+                    part,
+                    persist_dir,
+                    batch_size=settings.embed_batch_size,
+                    max_workers=settings.embed_concurrency,
+                    compact_ratio=settings.delta_compact_ratio,
+                )
+            else:
+                logger.info("Costruzione shard %d (%d chunk)", shard, len(part))
+                build_faiss_vectorstore(part, embeddings, persist_dir, replace(shard_settings, persist_dir=persist_dir))
+            _write_fingerprint(persist_dir, fingerprint)
+        # Ogni shard viene riaperto in mmap, anche dopo una ricostruzione
+        stores.append(_load_store(persist_dir, embeddings, settings))
+        present.append(shard)
+    if not stores:
+        raise ValueError("No chunks to index")
+    write_shards_file(settings.persist_dir, present)
+    remove_stale_shards(settings.persist_dir, present)
+    return sharded_store(stores, embeddings, max_workers=settings.shard_workers)
 
 
 def make_retriever(vector_store: FAISS, settings: Settings):
@@ -346,17 +815,38 @@ def make_retriever(vector_store: FAISS, settings: Settings):
     -------
     Any
         A retriever object compatible with LangChain.
+
+    Notes
+    -----
+    Query-time ANN parameters (``nprobe``, ``ef_search``) are applied to the
+    underlying index before wrapping it. MMR uses the vectorized
+    implementation in ``mmr``. The returned ``FaissRetriever`` also supports
+    ``batch_search`` for many questions at once.
+
+    ``"hybrid"`` loads the BM25 index persisted with each segment of the
+    store (base, delta segments, shards), building only the missing or
+    stale ones (see ``lexical``).
+
+    Searches can be restricted by metadata before scoring, e.g.
+    ``retriever.invoke(question, filter={"source": "guide.md"})`` (see
+    ``filters``).
     """
-    if settings.search_type == "mmr":
-        return vector_store.as_retriever(
-            search_type="mmr",
-            search_kwargs={"k": settings.k, "fetch_k": settings.fetch_k, "lambda_mult": settings.mmr_lambda},
-        )
-    else:
-        return vector_store.as_retriever(
-            search_type="similarity",
-            search_kwargs={"k": settings.k},
-        )
+    configure_search(vector_store.index, settings)
+    search_type = settings.search_type if settings.search_type in ("mmr", "hybrid") else "similarity"
+    lexical_index = None
+    if search_type == "hybrid":
+        lexical_index = lexical_index_for(vector_store)
+    # MMR vettoriale sui soli candidati ricostruiti (stessi risultati di LangChain)
+    return FaissRetriever(
+        vector_store=vector_store,
+        search_type=search_type,
+        k=settings.k,
+        fetch_k=settings.fetch_k,
+        lambda_mult=settings.mmr_lambda,
+        lexical_index=lexical_index,
+        rrf_k=settings.rrf_k,
+        filter_exact_max=settings.filter_exact_max,
+    )
 
 
 def format_docs_for_prompt(docs: List[Document]) -> str:
@@ -385,7 +875,29 @@ def rag_answer(question: str, chain) -> str:
     """
     return chain.invoke(question)
 
-def get_contexts_for_question(retriever, question: str, k: int) -> List[str]:
+def rag_answer_batch(questions: List[str], chain, max_concurrency: int = 8) -> List[str]:
+    """Execute a RAG chain for many questions with bounded concurrency.
+
+    Parameters
+    ----------
+    questions : list of str
+        The user queries.
+    chain : Any
+        A LangChain runnable supporting ``batch``.
+    max_concurrency : int, optional
+        Maximum number of questions processed at the same time.
+
+    Returns
+    -------
+    list of str
+        The generated answers, in the order of ``questions``.
+    """
+    return chain.batch(questions, config={"max_concurrency": max_concurrency})
+
+@timed("contexts.question")
+def get_contexts_for_question(
+    retriever, question: str, k: int, filter: Optional[Mapping[str, Any]] = None
+) -> List[str]:
     """Return the contents of the top-k retrieved chunks.
 
     Parameters
@@ -396,18 +908,359 @@ def get_contexts_for_question(retriever, question: str, k: int) -> List[str]:
         Query text.
     k : int
         Number of contexts to return.
+    filter : dict, optional
+        Metadata filter, e.g. ``{"source": "guide.md"}``; needs a retriever
+        that accepts one, such as ``FaissRetriever``.
 
     Returns
     -------
     dict
         Mapping from ``source`` to ``page_content``.
     """
-    docs = docs = retriever.invoke(question)[:k]
+    kwargs = {} if filter is None else {"filter": filter}
+    docs = retriever.invoke(question, **kwargs)[:k]
+    return _contexts_by_source(docs)
+
+def _contexts_by_source(docs: List[Document]) -> Dict[str, str]:
     return {d.metadata.get("source", f"doc{d.id}") : d.page_content for d in docs}
 
+@timed("contexts.questions")
+def get_contexts_for_questions(
+    retriever, questions: List[str], k: int, filter: Optional[Mapping[str, Any]] = None
+) -> List[Dict[str, str]]:
+    """Return the top-k contexts for many questions in one retrieval pass.
+
+    Parameters
+    ----------
+    retriever : Any
+        The retriever to query. A ``FaissRetriever`` embeds all questions in
+        one request and searches FAISS with a single query matrix; other
+        retrievers fall back to their own ``batch``.
+    questions : list of str
+        Query texts.
+    k : int
+        Number of contexts to return per question.
+    filter : dict, optional
+        Metadata filter applied to every question.
+
+    Returns
+    -------
+    list of dict
+        Per question, in input order, a mapping from ``source`` to
+        ``page_content``.
+    """
+    kwargs = {} if filter is None else {"filter": filter}
+    if isinstance(retriever, FaissRetriever):
+        results = retriever.batch_search(questions, **kwargs)
+    else:
+        results = retriever.batch(list(questions), **kwargs)
+    return [_contexts_by_source(docs[:k]) for docs in results]
+
+def _index_signature(persist_dir: str) -> Optional[Tuple[Tuple[int, int], ...]]:
+    """Return a cheap fingerprint of the persisted index files.
+
+    Parameters
+    ----------
+    persist_dir : str
+        Directory holding ``index.faiss`` and ``store.json``, or the
+        ``shards.json`` of a sharded store.
+
+    Returns
+    -------
+    tuple or None
+        ``(mtime_ns, size)`` for each index file, or ``None`` when the index
+        has not been persisted yet.
+    """
+    signature = []
+    names = (INDEX_FILE, STORE_FILE)
+    if not os.path.exists(os.path.join(persist_dir, INDEX_FILE)) and os.path.exists(os.path.join(persist_dir, SHARDS_FILE)):
+        names = (SHARDS_FILE,)
+    for name in names:
+        try:
+            stat = os.stat(os.path.join(persist_dir, name))
+        except FileNotFoundError:
+            return None
+        signature.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+class RagEngine:
+    """Long-lived retrieval engine that keeps the RAG components warm.
+
+    The embeddings client, the FAISS vector store and the retrievers are
+    created once and reused across calls. The index is reloaded only when
+    the files under ``settings.persist_dir`` change on disk.
+
+    Unless ``settings.response_cache_threshold`` is ``None``, ``search``
+    answers near-duplicate questions from a ``SemanticCache`` tied to the
+    index version and ``k``, skipping the retrieval.
+
+    ``asearch`` and ``asearch_batch`` are the non-blocking equivalents: the
+    query is embedded through the async embeddings client and the FAISS
+    search runs in a worker pool of ``settings.search_workers`` threads.
+    Concurrent calls, from any number of event loops or threads, only share
+    the one-off index load lock. The pool lives as long as the engine, across
+    index reloads; ``close`` shuts it down.
+
+    With ``settings.metrics_exporter`` set, stage timings, candidate counts
+    and cache hit rates are recorded (see ``metrics``) and exported at most
+    every ``settings.metrics_interval`` seconds.
+
+    Parameters
+    ----------
+    settings : Settings, optional
+        Base configuration. It is never mutated; per-call overrides are
+        applied on a copy.
+    embeddings : Any, optional
+        Embeddings model. Defaults to ``get_embeddings(settings)`` on first use.
+    docs_loader : callable, optional
+        Zero-argument callable returning the documents used to build the
+        index when it is missing. Defaults to ``simulate_corpus``.
+    """
+
+    def __init__(self, settings: Optional[Settings] = None, embeddings=None, docs_loader=None):
+        self.settings = settings if settings is not None else SETTINGS
+        self._embeddings = embeddings
+        self._docs_loader = docs_loader or simulate_corpus
+        self._vector_store: Optional[FAISS] = None
+        self._signature = None
+        self._retrievers: Dict[int, object] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.settings.search_workers, thread_name_prefix="rag-search")
+        self.response_cache: Optional[SemanticCache] = None
+        if self.settings.response_cache_threshold is not None:
+            self.response_cache = SemanticCache(
+                threshold=self.settings.response_cache_threshold,
+                ttl_seconds=self.settings.response_cache_ttl,
+                max_entries=self.settings.response_cache_size,
+            )
+        configure_metrics(self.settings)
+        self._register_metric_sources()
+
+    def _register_metric_sources(self) -> None:
+        # Hit/miss delle cache letti solo al momento dell'export
+        cache = self.response_cache
+        if cache is not None:
+            METRICS.register_source("response_cache", lambda: {"hits": cache.hits, "misses": cache.misses})
+        embeddings = self._embeddings
+        if isinstance(embeddings, CachedEmbeddings):
+            store = embeddings.cache
+            METRICS.register_source("embedding_cache", lambda: {"hits": store.hits, "misses": store.misses})
+
+    @property
+    def embeddings(self):
+        """Embeddings client, created lazily on first access."""
+        if self._embeddings is None:
+            with self._lock:
+                if self._embeddings is None:
+                    self._embeddings = get_embeddings(self.settings)
+                    self._register_metric_sources()
+        return self._embeddings
+
+    @property
+    def vector_store(self) -> FAISS:
+        """Vector store, (re)loaded only when the on-disk index changed."""
+        signature = _index_signature(self.settings.persist_dir)
+        if self._vector_store is None or signature != self._signature:
+            embeddings = self.embeddings
+            with self._lock:
+                signature = _index_signature(self.settings.persist_dir)
+                if self._vector_store is None or signature != self._signature:
+                    self._vector_store = load_or_build_vectorstore(
+                        self.settings, embeddings, self._docs_loader()
+                    )
+                    self._signature = _index_signature(self.settings.persist_dir)
+                    self._retrievers = {}
+        return self._vector_store
+
+    def retriever(self, k: Optional[int] = None):
+        """Return a cached retriever for ``k`` results.
+
+        Parameters
+        ----------
+        k : int, optional
+            Number of results. Defaults to ``settings.k``.
+
+        Returns
+        -------
+        Any
+            A retriever object compatible with LangChain.
+        """
+        k = self.settings.k if k is None else k
+        vector_store = self.vector_store
+        retrievers = self._retrievers
+        retriever = retrievers.get(k)
+        if retriever is None:
+            retriever = make_retriever(vector_store, replace(self.settings, k=k))
+            retrievers[k] = retriever
+        return retriever
+
+    def search(
+        self, question: str, k: Optional[int] = None, filter: Optional[Mapping[str, Any]] = None
+    ) -> Dict[str, str]:
+        """Retrieve the top-k contexts for ``question``.
+
+        Parameters
+        ----------
+        question : str
+            The user query.
+        k : int, optional
+            Number of contexts to retrieve. Defaults to ``settings.k``.
+        filter : dict, optional
+            Metadata filter, e.g. ``{"source": "guide.md"}``, applied before
+            scoring.
+
+        Returns
+        -------
+        dict
+            Mapping from ``source`` to ``page_content``.
+        """
+        try:
+            with stage("engine.search"):
+                return self._search(question, k, filter)
+        finally:
+            METRICS.maybe_export()
+
+    def _search(self, question: str, k: Optional[int], filter: Optional[Mapping[str, Any]]) -> Dict[str, str]:
+        k = self.settings.k if k is None else k
+        retriever = self.retriever(k)
+        cache = self.response_cache
+        if cache is None:
+            return get_contexts_for_question(retriever, question, k, filter)
+
+        # L'embedding della domanda serve sia per la cache sia per la ricerca
+        with stage("query.embed"):
+            vector = self.embeddings.embed_query(question)
+        version = self._cache_version(k, filter)
+        hit = cache.lookup(vector, version)
+        if hit is not None:
+            return dict(hit.contexts)
+        contexts = _contexts_by_source(retriever.search_by_vectors([vector], [question], filter=filter)[0][:k])
+        cache.put(vector, version, contexts=contexts)
+        return dict(contexts)
+
+    def _cache_version(self, k: int, filter: Optional[Mapping[str, Any]]) -> tuple:
+        return (self._signature, k, json.dumps(filter, sort_keys=True, default=list) if filter else None)
+
+    async def asearch(
+        self, question: str, k: Optional[int] = None, filter: Optional[Mapping[str, Any]] = None
+    ) -> Dict[str, str]:
+        """Async ``search``; never blocks the event loop.
+
+        Parameters
+        ----------
+        question : str
+            The user query.
+        k : int, optional
+            Number of contexts to retrieve. Defaults to ``settings.k``.
+        filter : dict, optional
+            Metadata filter applied before scoring.
+
+        Returns
+        -------
+        dict
+            Mapping from ``source`` to ``page_content``.
+        """
+        try:
+            return await self._asearch(question, k, filter)
+        finally:
+            # Anche sulle risposte dalla cache: l'export periodico non dipende dalle miss
+            METRICS.maybe_export()
+
+    async def _asearch(self, question: str, k: Optional[int], filter: Optional[Mapping[str, Any]]) -> Dict[str, str]:
+        k = self.settings.k if k is None else k
+        loop = asyncio.get_running_loop()
+        # Il primo accesso può caricare o costruire l'indice: anche questo nel pool
+        retriever = await loop.run_in_executor(self._executor, self.retriever, k)
+        start = time.perf_counter()
+        vector = await self.embeddings.aembed_query(question)
+        METRICS.observe_seconds("query.embed", time.perf_counter() - start)
+        cache = self.response_cache
+        version = self._cache_version(k, filter)
+        if cache is not None:
+            hit = cache.lookup(vector, version)
+            if hit is not None:
+                return dict(hit.contexts)
+        docs = await retriever.asearch_by_vectors([vector], [question], filter=filter, executor=self._executor)
+        contexts = _contexts_by_source(docs[0][:k])
+        if cache is not None:
+            cache.put(vector, version, contexts=contexts)
+        return dict(contexts)
+
+    async def asearch_batch(
+        self, questions: List[str], k: Optional[int] = None, filter: Optional[Mapping[str, Any]] = None
+    ) -> List[Dict[str, str]]:
+        """Async ``search_batch``: one awaited embedding request, one pooled search.
+
+        Parameters
+        ----------
+        questions : list of str
+            The user queries.
+        k : int, optional
+            Number of contexts per question. Defaults to ``settings.k``.
+        filter : dict, optional
+            Metadata filter applied to every question.
+
+        Returns
+        -------
+        list of dict
+            Per question, in input order, a mapping from ``source`` to
+            ``page_content``.
+        """
+        k = self.settings.k if k is None else k
+        loop = asyncio.get_running_loop()
+        retriever = await loop.run_in_executor(self._executor, self.retriever, k)
+        results = await retriever.abatch_search(questions, filter=filter, executor=self._executor)
+        return [_contexts_by_source(docs[:k]) for docs in results]
+
+    def search_batch(
+        self, questions: List[str], k: Optional[int] = None, filter: Optional[Mapping[str, Any]] = None
+    ) -> List[Dict[str, str]]:
+        """Retrieve the top-k contexts for many questions at once.
+
+        Parameters
+        ----------
+        questions : list of str
+            The user queries.
+        k : int, optional
+            Number of contexts per question. Defaults to ``settings.k``.
+        filter : dict, optional
+            Metadata filter applied to every question.
+
+        Returns
+        -------
+        list of dict
+            Per question, in input order, a mapping from ``source`` to
+            ``page_content``.
+        """
+        k = self.settings.k if k is None else k
+        return get_contexts_for_questions(self.retriever(k), questions, k, filter)
+
+    def close(self) -> None:
+        """Shut down the engine's search pool; the shard pool is shared (see ``sharding``)."""
+        self._executor.shutdown(wait=True)
+
+
+_ENGINE: Optional[RagEngine] = None
+_ENGINE_LOCK = threading.Lock()
+
+
+def get_engine() -> RagEngine:
+    """Return the process-wide ``RagEngine``, creating it on first use."""
+    global _ENGINE
+    if _ENGINE is None:
+        with _ENGINE_LOCK:
+            if _ENGINE is None:
+                _ENGINE = RagEngine(SETTINGS)
+    return _ENGINE
+
+
 def rag_search(question: str, k: int):
     """Perform a simple RAG retrieval flow and return contexts.
 
+    The components are kept warm in the process-wide engine returned by
+    ``get_engine``, so repeated calls do not reload the index.
+
     Parameters
     ----------
     question : str
@@ -420,22 +1273,41 @@ def rag_search(question: str, k: int):
     dict
         Mapping from ``source`` to ``page_content`` of retrieved chunks.
     """
-    settings = SETTINGS
-    
-    settings.k = k  # aggiorna k dinamicamente
+    return get_engine().search(question, k)
 
-    # 1) Componenti
-    embeddings = get_embeddings()
-    llm = get_llm_from_lmstudio(settings)
 
-    # 2) Dati simulati e indicizzazione (load or build)
-    docs = simulate_corpus()
-    vector_store = load_or_build_vectorstore(settings, embeddings, docs)
+async def arag_search(question: str, k: int) -> Dict[str, str]:
+    """Async ``rag_search`` on the process-wide engine.
 
-    # 3) Retriever ottimizzato
-    retriever = make_retriever(vector_store, settings)
-    
-    retrieved_docs = get_contexts_for_question(retriever, question, k)
-    
-    return retrieved_docs
-       
\ No newline at end of file
+    Parameters
+    ----------
+    question : str
+        The user query.
+    k : int
+        Number of contexts to retrieve.
+
+    Returns
+    -------
+    dict
+        Mapping from ``source`` to ``page_content`` of retrieved chunks.
+    """
+    return await get_engine().asearch(question, k)
+
+
+def rag_search_batch(questions: List[str], k: int) -> List[Dict[str, str]]:
+    """Batched variant of ``rag_search``.
+
+    Parameters
+    ----------
+    questions : list of str
+        The user queries.
+    k : int
+        Number of contexts to retrieve per question.
+
+    Returns
+    -------
+    list of dict
+        Per question, in input order, a mapping from ``source`` to
+        ``page_content`` of retrieved chunks.
+    """
+    return get_engine().search_batch(questions, k)
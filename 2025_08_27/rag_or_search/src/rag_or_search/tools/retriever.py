@@ -0,0 +1,297 @@
+"""Batch-capable retriever over a LangChain FAISS store.
+
+``FaissRetriever`` answers single queries like the retriever returned by
+``FAISS.as_retriever`` and adds ``batch_search``: all questions are embedded
+with one ``embed_documents`` request and FAISS is searched with a single
+``(q, d)`` query matrix, instead of one embedding call and one index search
+per question. The batch goes through ``embed_documents``, so results match
+the per-question path (``embed_query``) only for models that embed queries
+and documents alike, such as the OpenAI/Azure clients; with a query-specific
+instruction or prefix use ``invoke`` per question.
+
+``search_type="hybrid"`` fuses the FAISS nearest neighbours with the BM25
+ranking of the lexical index (see ``lexical``) by reciprocal-rank fusion, so
+exact-term matches surface without a large ``fetch_k``.
+
+The async path (``ainvoke``, ``abatch_search``) awaits the embeddings
+model's async client and runs the FAISS search in an executor, so the event
+loop is never blocked by the index.
+
+Every mode accepts a metadata ``filter`` (see ``filters``) that restricts the
+candidates before scoring, e.g. ``retriever.invoke(q, filter={"source": "a.md"})``.
+
+Query embedding, FAISS search, MMR, BM25 and docstore lookups are timed as
+separate stages when ``metrics.METRICS`` is enabled.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from concurrent.futures import Executor
+from functools import partial
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain.schema import Document
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+
+from .filters import filtered_search, metadata_bitmaps_for
+from .metrics import METRICS, instrumented_search, stage
+from .mmr import mmr_search_by_vectors
+
+SEARCH_TYPES = ("similarity", "mmr", "hybrid")
+
+
+def documents_at(vector_store, positions: Sequence[int]) -> List[Document]:
+    """Return the documents at the given FAISS positions, skipping ``-1``."""
+    docs = []
+    for position in positions:
+        if position == -1:
+            continue
+        doc_id = vector_store.index_to_docstore_id[int(position)]
+        doc = vector_store.docstore.search(doc_id)
+        if not isinstance(doc, Document):
+            raise ValueError(f"Could not find document for id {doc_id}, got {doc}")
+        docs.append(doc)
+    return docs
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[int]], k: int, rrf_k: int = 60) -> List[int]:
+    """Fuse ranked position lists with reciprocal-rank fusion.
+
+    Parameters
+    ----------
+    rankings : sequence of sequence of int
+        Ranked positions from each retriever (best first); ``-1`` is ignored.
+    k : int
+        Number of fused positions returned.
+    rrf_k : int, optional
+        Rank offset; larger values flatten the contribution of top ranks.
+
+    Returns
+    -------
+    list of int
+        The ``k`` positions with the highest ``sum(1 / (rrf_k + rank))``,
+        ties broken by position.
+    """
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking, start=1):
+            position = int(position)
+            if position != -1:
+                scores[position] = scores.get(position, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(scores, key=lambda p: (-scores[p], p))[:k]
+
+
+def similarity_search_by_vectors(
+    vector_store,
+    query_vectors: np.ndarray,
+    k: int = 4,
+    search: Optional[Callable[[np.ndarray, int], Tuple[np.ndarray, np.ndarray]]] = None,
+) -> List[List[Document]]:
+    """Return the ``k`` nearest documents for each query vector.
+
+    Parameters
+    ----------
+    vector_store : FAISS
+        LangChain FAISS store.
+    query_vectors : numpy.ndarray
+        Query embeddings, shape ``(q, d)``.
+    k : int, optional
+        Number of documents returned per query.
+    search : callable, optional
+        ``search(queries, k) -> (distances, positions)``; defaults to
+        ``vector_store.index.search``.
+
+    Returns
+    -------
+    list of list of Document
+        Per query, the documents in ascending distance order.
+    """
+    queries = np.ascontiguousarray(np.atleast_2d(query_vectors), dtype=np.float32)
+    _, indices = (search or vector_store.index.search)(queries, k)
+    with stage("docstore.lookup"):
+        return [documents_at(vector_store, row) for row in indices]
+
+
+class FaissRetriever(BaseRetriever):
+    """LangChain retriever with a batched query path.
+
+    Attributes
+    ----------
+    vector_store : FAISS
+        The store to search.
+    search_type : str
+        ``"similarity"``, ``"mmr"`` (vectorized, see ``mmr``) or
+        ``"hybrid"`` (vector and BM25 rankings fused by RRF).
+    k : int
+        Number of documents returned.
+    fetch_k : int
+        Number of nearest candidates re-ranked by MMR, and candidates taken
+        from each side in hybrid mode.
+    lambda_mult : float
+        0 = maximum diversity, 1 = maximum relevance.
+    lexical_index : BM25Index or None
+        Lexical index of ``vector_store``; required for ``"hybrid"``.
+    rrf_k : int
+        Rank offset of reciprocal-rank fusion.
+    filter : dict or None
+        Default metadata filter, e.g. ``{"source": "a.md"}``; a ``filter``
+        passed per call replaces it.
+    filter_exact_max : int
+        Filtered subsets up to this size are searched exactly.
+    """
+
+    vector_store: Any
+    search_type: str = "similarity"
+    k: int = 4
+    fetch_k: int = 20
+    lambda_mult: float = 0.5
+    lexical_index: Any = None
+    rrf_k: int = 60
+    filter: Optional[Dict[str, Any]] = None
+    filter_exact_max: int = 20_000
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+        filter: Optional[Mapping[str, Any]] = None,
+    ) -> List[Document]:
+        with stage("retriever.invoke"):
+            with stage("query.embed"):
+                vector = self.vector_store.embedding_function.embed_query(query)
+            return self.search_by_vectors([vector], [query], filter=filter)[0]
+
+    async def _aget_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: AsyncCallbackManagerForRetrieverRun,
+        filter: Optional[Mapping[str, Any]] = None,
+    ) -> List[Document]:
+        start = time.perf_counter()
+        vector = await self.vector_store.embedding_function.aembed_query(query)
+        METRICS.observe_seconds("query.embed", time.perf_counter() - start)
+        docs = (await self.asearch_by_vectors([vector], [query], filter=filter))[0]
+        METRICS.observe_seconds("retriever.invoke", time.perf_counter() - start)
+        return docs
+
+    async def asearch_by_vectors(
+        self,
+        query_vectors: Sequence[Sequence[float]],
+        queries: Optional[Sequence[str]] = None,
+        filter: Optional[Mapping[str, Any]] = None,
+        executor: Optional[Executor] = None,
+    ) -> List[List[Document]]:
+        """Async ``search_by_vectors``: the search runs in ``executor``.
+
+        ``executor`` defaults to the event loop's default executor.
+        """
+        loop = asyncio.get_running_loop()
+        search = partial(self.search_by_vectors, query_vectors, queries, filter=filter)
+        return await loop.run_in_executor(executor, search)
+
+    def search_by_vectors(
+        self,
+        query_vectors: Sequence[Sequence[float]],
+        queries: Optional[Sequence[str]] = None,
+        filter: Optional[Mapping[str, Any]] = None,
+    ) -> List[List[Document]]:
+        """Return the documents for each query embedding, in input order.
+
+        ``queries`` (the query texts) is required by the hybrid mode only.
+        ``filter`` restricts the candidates by metadata; defaults to
+        ``self.filter``.
+        """
+        vectors = np.asarray(query_vectors, dtype=np.float32)
+        filter = self.filter if filter is None else filter
+        allowed = None
+        search = self.vector_store.index.search
+        if filter:
+            with stage("filter.positions"):
+                allowed = metadata_bitmaps_for(self.vector_store).positions(filter)
+            METRICS.observe("filter.allowed", len(allowed))
+            search = partial(filtered_search, self.vector_store, positions=allowed, exact_max=self.filter_exact_max)
+        search = instrumented_search(search)
+        if self.search_type == "hybrid":
+            return self._hybrid_search(vectors, queries, search, allowed)
+        if self.search_type == "mmr":
+            results = mmr_search_by_vectors(
+                self.vector_store,
+                vectors,
+                k=self.k,
+                fetch_k=self.fetch_k,
+                lambda_mult=self.lambda_mult,
+                search=search,
+            )
+            return [[doc for doc, _ in docs] for docs in results]
+        if self.search_type == "similarity":
+            return similarity_search_by_vectors(self.vector_store, vectors, k=self.k, search=search)
+        raise ValueError(f"Unsupported search type: {self.search_type}. Choose one of {SEARCH_TYPES}.")
+
+    def _hybrid_search(
+        self,
+        vectors: np.ndarray,
+        queries: Optional[Sequence[str]],
+        search: Callable[[np.ndarray, int], Tuple[np.ndarray, np.ndarray]],
+        allowed: Optional[np.ndarray],
+    ) -> List[List[Document]]:
+        if self.lexical_index is None:
+            raise ValueError("Hybrid search needs a lexical index")
+        if queries is None or len(queries) != len(vectors):
+            raise ValueError("Hybrid search needs the query texts together with their vectors")
+        queries_2d = np.ascontiguousarray(np.atleast_2d(vectors), dtype=np.float32)
+        _, indices = search(queries_2d, self.fetch_k)
+        results = []
+        for query, row in zip(queries, indices):
+            with stage("lexical.search"):
+                lexical, _ = self.lexical_index.search(query, self.fetch_k, allowed=allowed)
+            fused = reciprocal_rank_fusion([row, lexical], self.k, self.rrf_k)
+            with stage("docstore.lookup"):
+                results.append(documents_at(self.vector_store, fused))
+        return results
+
+    def batch_search(
+        self, questions: Sequence[str], filter: Optional[Mapping[str, Any]] = None
+    ) -> List[List[Document]]:
+        """Retrieve documents for many questions with one embedding request.
+
+        The questions are embedded with ``embed_documents``, not
+        ``embed_query`` (see the module docstring).
+
+        Parameters
+        ----------
+        questions : sequence of str
+            Query texts.
+        filter : dict, optional
+            Metadata filter applied to every question; defaults to
+            ``self.filter``.
+
+        Returns
+        -------
+        list of list of Document
+            Retrieved documents per question, in the order of ``questions``.
+        """
+        if not questions:
+            return []
+        with stage("query.embed"):
+            vectors = self.vector_store.embedding_function.embed_documents(list(questions))
+        return self.search_by_vectors(vectors, questions, filter=filter)
+
+    async def abatch_search(
+        self,
+        questions: Sequence[str],
+        filter: Optional[Mapping[str, Any]] = None,
+        executor: Optional[Executor] = None,
+    ) -> List[List[Document]]:
+        """Async ``batch_search``: one awaited embedding request, search in ``executor``."""
+        if not questions:
+            return []
+        start = time.perf_counter()
+        vectors = await self.vector_store.embedding_function.aembed_documents(list(questions))
+        METRICS.observe_seconds("query.embed", time.perf_counter() - start)
+        return await self.asearch_by_vectors(vectors, questions, filter=filter, executor=executor)
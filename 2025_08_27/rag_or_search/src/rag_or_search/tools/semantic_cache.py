@@ -0,0 +1,176 @@
+"""Semantic cache of RAG responses keyed by query embedding.
+
+A new query is served from the cache when its embedding has cosine
+similarity at least ``threshold`` with a cached query answered against the
+same index version (any hashable: index file signature, retrieval
+settings, ...). Entries expire after ``ttl_seconds`` and the least recently
+used one is evicted when ``max_entries`` is reached. Lookups are a single
+matrix-vector product over the resident, L2-normalized query vectors.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Hashable, List, Optional, Sequence
+
+import numpy as np
+
+
+@dataclass
+class CachedResponse:
+    """A cache hit.
+
+    Attributes
+    ----------
+    answer : Any
+        Cached answer (``None`` when only contexts were cached).
+    contexts : Any
+        Cached retrieval contexts, if any.
+    similarity : float
+        Cosine similarity between the new and the cached query.
+    """
+
+    answer: Any
+    contexts: Any
+    similarity: float
+
+
+@dataclass
+class _Entry:
+    version: Hashable
+    answer: Any
+    contexts: Any
+    created: float
+
+
+class SemanticCache:
+    """In-memory response cache with cosine matching, TTL and LRU eviction.
+
+    Parameters
+    ----------
+    threshold : float, optional
+        Minimum cosine similarity for a hit.
+    ttl_seconds : float, optional
+        Lifetime of an entry; ``None`` disables expiry.
+    max_entries : int, optional
+        Maximum number of cached responses.
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl_seconds: Optional[float] = 3600.0, max_entries: int = 1024):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._vectors: Optional[np.ndarray] = None
+        self._active = np.zeros(max_entries, dtype=bool)
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._free: List[int] = list(range(max_entries - 1, -1, -1))
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expired(self, entry: _Entry, now: float) -> bool:
+        return self.ttl_seconds is not None and now - entry.created > self.ttl_seconds
+
+    def _evict(self, slot: int) -> None:
+        del self._entries[slot]
+        self._active[slot] = False
+        self._free.append(slot)
+
+    def lookup(self, vector: Sequence[float], version: Hashable) -> Optional[CachedResponse]:
+        """Return the most similar valid cached response, or ``None``.
+
+        Parameters
+        ----------
+        vector : sequence of float
+            Embedding of the new query.
+        version : hashable
+            Current index version; entries of other versions never match.
+
+        Returns
+        -------
+        CachedResponse or None
+            The hit, or ``None`` on a miss.
+        """
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        with self._lock:
+            if self._vectors is None or not self._entries or not norm or query.shape[0] != self._vectors.shape[1]:
+                self.misses += 1
+                return None
+            similarity = self._vectors @ (query / norm)
+            similarity[~self._active] = -np.inf
+            now = time.monotonic()
+            for slot in np.argsort(-similarity):
+                score = float(similarity[slot])
+                if score < self.threshold:
+                    break
+                entry = self._entries[int(slot)]
+                if self._expired(entry, now):
+                    self._evict(int(slot))
+                    continue
+                if entry.version != version:
+                    continue
+                self._entries.move_to_end(int(slot))
+                self.hits += 1
+                return CachedResponse(answer=entry.answer, contexts=entry.contexts, similarity=score)
+            self.misses += 1
+            return None
+
+    def put(self, vector: Sequence[float], version: Hashable, answer: Any = None, contexts: Any = None) -> None:
+        """Cache the response to a query.
+
+        Parameters
+        ----------
+        vector : sequence of float
+            Embedding of the query.
+        version : hashable
+            Index version the response was computed against.
+        answer : Any, optional
+            Generated answer.
+        contexts : Any, optional
+            Retrieved contexts.
+
+        Raises
+        ------
+        ValueError
+            If ``vector`` has a different dimension from the cached ones.
+        """
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if not norm or self.max_entries <= 0:
+            return
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, query.shape[0]), dtype=np.float32)
+            elif query.shape[0] != self._vectors.shape[1]:
+                raise ValueError(f"Expected vectors of dimension {self._vectors.shape[1]}, got {query.shape[0]}")
+            if not self._free:
+                # Pieno: libera lo slot usato meno di recente
+                self._evict(next(iter(self._entries)))
+            slot = self._free.pop()
+            self._vectors[slot] = query / norm
+            self._active[slot] = True
+            self._entries[slot] = _Entry(version=version, answer=answer, contexts=contexts, created=time.monotonic())
+
+    def clear(self) -> None:
+        """Drop every entry (counters are kept)."""
+        with self._lock:
+            for slot in list(self._entries):
+                self._evict(slot)
+
+    def stats(self) -> Dict[str, float]:
+        """Return hit/miss counters, hit rate and current size."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self._entries),
+            }
@@ -0,0 +1,321 @@
+"""Sharded FAISS store with parallel fan-out search.
+
+Chunks are partitioned by a hash of their ``source`` across N shards, each
+an independent store written by ``save_store`` under
+``<persist_dir>/shard-XXX``, so shards are built, updated and reloaded on
+their own. ``shards.json`` in ``persist_dir`` lists the shards and the
+signature of each one; it is rewritten only when a shard changes.
+
+``sharded_store`` combines the shard stores into one LangChain ``FAISS``
+object whose index is a ``ShardedIndex``: global positions are the shard
+positions laid end to end, a query is searched on every shard concurrently
+in a thread pool (FAISS releases the GIL while searching) and the per-shard
+top-k lists are merged with a heap. The pool is shared per process (see
+``shared_executor``), so reloading a store does not leave threads behind. The combined store is read-only and
+works unchanged with ``make_retriever`` (similarity, MMR, hybrid and
+metadata filters).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import heapq
+import json
+import os
+import shutil
+import threading
+from collections.abc import Mapping
+from concurrent.futures import Executor, ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import faiss
+import numpy as np
+from langchain.schema import Document
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+
+from .filters import filtered_index_search
+from .index_store import STORE_FILE
+
+SHARDS_FILE = "shards.json"
+
+_EXECUTORS: Dict[int, ThreadPoolExecutor] = {}
+_EXECUTORS_LOCK = threading.Lock()
+
+
+def shared_executor(max_workers: int) -> ThreadPoolExecutor:
+    """Return the process-wide fan-out pool with ``max_workers`` threads.
+
+    Stores reloaded after an index change reuse the pool of the previous
+    load instead of each starting (and leaking) its own threads.
+    """
+    with _EXECUTORS_LOCK:
+        executor = _EXECUTORS.get(max_workers)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="shard")
+            _EXECUTORS[max_workers] = executor
+        return executor
+
+
+def shard_of(doc: Document, n_shards: int) -> int:
+    """Return the shard of a chunk: a stable hash of its ``source`` modulo ``n_shards``."""
+    source = str(doc.metadata.get("source", ""))
+    return int.from_bytes(hashlib.sha1(source.encode("utf-8")).digest()[:8], "little") % n_shards
+
+
+def partition_chunks(chunks: Sequence[Document], n_shards: int) -> List[List[Document]]:
+    """Split ``chunks`` into ``n_shards`` lists, keeping every source in one shard."""
+    parts: List[List[Document]] = [[] for _ in range(n_shards)]
+    for doc in chunks:
+        parts[shard_of(doc, n_shards)].append(doc)
+    return parts
+
+
+def shard_dir(persist_dir: str, shard: int) -> str:
+    """Directory of shard number ``shard`` under ``persist_dir``."""
+    return str(Path(persist_dir) / f"shard-{shard:03d}")
+
+
+def sharded_store_exists(persist_dir: str) -> bool:
+    """Whether ``persist_dir`` holds a sharded store."""
+    return (Path(persist_dir) / SHARDS_FILE).exists()
+
+
+def write_shards_file(persist_dir: str, shards: Sequence[int]) -> None:
+    """Record the shards of ``persist_dir`` and their signatures, if they changed."""
+    entries = []
+    for shard in shards:
+        stat = os.stat(Path(shard_dir(persist_dir, shard)) / STORE_FILE)
+        entries.append({"shard": shard, "signature": [stat.st_mtime_ns, stat.st_size]})
+    content = {"version": 1, "shards": entries}
+    path = Path(persist_dir) / SHARDS_FILE
+    if path.exists():
+        with open(path, "r", encoding="utf-8") as f:
+            if json.load(f) == content:
+                # Invariato: mtime stabile, così RagEngine non ricarica l'indice
+                return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(content, f)
+    os.replace(tmp_path, path)
+
+
+
+def remove_stale_shards(persist_dir: str, shards: Sequence[int]) -> None:
+    """Delete the shard directories of ``persist_dir`` not listed in ``shards``.
+
+    Left over when ``settings.shards`` is lowered or a shard ends up empty;
+    call after ``write_shards_file`` so a crash never drops a listed shard.
+    """
+    keep = {Path(shard_dir(persist_dir, shard)).name for shard in shards}
+    for path in Path(persist_dir).glob("shard-*"):
+        if path.is_dir() and path.name not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+class ShardedIndex:
+    """Read-only view of several FAISS indexes as one, searched in parallel.
+
+    Implements the subset of the ``faiss.Index`` API used by the retrieval
+    code (``search``, ``reconstruct*``, ``ntotal``, ``d``, ``metric_type``).
+
+    Parameters
+    ----------
+    shards : sequence of faiss.Index
+        Shard indexes, in global position order; same dimension and metric.
+    executor : concurrent.futures.Executor, optional
+        Pool of the fan-out, owned by the caller (e.g. ``shared_executor``);
+        without one the shards are searched one after the other in the
+        calling thread. Shards must not fan out on the same pool.
+    """
+
+    def __init__(self, shards: Sequence[faiss.Index], executor: Optional[Executor] = None):
+        if not shards:
+            raise ValueError("ShardedIndex needs at least one shard")
+        self.shards = list(shards)
+        self.d = self.shards[0].d
+        self.metric_type = self.shards[0].metric_type
+        if any(s.d != self.d or s.metric_type != self.metric_type for s in self.shards):
+            raise ValueError("All shards must have the same dimension and metric")
+        self.offsets = np.concatenate(([0], np.cumsum([s.ntotal for s in self.shards]))).astype(np.int64)
+        self.is_trained = True
+        self._executor = executor
+
+    @property
+    def ntotal(self) -> int:
+        return int(self.offsets[-1])
+
+    def _fan_out(self, search) -> List[Tuple[np.ndarray, np.ndarray]]:
+        if len(self.shards) == 1 or self._executor is None:
+            return [search(s, shard) for s, shard in enumerate(self.shards)]
+        return list(self._executor.map(search, range(len(self.shards)), self.shards))
+
+    def _merge(self, results: List[Tuple[np.ndarray, np.ndarray]], n_queries: int, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        inner_product = self.metric_type == faiss.METRIC_INNER_PRODUCT
+        distances = np.full((n_queries, k), -np.inf if inner_product else np.inf, dtype=np.float32)
+        labels = np.full((n_queries, k), -1, dtype=np.int64)
+        key = (lambda item: -item[0]) if inner_product else (lambda item: item[0])
+        for row in range(n_queries):
+            # Ogni shard restituisce una lista già ordinata: fusione k-way con heap
+            runs = [
+                zip(d[row][i[row] >= 0].tolist(), (i[row][i[row] >= 0] + self.offsets[s]).tolist())
+                for s, (d, i) in enumerate(results)
+            ]
+            for j, (distance, label) in enumerate(islice(heapq.merge(*runs, key=key), k)):
+                distances[row, j] = distance
+                labels[row, j] = label
+        return distances, labels
+
+    def search(self, x: np.ndarray, k: int, params=None) -> Tuple[np.ndarray, np.ndarray]:
+        """Search every shard concurrently and merge the top ``k``.
+
+        Raises
+        ------
+        ValueError
+            If ``params`` is given: per-shard parameters are applied with
+            ``configure_search`` and subsets with ``search_positions``.
+        """
+        if params is not None:
+            raise ValueError("ShardedIndex.search does not take search parameters")
+        queries = np.ascontiguousarray(np.atleast_2d(x), dtype=np.float32)
+        results = self._fan_out(lambda _, shard: shard.search(queries, k))
+        return self._merge(results, len(queries), k)
+
+    def search_positions(
+        self, queries: np.ndarray, k: int, positions: np.ndarray, exact_max: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Search only the global ``positions`` (sorted), shard by shard in parallel."""
+        bounds = np.searchsorted(positions, self.offsets)
+
+        def search(s: int, shard: faiss.Index):
+            local = positions[bounds[s]:bounds[s + 1]] - self.offsets[s]
+            if not len(local):
+                return np.zeros((len(queries), 0), np.float32), np.zeros((len(queries), 0), np.int64)
+            return filtered_index_search(shard, queries, k, local, exact_max)
+
+        return self._merge(self._fan_out(search), len(queries), k)
+
+    def _locate(self, positions: np.ndarray) -> np.ndarray:
+        return np.searchsorted(self.offsets, positions, side="right") - 1
+
+    def reconstruct(self, key: int) -> np.ndarray:
+        shard = int(self._locate(np.array([key]))[0])
+        return self.shards[shard].reconstruct(int(key - self.offsets[shard]))
+
+    def reconstruct_batch(self, keys: np.ndarray) -> np.ndarray:
+        keys = np.asarray(keys, dtype=np.int64)
+        out = np.empty((len(keys), self.d), dtype=np.float32)
+        owners = self._locate(keys)
+        for shard in np.unique(owners):
+            rows = owners == shard
+            out[rows] = self.shards[shard].reconstruct_batch(keys[rows] - self.offsets[shard])
+        return out
+
+    def reconstruct_n(self, i0: int, ni: int) -> np.ndarray:
+        return self.reconstruct_batch(np.arange(i0, i0 + ni, dtype=np.int64))
+
+
+class ShardedIdMap(Mapping):
+    """Global ``position -> docstore id`` mapping over the shard mappings."""
+
+    def __init__(self, mappings: Sequence[Mapping], offsets: np.ndarray):
+        self._mappings = list(mappings)
+        self._offsets = offsets
+
+    def __getitem__(self, position: int) -> str:
+        if not 0 <= position < self._offsets[-1]:
+            raise KeyError(position)
+        shard = int(np.searchsorted(self._offsets, position, side="right") - 1)
+        return self._mappings[shard][int(position - self._offsets[shard])]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(int(self._offsets[-1])))
+
+    def __len__(self) -> int:
+        return int(self._offsets[-1])
+
+
+class ShardedDocstore(Docstore):
+    """Docstore that looks ids up in each shard's docstore."""
+
+    def __init__(self, docstores: Sequence[Docstore], counts: Sequence[int]):
+        self.docstores = list(docstores)
+        self.counts = list(counts)
+        self.count = sum(self.counts)
+
+    def search(self, search: str) -> Union[str, Document]:
+        """Return the document with id ``search`` (LangChain ``Docstore`` API)."""
+        for docstore in self.docstores:
+            doc = docstore.search(search)
+            if isinstance(doc, Document):
+                return doc
+        return f"ID {search} not found."
+
+    def deleted_positions(self) -> np.ndarray:
+        """Global positions deleted in the shards since their last compaction."""
+        offsets = np.concatenate(([0], np.cumsum(self.counts))).astype(np.int64)
+        deleted = [
+            docstore.deleted_positions() + offsets[s]
+            for s, docstore in enumerate(self.docstores)
+            if hasattr(docstore, "deleted_positions")
+        ]
+        return np.concatenate(deleted).astype(np.int64) if deleted else np.zeros(0, dtype=np.int64)
+
+    def metadata_columns(self) -> Dict[str, tuple]:
+        """Merge the shard metadata columns (see ``MmapDocstore.metadata_columns``)."""
+        names: List[str] = []
+        per_shard = []
+        for docstore in self.docstores:
+            columns = docstore.metadata_columns()
+            per_shard.append(columns)
+            names.extend(n for n in columns if n not in names)
+
+        merged = {}
+        for name in names:
+            lookup: Dict[str, int] = {}
+            values: list = []
+            parts = []
+            for columns, count in zip(per_shard, self.counts):
+                if name not in columns:
+                    parts.append(np.full(count, -1, dtype=np.int32))
+                    continue
+                codes, shard_values = columns[name]
+                remap = np.empty(len(shard_values) + 1, dtype=np.int32)
+                remap[-1] = -1
+                for code, value in enumerate(shard_values):
+                    remap[code] = lookup.setdefault(json.dumps(value, sort_keys=True), len(values))
+                    if remap[code] == len(values):
+                        values.append(value)
+                # Il codice -1 (metadato assente) punta all'ultimo elemento di remap
+                parts.append(remap[np.asarray(codes)])
+            merged[name] = (np.concatenate(parts), values)
+        return merged
+
+
+def sharded_store(stores: Sequence[FAISS], embeddings, max_workers: Optional[int] = None) -> FAISS:
+    """Combine shard stores into one read-only LangChain ``FAISS`` store.
+
+    Parameters
+    ----------
+    stores : sequence of FAISS
+        Shard stores, typically opened with ``load_store``.
+    embeddings : Any
+        Embeddings model used for queries.
+    max_workers : int, optional
+        Threads of the fan-out pool; defaults to the number of shards. The
+        pool is the process-wide one of that size (``shared_executor``).
+
+    Returns
+    -------
+    FAISS
+        A store whose index is a ``ShardedIndex``.
+    """
+    index = ShardedIndex([s.index for s in stores], executor=shared_executor(max_workers or len(stores)))
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=ShardedDocstore([s.docstore for s in stores], [s.index.ntotal for s in stores]),
+        index_to_docstore_id=ShardedIdMap([s.index_to_docstore_id for s in stores], index.offsets),
+    )
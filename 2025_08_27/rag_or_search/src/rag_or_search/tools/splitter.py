@@ -0,0 +1,246 @@
+"""Fast drop-in replacement for LangChain's ``RecursiveCharacterTextSplitter``.
+
+``RecursiveCharacterTextSplitter`` (with its defaults used by
+``split_documents``: literal separators kept at the start of each piece,
+``len`` as length function, stripped chunks) re-searches and re-slices
+substrings at every recursion level, concatenates separators back onto the
+pieces and merges them by repeatedly slicing and joining lists.
+
+``FastRecursiveSplitter`` produces the same chunks working on offsets into the
+original text: separators are located with bounded ``str.find`` calls, each
+level is split once in C with ``str.split`` and only the piece lengths are
+kept, and since the pieces merged into a chunk are always contiguous, every
+chunk is a single slice of the input. Metadata of simple documents is copied with
+``dict`` instead of ``copy.deepcopy``.
+
+Equivalence with the LangChain splitter and the speed-up can be checked
+with::
+
+    python -m rag_or_search.tools.splitter
+"""
+
+from __future__ import annotations
+
+import argparse
+import copy
+import random
+import time
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import Iterable, List, Optional, Sequence
+
+from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+_SCALARS = (str, int, float, bool, type(None))
+
+
+class FastRecursiveSplitter:
+    """Recursive character splitter with output identical to LangChain's.
+
+    Equivalent to ``RecursiveCharacterTextSplitter(chunk_size=...,
+    chunk_overlap=..., separators=...)`` with the remaining arguments left
+    at their defaults.
+
+    Parameters
+    ----------
+    chunk_size : int, optional
+        Maximum characters per chunk.
+    chunk_overlap : int, optional
+        Overlap between adjacent chunks.
+    separators : sequence of str, optional
+        Literal separators, tried in order; ``""`` splits into characters.
+
+    Raises
+    ------
+    ValueError
+        On invalid sizes, as ``RecursiveCharacterTextSplitter``.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = 4000,
+        chunk_overlap: int = 200,
+        separators: Optional[Sequence[str]] = None,
+    ):
+        if chunk_size <= 0:
+            raise ValueError(f"chunk_size must be > 0, got {chunk_size}")
+        if chunk_overlap < 0:
+            raise ValueError(f"chunk_overlap must be >= 0, got {chunk_overlap}")
+        if chunk_overlap > chunk_size:
+            raise ValueError(
+                f"Got a larger chunk overlap ({chunk_overlap}) than chunk size "
+                f"({chunk_size}), should be smaller."
+            )
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = list(separators or ["\n\n", "\n", " ", ""])
+
+    def split_text(self, text: str) -> List[str]:
+        """Split ``text`` into chunks."""
+        chunks: List[str] = []
+        self._split(text, 0, len(text), 0, chunks)
+        return chunks
+
+    def split_documents(self, documents: Iterable[Document]) -> List[Document]:
+        """Split documents, copying the metadata of each into its chunks."""
+        chunks = []
+        for doc in documents:
+            metadata = doc.metadata
+            simple = all(isinstance(k, str) and isinstance(v, _SCALARS) for k, v in metadata.items())
+            for chunk in self.split_text(doc.page_content):
+                chunks.append(Document(
+                    page_content=chunk,
+                    metadata=dict(metadata) if simple else copy.deepcopy(metadata),
+                ))
+        return chunks
+
+    def _split(self, text: str, start: int, end: int, level: int, out: List[str]) -> None:
+        separators = self.separators
+        # Primo separatore presente nell'intervallo (come re.search sulla sottostringa)
+        separator = separators[-1]
+        next_level = len(separators)
+        for i in range(level, len(separators)):
+            if separators[i] == "":
+                separator = ""
+                break
+            if text.find(separators[i], start, end) != -1:
+                separator = separators[i]
+                next_level = i + 1
+                break
+
+        # Lunghezze dei pezzi consecutivi: il separatore resta in testa al pezzo successivo
+        if separator == "":
+            lengths = [1] * (end - start)
+        else:
+            width = len(separator)
+            lengths = [len(part) + width for part in text[start:end].split(separator)]
+            lengths[0] -= width
+            if not lengths[0]:
+                del lengths[0]
+
+        size = self.chunk_size
+        if not lengths:
+            return
+        if max(lengths) < size:
+            self._merge(text, start, lengths, out)
+            return
+
+        run_start = position = start
+        run: List[int] = []
+        for length in lengths:
+            if length < size:
+                run.append(length)
+                position += length
+                continue
+            if run:
+                self._merge(text, run_start, run, out)
+                run = []
+            if next_level >= len(separators):
+                out.append(text[position:position + length])
+            else:
+                self._split(text, position, position + length, next_level, out)
+            position += length
+            run_start = position
+        if run:
+            self._merge(text, run_start, run, out)
+
+    def _merge(self, text: str, start: int, lengths: List[int], out: List[str]) -> None:
+        # Stessa logica di TextSplitter._merge_splits con separatore vuoto, ma con
+        # le somme prefisse: la finestra corrente è prefix[head:i], contigua nel testo,
+        # e i punti di taglio si trovano con ricerca binaria invece che pezzo per pezzo
+        size, overlap = self.chunk_size, self.chunk_overlap
+        prefix = [0, *accumulate(lengths)]
+        n = len(lengths)
+        head = 0
+        while True:
+            # Primo pezzo i che non entra più nella finestra che parte da head
+            i = bisect_right(prefix, prefix[head] + size) - 1
+            if i >= n:
+                break
+            chunk = text[start + prefix[head]:start + prefix[i]].strip()
+            if chunk:
+                out.append(chunk)
+            # Scarta pezzi in testa finché la finestra è nell'overlap e il pezzo i ci sta
+            head = bisect_left(prefix, max(prefix[i] - overlap, prefix[i + 1] - size), head, i)
+        chunk = text[start + prefix[head]:start + prefix[n]].strip()
+        if chunk:
+            out.append(chunk)
+
+
+def compare_with_langchain(
+    texts: Sequence[str],
+    chunk_size: int,
+    chunk_overlap: int,
+    separators: Optional[Sequence[str]] = None,
+) -> List[int]:
+    """Return the indices of ``texts`` where the two splitters disagree."""
+    reference = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap, separators=list(separators) if separators else None
+    )
+    fast = FastRecursiveSplitter(chunk_size, chunk_overlap, separators)
+    return [i for i, text in enumerate(texts) if reference.split_text(text) != fast.split_text(text)]
+
+
+def random_texts(n: int, separators: Sequence[str], max_len: int = 3000, seed: int = 0) -> List[str]:
+    """Generate texts dense in separators, overlapping ones and long words."""
+    rng = random.Random(seed)
+    atoms = [s for s in separators if s] + ["\n\n\n", "..", "  ", "word", "parola", "è", "x" * 50, "a"]
+    texts = []
+    for _ in range(n):
+        parts = []
+        length = 0
+        target = rng.randint(0, max_len)
+        while length < target:
+            atom = rng.choice(atoms) if rng.random() < 0.5 else rng.choice(atoms[-6:])
+            parts.append(atom)
+            length += len(atom)
+        texts.append("".join(parts))
+    return texts
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    """Check equivalence with LangChain on random texts and compare throughput."""
+    from .rag_utils import Settings, SPLIT_SEPARATORS
+
+    parser = argparse.ArgumentParser(description="FastRecursiveSplitter equivalence check and benchmark.")
+    parser.add_argument("--texts", type=int, default=2000, help="Random texts per configuration.")
+    parser.add_argument("--bench-mb", type=float, default=20.0, help="Megabytes of text for the benchmark.")
+    args = parser.parse_args(argv)
+
+    configs = [(1000, 100), (200, 20), (50, 0), (10, 9), (3, 1), (1, 0)]
+    texts = random_texts(args.texts, SPLIT_SEPARATORS)
+    for chunk_size, chunk_overlap in configs:
+        for separators in (SPLIT_SEPARATORS, None, ["\n\n", "\n", " "]):
+            mismatches = compare_with_langchain(texts, chunk_size, chunk_overlap, separators)
+            if mismatches:
+                raise SystemExit(
+                    f"Mismatch for chunk_size={chunk_size}, chunk_overlap={chunk_overlap}, "
+                    f"separators={separators!r}: text #{mismatches[0]}"
+                )
+    print(f"Equivalenza verificata su {len(texts)} testi x {len(configs) * 3} configurazioni")
+
+    from .benchmark import synthetic_corpus
+
+    settings = Settings()
+    sample = [d.page_content for d in synthetic_corpus(2000, words_per_chunk=200)]
+    corpus = "\n\n".join(sample)
+    copies = max(1, int(args.bench_mb * 1e6 // len(corpus)))
+    docs = [Document(page_content=corpus, metadata={"source": f"bench-{i}.md", "section": 1}) for i in range(copies)]
+    megabytes = copies * len(corpus) / 1e6
+
+    reference = RecursiveCharacterTextSplitter(
+        chunk_size=settings.chunk_size, chunk_overlap=settings.chunk_overlap, separators=SPLIT_SEPARATORS
+    )
+    fast = FastRecursiveSplitter(settings.chunk_size, settings.chunk_overlap, SPLIT_SEPARATORS)
+    timings = {}
+    for name, splitter in (("langchain", reference), ("fast", fast)):
+        start = time.perf_counter()
+        chunks = splitter.split_documents(docs)
+        timings[name] = time.perf_counter() - start
+        print(f"{name}: {len(chunks)} chunk, {megabytes / timings[name]:.1f} MB/s")
+    print(f"Speed-up: {timings['langchain'] / timings['fast']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
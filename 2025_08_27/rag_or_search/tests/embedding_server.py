@@ -0,0 +1,110 @@
+"""Local stub of the OpenAI ``/embeddings`` endpoint for the ingestion tests.
+
+Vectors are those of ``FakeEmbeddings``. Failures are scripted per request,
+in order: an HTTP status (e.g. ``429``), ``"drop"`` (the connection is closed
+without a response) or ``"slow"`` (the response is delayed past the client
+timeout); once the script is exhausted every request succeeds.
+"""
+
+from __future__ import annotations
+
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Sequence, Union
+
+import numpy as np
+
+from rag_or_search.tools.embedding_cache import FakeEmbeddings
+
+Failure = Union[int, str]
+
+
+class StubEmbeddingServer:
+    """OpenAI-compatible embedding server on ``127.0.0.1``, run in a thread.
+
+    Parameters
+    ----------
+    failures : sequence of int or str, optional
+        Scripted outcome of the first requests (see the module docstring).
+    size : int, optional
+        Embedding dimension.
+    slow_seconds : float, optional
+        Delay of a ``"slow"`` response.
+    """
+
+    def __init__(self, failures: Sequence[Failure] = (), size: int = 16, slow_seconds: float = 2.0):
+        self.failures: List[Failure] = list(failures)
+        self.model = FakeEmbeddings(size=size)
+        self.slow_seconds = slow_seconds
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self) -> "StubEmbeddingServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next_failure(self):
+        with self._lock:
+            self.requests += 1
+            return self.failures.pop(0) if self.failures else None
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args) -> None:
+                pass
+
+            def _reply(self, status: int, payload: dict) -> None:
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                if status == 429:
+                    self.send_header("retry-after", "0")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self) -> None:
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                failure = stub._next_failure()
+                if failure == "drop":
+                    self.close_connection = True
+                    self.connection.close()
+                    return
+                if failure == "slow":
+                    time.sleep(stub.slow_seconds)
+                elif failure is not None:
+                    self._reply(failure, {"error": {"message": f"scripted {failure}", "type": "stub"}})
+                    return
+
+                texts = request["input"]
+                texts = [texts] if isinstance(texts, str) else texts
+                data = []
+                for i, vector in enumerate(stub.model.embed_documents(texts)):
+                    if request.get("encoding_format") == "base64":
+                        vector = base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode("ascii")
+                    data.append({"object": "embedding", "index": i, "embedding": vector})
+                self._reply(200, {
+                    "object": "list",
+                    "data": data,
+                    "model": request.get("model", "stub"),
+                    "usage": {"prompt_tokens": 0, "total_tokens": 0},
+                })
+
+        return Handler
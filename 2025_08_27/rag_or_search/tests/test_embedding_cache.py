@@ -0,0 +1,80 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from rag_or_search.tools.embedding_cache import CachedEmbeddings, EmbeddingCache, FakeEmbeddings, embedding_key
+
+
+def _texts(prefix, n):
+    return [f"{prefix} chunk {i}" for i in range(n)]
+
+
+def test_misses_are_embedded_once(tmp_path):
+    model = FakeEmbeddings(size=16)
+    embeddings = CachedEmbeddings(model, EmbeddingCache(str(tmp_path)), model="m")
+    texts = _texts("a", 10)
+
+    first = embeddings.embed_documents(texts)
+    second = embeddings.embed_documents(texts + ["new text"])
+
+    assert second[:10] == first
+    assert model.texts_embedded == 11
+    assert embeddings.embed_query(texts[0]) == first[0]
+    assert model.texts_embedded == 11
+
+
+def test_vectors_persist_across_instances(tmp_path):
+    model = FakeEmbeddings(size=16)
+    texts = _texts("b", 5)
+    expected = CachedEmbeddings(model, EmbeddingCache(str(tmp_path)), model="m").embed_documents(texts)
+
+    reopened = CachedEmbeddings(model, EmbeddingCache(str(tmp_path)), model="m")
+    assert reopened.embed_documents(texts) == expected
+    assert model.texts_embedded == 5
+
+
+def test_dimension_mismatch(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    cache.put_many(["k1"], [np.ones(8)])
+    with pytest.raises(ValueError):
+        cache.put_many(["k2"], [np.ones(4)])
+
+
+def test_lru_eviction_keeps_recently_used(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), max_bytes=256 * 1024)
+    cache.put_many(["hot"], [np.ones(256)])
+    for start in range(0, 2000, 50):
+        keys = [f"k{i}" for i in range(start, start + 50)]
+        cache.put_many(keys, np.zeros((50, 256)))
+        cache.get_many(["hot"])
+
+    assert "hot" in cache
+    assert "k0" not in cache
+    assert len(cache) < 2001
+
+
+def _fill(cache_dir, prefix):
+    model = FakeEmbeddings(size=32)
+    embeddings = CachedEmbeddings(model, EmbeddingCache(cache_dir), model="m")
+    for start in range(0, 200, 20):
+        embeddings.embed_documents(_texts(prefix, 200)[start:start + 20])
+
+
+def test_processes_share_a_cache_directory(tmp_path):
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=_fill, args=(str(tmp_path), prefix)) for prefix in ("p", "q", "r")]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    # Ogni chiave deve restituire il vettore del proprio testo, non quello di un altro processo
+    cache = EmbeddingCache(str(tmp_path))
+    reference = FakeEmbeddings(size=32)
+    for prefix in ("p", "q", "r"):
+        texts = _texts(prefix, 200)
+        vectors = cache.get_many([embedding_key("m", t) for t in texts])
+        assert all(v is not None for v in vectors)
+        np.testing.assert_allclose(np.array(vectors), np.array(reference.embed_documents(texts)), rtol=1e-6)
@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+from langchain.schema import Document
+
+from rag_or_search.tools import rag_utils
+from rag_or_search.tools.embedding_cache import FakeEmbeddings
+from rag_or_search.tools.rag_utils import RagEngine, Settings
+
+
+def _docs():
+    return [
+        Document(page_content=f"document {i} about topic {i % 4}. " * 10, metadata={"source": f"doc{i}.md"})
+        for i in range(8)
+    ]
+
+
+@pytest.mark.parametrize("use_async", [False, True], ids=["sync", "async"])
+def test_metrics_export_is_attempted_on_cache_hits(tmp_path, monkeypatch, use_async):
+    settings = Settings(persist_dir=str(tmp_path), search_type="similarity", k=2, response_cache_threshold=0.99)
+    engine = RagEngine(settings, embeddings=FakeEmbeddings(size=16), docs_loader=_docs)
+    exports = []
+    monkeypatch.setattr(rag_utils.METRICS, "maybe_export", lambda: exports.append(1))
+
+    for _ in range(2):
+        if use_async:
+            contexts = asyncio.run(engine.asearch("topic 1"))
+        else:
+            contexts = engine.search("topic 1")
+        assert len(contexts) == 2
+    engine.close()
+
+    assert engine.response_cache.hits == 1
+    assert len(exports) == 2
@@ -0,0 +1,169 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from langchain.schema import Document
+
+from rag_or_search.tools import incremental
+from rag_or_search.tools.embedding_cache import FakeEmbeddings
+from rag_or_search.tools.incremental import load_live_store, update_vectorstore
+from rag_or_search.tools.index_store import MmapDocstore, read_schema
+from rag_or_search.tools.rag_utils import Settings, build_faiss_vectorstore
+
+
+def _chunks(n, offset=0, section="intro"):
+    return [
+        Document(page_content=f"paragraph {i} about topic {i % 7}", metadata={"source": f"doc{i % 5}.md", "section": section})
+        for i in range(offset, offset + n)
+    ]
+
+
+def _build(path, chunks, embeddings):
+    settings = Settings(persist_dir=str(path), search_type="similarity", embed_concurrency=1)
+    build_faiss_vectorstore(chunks, embeddings, str(path), settings)
+
+
+def _results(store, queries, embeddings, k=5, **kwargs):
+    out = []
+    for query in queries:
+        hits = store.similarity_search_with_score_by_vector(embeddings.embed_query(query), k=k, **kwargs)
+        out.append([(d.page_content, d.metadata, round(float(s), 5)) for d, s in hits])
+    return out
+
+
+QUERIES = [f"topic {i}" for i in range(7)] + ["paragraph 3", "paragraph 120"]
+
+
+def test_update_writes_a_delta_and_matches_a_rebuild(tmp_path):
+    embeddings = FakeEmbeddings(size=16)
+    chunks = _chunks(100)
+    _build(tmp_path / "live", chunks, embeddings)
+    base_texts = (tmp_path / "live" / "texts.bin").stat().st_mtime_ns
+
+    relabeled = [Document(page_content=d.page_content, metadata={**d.metadata, "section": "moved"}) for d in chunks[:3]]
+    current = relabeled + chunks[3:90] + _chunks(4, offset=100)
+    embedded = embeddings.texts_embedded
+    update = update_vectorstore(
+        load_live_store(str(tmp_path / "live"), embeddings), current, str(tmp_path / "live"), compact_ratio=10
+    )
+
+    assert (len(update.added), len(update.removed), len(update.relabeled)) == (4, 10, 3)
+    assert embeddings.texts_embedded - embedded == 4
+    # La base non viene riscritta: solo segmento, tombstone e store.json
+    assert (tmp_path / "live" / "texts.bin").stat().st_mtime_ns == base_texts
+    assert read_schema(str(tmp_path / "live"))["delta"]["segments"] == ["delta-0001"]
+    assert (tmp_path / "live" / "tombstones-0001.npy").exists()
+
+    _build(tmp_path / "full", current, embeddings)
+    live = load_live_store(str(tmp_path / "live"), embeddings)
+    full = load_live_store(str(tmp_path / "full"), embeddings)
+    assert _results(live, QUERIES, embeddings) == _results(full, QUERIES, embeddings)
+    assert _results(live, QUERIES, embeddings, filter={"section": "moved"}) == _results(
+        full, QUERIES, embeddings, filter={"section": "moved"}
+    )
+
+
+def test_unchanged_corpus_writes_nothing(tmp_path):
+    embeddings = FakeEmbeddings(size=16)
+    chunks = _chunks(30)
+    _build(tmp_path, chunks, embeddings)
+    store_json = (tmp_path / "store.json").stat().st_mtime_ns
+
+    update = update_vectorstore(load_live_store(str(tmp_path), embeddings), chunks, str(tmp_path))
+
+    assert not update.changed
+    assert (tmp_path / "store.json").stat().st_mtime_ns == store_json
+
+
+def test_deltas_are_compacted_past_the_ratio(tmp_path):
+    embeddings = FakeEmbeddings(size=16)
+    chunks = _chunks(100)
+    _build(tmp_path / "live", chunks, embeddings)
+
+    current = chunks
+    for step in range(3):
+        current = current[5:] + _chunks(5, offset=100 + 5 * step)
+        update_vectorstore(load_live_store(str(tmp_path / "live"), embeddings), current, str(tmp_path / "live"))
+        schema = read_schema(str(tmp_path / "live"))
+        if step == 0:
+            assert "delta" in schema
+
+    # Al terzo aggiornamento 15 aggiunte e 15 tombstone superano il 20% di 100 chunk
+    assert "delta" not in schema
+    assert schema["count"] == len(current)
+    assert not list((tmp_path / "live").glob("delta-*"))
+    assert not list((tmp_path / "live").glob("tombstones-*"))
+
+    _build(tmp_path / "full", current, embeddings)
+    live = load_live_store(str(tmp_path / "live"), embeddings)
+    full = load_live_store(str(tmp_path / "full"), embeddings)
+    assert _results(live, QUERIES, embeddings) == _results(full, QUERIES, embeddings)
+
+
+def test_deleted_documents_are_not_found(tmp_path):
+    embeddings = FakeEmbeddings(size=16)
+    chunks = _chunks(20)
+    _build(tmp_path, chunks, embeddings)
+    store = load_live_store(str(tmp_path), embeddings)
+    gone = [store.index_to_docstore_id[p] for p in range(5)]
+
+    update_vectorstore(store, chunks[5:], str(tmp_path), compact_ratio=10)
+
+    live = load_live_store(str(tmp_path), embeddings)
+    assert all(isinstance(live.docstore.search(doc_id), str) for doc_id in gone)
+    assert np.array_equal(live.docstore.deleted_positions(), np.arange(5))
+    hits = live.similarity_search_by_vector(embeddings.embed_query("paragraph 1"), k=20)
+    assert len(hits) == 15
+
+
+@pytest.mark.parametrize("k", [1, 3])
+def test_search_pads_when_most_positions_are_deleted(tmp_path, k):
+    embeddings = FakeEmbeddings(size=16)
+    chunks = _chunks(6)
+    _build(tmp_path, chunks, embeddings)
+    update_vectorstore(load_live_store(str(tmp_path), embeddings), chunks[:1], str(tmp_path), compact_ratio=10)
+
+    live = load_live_store(str(tmp_path), embeddings)
+    _, labels = live.index.search(np.array([embeddings.embed_query("x")], dtype=np.float32), k)
+    assert labels[0, 0] == 0
+    assert (labels[0, 1:] == -1).all()
+    assert Path(tmp_path / "delta-0001").exists() is False
+
+
+@pytest.mark.parametrize("step,added", [("update_schema", 3), ("drop_deltas", 0)], ids=["before-commit", "after-commit"])
+def test_interrupted_update_keeps_store_and_manifest_in_step(tmp_path, monkeypatch, step, added):
+    embeddings = FakeEmbeddings(size=16)
+    chunks = _chunks(20)
+    _build(tmp_path, chunks, embeddings)
+    current = chunks + _chunks(3, offset=20)
+
+    def crash(*args, **kwargs):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as m:
+        m.setattr(incremental, step, crash)
+        with pytest.raises(OSError):
+            update_vectorstore(load_live_store(str(tmp_path), embeddings), current, str(tmp_path), compact_ratio=10)
+
+    # Il manifest segue store.json: chunk aggiunti una sola volta
+    update = update_vectorstore(load_live_store(str(tmp_path), embeddings), current, str(tmp_path), compact_ratio=10)
+    assert len(update.added) == added
+    live = load_live_store(str(tmp_path), embeddings)
+    assert live.index.ntotal - len(live.docstore.deleted_positions()) == len(current)
+
+
+def test_relabels_are_found_without_reading_documents(tmp_path, monkeypatch):
+    embeddings = FakeEmbeddings(size=16)
+    chunks = _chunks(30)
+    _build(tmp_path, chunks, embeddings)
+    store = load_live_store(str(tmp_path), embeddings)
+    relabeled = [Document(page_content=d.page_content, metadata={**d.metadata, "section": "moved"}) for d in chunks[:4]]
+    tagged = [Document(page_content=d.page_content, metadata={**d.metadata, "tag": "new"}) for d in chunks[4:6]]
+
+    def unexpected(self, position):
+        raise AssertionError("document materialized")
+
+    monkeypatch.setattr(MmapDocstore, "document_at", unexpected)
+    update = update_vectorstore(store, relabeled + tagged + chunks[6:], str(tmp_path), compact_ratio=10)
+
+    assert (len(update.added), len(update.removed), len(update.relabeled), update.unchanged) == (0, 0, 6, 24)
@@ -0,0 +1,59 @@
+import numpy as np
+import openai
+import pytest
+from langchain_openai import OpenAIEmbeddings
+
+from embedding_server import StubEmbeddingServer
+from rag_or_search.tools.embedding_cache import FakeEmbeddings
+from rag_or_search.tools.ingest import embed_chunks, is_transient
+
+
+def _client(server, timeout=0.5):
+    # Nessun retry nel client: li gestisce embed_chunks
+    return OpenAIEmbeddings(
+        model="stub",
+        base_url=server.base_url,
+        api_key="stub",
+        max_retries=0,
+        timeout=timeout,
+        check_embedding_ctx_length=False,
+    )
+
+
+TEXTS = [f"chunk {i}" for i in range(12)]
+
+
+def test_embeds_through_the_openai_client():
+    with StubEmbeddingServer() as server:
+        vectors, report = embed_chunks(TEXTS, _client(server), batch_size=4, max_workers=2)
+
+    np.testing.assert_allclose(vectors, np.array(FakeEmbeddings(size=16).embed_documents(TEXTS)), rtol=1e-6)
+    assert (report.batches, report.retries) == (3, 0)
+    assert server.requests == 3
+
+
+@pytest.mark.parametrize("failure", [429, "drop", "slow"], ids=["throttled", "connection", "timeout"])
+def test_transient_errors_are_retried(failure):
+    with StubEmbeddingServer(failures=[failure]) as server:
+        vectors, report = embed_chunks(TEXTS, _client(server), batch_size=4, max_workers=1, max_retries=2)
+
+    np.testing.assert_allclose(vectors, np.array(FakeEmbeddings(size=16).embed_documents(TEXTS)), rtol=1e-6)
+    assert report.retries == 1
+    assert server.requests == 4
+
+
+def test_retries_are_bounded():
+    with StubEmbeddingServer(failures=["drop"] * 3) as server:
+        with pytest.raises(openai.APIConnectionError):
+            embed_chunks(TEXTS[:4], _client(server), batch_size=4, max_workers=1, max_retries=1)
+
+    assert server.requests == 2
+
+
+def test_client_errors_are_not_retried():
+    with StubEmbeddingServer(failures=[400]) as server:
+        with pytest.raises(openai.BadRequestError) as excinfo:
+            embed_chunks(TEXTS[:4], _client(server), batch_size=4, max_workers=1, max_retries=3)
+
+    assert not is_transient(excinfo.value)
+    assert server.requests == 1
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from langchain.schema import Document
+
+from rag_or_search.tools.embedding_cache import FakeEmbeddings
+from rag_or_search.tools.incremental import load_live_store, update_vectorstore
+from rag_or_search.tools.lexical import BM25Index, LayeredBM25Index, _texts, lexical_index_for
+from rag_or_search.tools.rag_utils import Settings, build_faiss_vectorstore, load_or_build_sharded_vectorstore
+
+
+def _chunks(n, offset=0, section="intro"):
+    return [
+        Document(
+            page_content=f"paragraph {i} about topic {i % 7} error ERR-{i % 11}",
+            metadata={"source": f"doc{i % 5}.md", "section": section},
+        )
+        for i in range(offset, offset + n)
+    ]
+
+
+QUERIES = ["ERR-3", "topic 4 paragraph", "paragraph 12", "error", "unknown words"]
+
+
+def _assert_same_ranking(index, store):
+    reference = BM25Index.build(_texts(store))
+    for query in QUERIES:
+        positions, scores = index.search(query, k=20)
+        expected_positions, expected_scores = reference.search(query, k=20)
+        np.testing.assert_array_equal(positions, expected_positions)
+        np.testing.assert_allclose(scores, expected_scores)
+
+
+def test_update_indexes_only_the_new_segment(tmp_path):
+    embeddings = FakeEmbeddings(size=16)
+    chunks = _chunks(60)
+    settings = Settings(persist_dir=str(tmp_path), search_type="hybrid", embed_concurrency=1)
+    build_faiss_vectorstore(chunks, embeddings, str(tmp_path), settings)
+    base_lexical = (tmp_path / "lexical" / "lexical.json").stat().st_mtime_ns
+    assert isinstance(lexical_index_for(load_live_store(str(tmp_path), embeddings)), BM25Index)
+
+    relabeled = [Document(page_content=d.page_content, metadata={**d.metadata, "section": "moved"}) for d in chunks[:3]]
+    current = relabeled + chunks[3:50] + _chunks(5, offset=60)
+    update_vectorstore(load_live_store(str(tmp_path), embeddings), current, str(tmp_path), compact_ratio=10)
+
+    live = load_live_store(str(tmp_path), embeddings)
+    index = lexical_index_for(live)
+    assert isinstance(index, LayeredBM25Index)
+    # La base non viene reindicizzata: solo il segmento delta
+    assert (tmp_path / "lexical" / "lexical.json").stat().st_mtime_ns == base_lexical
+    assert (tmp_path / "delta-0001" / "lexical" / "lexical.json").exists()
+    _assert_same_ranking(index, live)
+
+
+@pytest.mark.parametrize("incremental", [False, True])
+def test_sharded_store_is_indexed_per_shard(tmp_path, incremental):
+    embeddings = FakeEmbeddings(size=16)
+    settings = Settings(
+        persist_dir=str(tmp_path), shards=3, search_type="hybrid", embed_concurrency=1,
+        incremental=incremental, delta_compact_ratio=10,
+    )
+    load_or_build_sharded_vectorstore(settings, embeddings, _chunks(40))
+    store = load_or_build_sharded_vectorstore(settings, embeddings, _chunks(35, offset=5))
+
+    _assert_same_ranking(lexical_index_for(store), store)
+    assert len(list(tmp_path.glob("shard-*/lexical/lexical.json"))) == 3
@@ -0,0 +1,53 @@
+import faiss
+import numpy as np
+import pytest
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+
+from rag_or_search.tools.embedding_cache import FakeEmbeddings
+from rag_or_search.tools.mmr import mmr_search_by_vectors
+
+
+def _store(n, size=16):
+    embeddings = FakeEmbeddings(size=size)
+    store = FAISS(
+        embedding_function=embeddings,
+        index=faiss.IndexFlatL2(size),
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+    )
+    if n:
+        texts = [f"chunk {i} about topic {i % 9}" for i in range(n)]
+        store.add_texts(texts)
+    return store, embeddings
+
+
+@pytest.mark.parametrize("lambda_mult", [0.0, 0.5, 1.0])
+def test_matches_langchain_selection(lambda_mult):
+    store, embeddings = _store(200)
+    queries = np.array([embeddings.embed_query(f"topic {i}") for i in range(9)], dtype=np.float32)
+
+    results = mmr_search_by_vectors(store, queries, k=5, fetch_k=30, lambda_mult=lambda_mult)
+
+    for query, docs in zip(queries, results):
+        _, indices = store.index.search(query[None], 30)
+        candidates = [store.index.reconstruct(int(i)) for i in indices[0]]
+        picks = maximal_marginal_relevance(query, candidates, lambda_mult=lambda_mult, k=5)
+        expected = [store.docstore.search(store.index_to_docstore_id[int(indices[0][p])]).page_content for p in picks]
+        assert [doc.page_content for doc, _ in docs] == expected
+
+
+def test_empty_store_returns_no_documents():
+    store, embeddings = _store(0)
+    queries = np.array([embeddings.embed_query("anything")] * 2, dtype=np.float32)
+
+    assert mmr_search_by_vectors(store, queries, k=3, fetch_k=1) == [[], []]
+
+
+def test_fetch_k_larger_than_the_store():
+    store, embeddings = _store(3)
+
+    results = mmr_search_by_vectors(store, np.array([embeddings.embed_query("topic 1")]), k=5, fetch_k=50)
+
+    assert len(results[0]) == 3
@@ -0,0 +1,104 @@
+from dataclasses import replace
+
+import numpy as np
+from langchain.schema import Document
+
+from rag_or_search.tools import rag_utils
+from rag_or_search.tools.embedding_cache import FakeEmbeddings
+from rag_or_search.tools.rag_utils import Settings, load_or_build_sharded_vectorstore
+
+
+def _docs(n=12, section="intro"):
+    return [
+        Document(page_content=f"document {i} about topic {i % 4}. " * 20, metadata={"source": f"doc{i}.md", "section": section})
+        for i in range(n)
+    ]
+
+
+def _settings(path, **kwargs):
+    return Settings(
+        persist_dir=str(path), shards=3, search_type="similarity", chunk_size=200, chunk_overlap=20,
+        embed_concurrency=1, **kwargs,
+    )
+
+
+def _split_counter(monkeypatch):
+    calls = []
+    split = rag_utils.split_documents
+
+    def counting(docs, settings):
+        calls.append(len(docs))
+        return split(docs, settings)
+
+    monkeypatch.setattr(rag_utils, "split_documents", counting)
+    return calls
+
+
+def test_unchanged_corpus_is_not_split_or_embedded(tmp_path, monkeypatch):
+    embeddings = FakeEmbeddings(size=16)
+    settings = _settings(tmp_path)
+    first = load_or_build_sharded_vectorstore(settings, embeddings, _docs())
+    calls = _split_counter(monkeypatch)
+    embedded = embeddings.texts_embedded
+
+    second = load_or_build_sharded_vectorstore(settings, embeddings, _docs())
+
+    assert calls == []
+    assert embeddings.texts_embedded == embedded
+    assert second.index.ntotal == first.index.ntotal
+    # Stesso pool di thread tra un caricamento e l'altro
+    assert second.index._executor is first.index._executor
+
+
+def test_only_touched_shards_are_split(tmp_path, monkeypatch):
+    embeddings = FakeEmbeddings(size=16)
+    settings = _settings(tmp_path, incremental=True)
+    docs = _docs()
+    load_or_build_sharded_vectorstore(settings, embeddings, docs)
+    calls = _split_counter(monkeypatch)
+
+    docs[0] = Document(page_content="a brand new text. " * 20, metadata=docs[0].metadata)
+    load_or_build_sharded_vectorstore(settings, embeddings, docs)
+
+    assert len(calls) == 1
+
+
+def test_relabelled_metadata_is_picked_up(tmp_path):
+    embeddings = FakeEmbeddings(size=16)
+    query = embeddings.embed_query("topic 1")
+    for incremental in (False, True):
+        settings = _settings(tmp_path / str(incremental), incremental=incremental)
+        load_or_build_sharded_vectorstore(settings, embeddings, _docs())
+        embedded = embeddings.texts_embedded
+
+        store = load_or_build_sharded_vectorstore(settings, embeddings, _docs(section="moved"))
+
+        hits = store.similarity_search_by_vector(query, k=50)
+        assert hits and all(doc.metadata["section"] == "moved" for doc in hits)
+        if incremental:
+            # Solo i metadati cambiano: nessun testo viene ricalcolato
+            assert embeddings.texts_embedded == embedded
+
+
+def test_relabelled_vectors_stay_exact_with_quantized_storage(tmp_path):
+    embeddings = FakeEmbeddings(size=16)
+    settings = _settings(tmp_path, incremental=True, vector_storage="int8", delta_compact_ratio=10)
+    load_or_build_sharded_vectorstore(settings, embeddings, _docs())
+
+    store = load_or_build_sharded_vectorstore(settings, embeddings, _docs(section="moved"))
+
+    # I vettori copiati nel segmento delta sono quelli float32, non i codici int8
+    texts = [store.docstore.search(store.index_to_docstore_id[p]).page_content for p in range(store.index.ntotal)]
+    expected = np.array(embeddings.embed_documents(texts), dtype=np.float32)
+    np.testing.assert_allclose(store.index.reconstruct_n(0, store.index.ntotal), expected, rtol=1e-6)
+
+
+def test_lowering_the_shard_count_removes_stale_shards(tmp_path):
+    embeddings = FakeEmbeddings(size=16)
+    load_or_build_sharded_vectorstore(_settings(tmp_path), embeddings, _docs())
+    assert (tmp_path / "shard-002").exists()
+
+    store = load_or_build_sharded_vectorstore(replace(_settings(tmp_path), shards=2), embeddings, _docs())
+
+    assert sorted(p.name for p in tmp_path.glob("shard-*")) == ["shard-000", "shard-001"]
+    assert len({doc.metadata["source"] for doc in store.similarity_search("topic", k=200)}) == 12
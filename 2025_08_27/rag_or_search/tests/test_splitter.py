@@ -0,0 +1,45 @@
+import pytest
+from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from rag_or_search.tools.rag_utils import SPLIT_SEPARATORS
+from rag_or_search.tools.splitter import FastRecursiveSplitter, compare_with_langchain, random_texts
+
+SEPARATORS = [SPLIT_SEPARATORS, None, ["\n\n", "\n", " "], ["---", "\n"]]
+CONFIGS = [(1000, 100), (200, 20), (50, 0), (10, 9), (3, 1), (1, 0)]
+
+
+@pytest.mark.parametrize("separators", SEPARATORS, ids=["rag", "default", "no-chars", "custom"])
+@pytest.mark.parametrize("chunk_size,chunk_overlap", CONFIGS)
+def test_same_chunks_as_langchain(chunk_size, chunk_overlap, separators):
+    texts = random_texts(300, separators or SPLIT_SEPARATORS, seed=chunk_size)
+
+    assert compare_with_langchain(texts, chunk_size, chunk_overlap, separators) == []
+
+
+@pytest.mark.parametrize("text", ["", "   ", "\n\n\n", "a", "è" * 30, "word " * 400])
+def test_edge_cases(text):
+    assert compare_with_langchain([text], 20, 5, SPLIT_SEPARATORS) == []
+
+
+def test_documents_keep_their_metadata():
+    docs = [
+        Document(page_content="alpha beta gamma. " * 40, metadata={"source": "a.md", "section": 1}),
+        Document(page_content="delta\n\nepsilon " * 30, metadata={"source": "b.md", "tags": ["x", "y"]}),
+    ]
+    reference = RecursiveCharacterTextSplitter(chunk_size=100, chunk_overlap=10, separators=SPLIT_SEPARATORS)
+    fast = FastRecursiveSplitter(100, 10, SPLIT_SEPARATORS)
+
+    expected = reference.split_documents(docs)
+    chunks = fast.split_documents(docs)
+
+    assert [(c.page_content, c.metadata) for c in chunks] == [(c.page_content, c.metadata) for c in expected]
+    # Metadati copiati, non condivisi tra i chunk
+    chunks[-1].metadata["tags"].append("z")
+    assert docs[1].metadata["tags"] == ["x", "y"]
+
+
+@pytest.mark.parametrize("chunk_size,chunk_overlap", [(0, 0), (10, -1), (10, 11)])
+def test_invalid_sizes(chunk_size, chunk_overlap):
+    with pytest.raises(ValueError):
+        FastRecursiveSplitter(chunk_size, chunk_overlap)